@@ -19,7 +19,13 @@ setup(
     include_package_data=True,
     install_requires=[
         'flask',
+        'numpy',
     ],
+    extras_require={
+        'cassandra': ['cassandra-driver'],
+        'ingest': ['aiohttp', 'asyncpg'],
+        'codecs': ['msgpack', 'cbor2'],
+    },
     entry_points={
         'console_scripts': {'snms = snms.cli.core:cli'},
         'pytest11': {'snms = snms.testing.pytest_plugin'},
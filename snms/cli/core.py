@@ -65,12 +65,46 @@ def celery(ctx):
     celery_cmd(ctx.args)
 
 
-@cli.command(context_settings={'ignore_unknown_options': True, 'allow_extra_args': True}, add_help_option=False)
-@click.pass_context
-def mqtt(ctx):
-    """Manage the Celery task daemon."""
+@cli.command()
+@click.option('--workers', '-w', default=1, type=int, help='Number of consumer processes.')
+@click.option('--partitions', default=None, type=int,
+              help='Total number of partitions of all nodes. Defaults to the number of workers.')
+@click.option('--partition-offset', default=0, type=int, help='First partition consumed on this node.')
+@click.option('--prefetch', default=None, type=int, help='Unacknowledged messages per worker.')
+@click.option('--threads', default=None, type=int, help='Threads per worker.')
+@click.option('--batch-size', default=None, type=int, help='Messages per batch, 0 to disable batching.')
+@click.option('--batch-wait', default=None, type=int, help='Milliseconds to wait for a batch to fill up.')
+def mqtt(workers, partitions, partition_offset, prefetch, threads, batch_size, batch_wait):
+    """Run the MQTT consumer.
+
+    With more than one worker, or with `--partitions`, values are
+    distributed by sensor across partition queues and each worker consumes
+    one of them. To spread the partitions over several nodes, run each node
+    with the same `--partitions` and its own `--partition-offset`.
+
+    With MQTT_CONSUMER_ENGINE = 'mqtt' the workers join a shared
+    subscription instead and partitions are not used.
+    """
     from snms.core.mqtt.cli import mqtt_cmd
-    mqtt_cmd(ctx.args)
+    mqtt_cmd(workers, partitions, partition_offset, prefetch, threads, batch_size, batch_wait)
+
+
+@cli.command()
+@click.option('--host', '-h', default='127.0.0.1', metavar='HOST', help='The ip/host to bind to.')
+@click.option('--port', '-p', default=8001, type=int, metavar='PORT', help='The port to bind to.')
+@click.option('--pool-size', default=10, type=int, help='Maximum number of database connections.')
+@click.option('--threads', default=8, type=int, help='Threads for time series writes, alerts and MQTT.')
+def ingest(host, port, pool_size, threads):
+    """Run the device ingest server.
+
+    Serves only the routes used by devices to post values and poll their
+    configuration, on an asyncio event loop. Route these paths to it
+    from the web server in front of SNMS. Time series writes and alerts
+    still run on a pool of --threads threads, which bounds its throughput;
+    readings with file uploads are refused.
+    """
+    from snms.core.ingest.cli import ingest_cmd
+    ingest_cmd(host, port, pool_size, threads)
 
 
 @cli.command(with_appcontext=False)
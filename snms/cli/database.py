@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 
 import os
 import sys
+from datetime import datetime, timedelta
 from functools import partial
 
 import click
@@ -12,10 +13,12 @@ from terminaltables import AsciiTable
 
 import snms
 from snms.cli.core import cli_group
+from snms.core.config import config
 from snms.core.db import db
 from snms.core.db.sqlalchemy.migration import migrate, prepare_db
 from snms.utils.console import cformat
 from snms.database import tsdb
+from snms.database.exceptions import MeasurementNotFound
 
 
 @cli_group()
@@ -34,6 +37,105 @@ def prepare():
     return prepare_db()
 
 
+@cli.command('bucket-tsdb')
+@click.argument('sensor_types', nargs=-1)
+@click.option('--bucket-size', type=int, help='Seconds per bucket, by default from TSDB_BUCKET_SIZES or '
+                                              'TSDB_BUCKET_SIZE')
+@click.option('--drop', is_flag=True, help='Drop the old tables once they are copied')
+def bucket_tsdb(sensor_types, bucket_size, drop):
+    """Move Cassandra sensor tables to the time-bucketed layout.
+
+    The tables stay in use: values are written to the old and the new table
+    until the old rows are copied. Without SENSOR_TYPES all sensor types are
+    moved.
+    """
+    from snms.modules.sensors import SensorType
+    if config.TSDB_CLIENT != 'cassandra':
+        print(cformat('%{red!}Only Cassandra tables are bucketed'))
+        sys.exit(1)
+    if not sensor_types:
+        sensor_types = [sensor_type.type for sensor_type in SensorType.query.filter(SensorType.deleted == False)]
+    for sensor_type in sensor_types:
+        size = bucket_size or config.TSDB_BUCKET_SIZES.get(sensor_type, config.TSDB_BUCKET_SIZE)
+        if not size:
+            print(cformat('%{red!}No bucket size for {}').format(sensor_type))
+            continue
+        copied = tsdb.client.migrate_to_buckets(sensor_type, size, drop=drop, log=print)
+        if copied is None:
+            print(cformat('%{yellow}{} is already bucketed').format(sensor_type))
+
+
+@cli.command('history-tsdb')
+@click.option('--bucket-size', type=int, help='Seconds per bucket, one week by default')
+def history_tsdb(bucket_size):
+    """Fill the Cassandra history tables of alerts, events and event logs.
+
+    History pages filtered by company, sensor, alert or event read these
+    tables once they are filled instead of filtering the whole history of
+    the company. History written meanwhile is kept in both.
+    """
+    from snms.database.cassandra_client import HISTORY_TABLES
+    if config.TSDB_CLIENT != 'cassandra':
+        print(cformat('%{red!}Only Cassandra has history tables'))
+        sys.exit(1)
+    for measurement in HISTORY_TABLES:
+        copied = tsdb.client.migrate_history(measurement, bucket_size or tsdb.client.HISTORY_BUCKET_SIZE,
+                                             log=print)
+        if copied is None:
+            print(cformat('%{yellow}{} history tables are already in use').format(measurement))
+
+
+@cli.command('count-tsdb')
+@click.argument('sensor_types', nargs=-1)
+def count_tsdb(sensor_types):
+    """Fill the Cassandra point counters of sensor tables.
+
+    Values are counted at ingest, and history totals are read from the
+    counters of sensor types counted from their creation or by this
+    command. It can run while values are written, and running it again
+    corrects the counters, also of values counted twice because they were
+    written again. Without SENSOR_TYPES all sensor types are counted.
+    """
+    from snms.modules.sensors import SensorType
+    if config.TSDB_CLIENT != 'cassandra':
+        print(cformat('%{red!}Only Cassandra tables have point counters'))
+        sys.exit(1)
+    if not sensor_types:
+        sensor_types = [sensor_type.type for sensor_type in SensorType.query.filter(SensorType.deleted == False)]
+    for sensor_type in sensor_types:
+        try:
+            tsdb.client.recount(sensor_type, log=print)
+        except (MeasurementNotFound, ValueError) as e:
+            print(cformat('%{red!}{}').format(e))
+
+
+@cli.command('rollup-tsdb')
+@click.argument('sensor_types', nargs=-1)
+@click.option('--days', type=int, default=30, show_default=True, help='Days of older readings to roll up')
+def rollup_tsdb(sensor_types, days):
+    """Roll up older sensor readings, with TSDB_ROLLUPS.
+
+    Rollups start with the readings written once they are enabled; grouped
+    history reaching further back is read from the readings until this
+    command rolls them up. Without SENSOR_TYPES all sensor types are rolled
+    up.
+    """
+    from snms.modules.sensors import Sensor, SensorType
+    if not config.TSDB_ROLLUPS:
+        print(cformat('%{red!}Rollups are not enabled, see TSDB_ROLLUPS'))
+        sys.exit(1)
+    if not sensor_types:
+        sensor_types = [sensor_type.type for sensor_type in SensorType.query.filter(SensorType.deleted == False)]
+    start = datetime.utcnow() - timedelta(days=days)
+    for sensor_type in sensor_types:
+        companies = {sensor.id: sensor.company_id
+                     for sensor in Sensor.query.filter(Sensor.type == sensor_type, Sensor.deleted == False)}
+        written = tsdb.backfill_rollups(sensor_type, list(companies), start, log=print, companies=companies)
+        if written is None:
+            print(cformat('%{red!}The {} database has no rollups').format(config.TSDB_CLIENT))
+            sys.exit(1)
+
+
 @cli.command()
 def purge():
     """Remove deleted companies, sensors, and other data."""
@@ -7,7 +7,6 @@
 """Constants used in App"""
 
 SINGLE_USER = True
-TSDB_CLIENT = 'influx'
 
 # Alert Types
 ALERT_TYPE_LESS_THEN = 'lt'
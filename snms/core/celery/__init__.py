@@ -6,7 +6,7 @@
 
 from __future__ import unicode_literals
 
-from celery.signals import import_modules, worker_process_init, beat_init
+from celery.signals import import_modules, worker_process_init, worker_process_shutdown, beat_init
 from flask import session
 
 from snms.core import signals
@@ -21,7 +21,13 @@ def cassandra_init(**kwargs):
     """ Initialize a clean Cassandra connection. """
     tsdb.restart()
 
+
+def tsdb_shutdown(**kwargs):
+    """ Write the points still buffered by the worker process. """
+    tsdb.close_buffer()
+
 worker_process_init.connect(cassandra_init)
+worker_process_shutdown.connect(tsdb_shutdown)
 beat_init.connect(cassandra_init)
 
 #: The Celery instance for all SNMS tasks
@@ -64,11 +64,31 @@ DEFAULTS = {
     'SQLALCHEMY_POOL_RECYCLE': 120,
     'SQLALCHEMY_POOL_SIZE': 5,
     'SQLALCHEMY_POOL_TIMEOUT': 10,
+    'TSDB_CLIENT': 'influx',
+    'TSDB_DIR': '/opt/snms/tsdb',
     'TSDB_HOST': 'localhost',
     'TSDB_PORT': 8086,
     'TSDB_USERNAME': 'root',
     'TSDB_PASSWORD': 'root',
     'TSDB_DB': 'snms',
+    'TSDB_WRITE_BUFFER': False,
+    'TSDB_BATCH_SIZE': 500,
+    'TSDB_FLUSH_INTERVAL': 1.0,
+    'TSDB_BUFFER_MAX_SIZE': 10000,
+    'TSDB_WRITE_RETRIES': 3,
+    'TSDB_MAX_INFLIGHT': 128,
+    'TSDB_BUCKET_SIZE': 0,
+    'TSDB_BUCKET_SIZES': {},
+    'TSDB_QUERY_CACHE': None,
+    'TSDB_QUERY_CACHE_SIZE': 100000,
+    'TSDB_QUERY_CACHE_BUCKET': '1h',
+    'TSDB_QUERY_CACHE_GRACE': 60,
+    'TSDB_QUERY_CACHE_TTL': 0,
+    'TSDB_QUERY_CACHE_WAIT': 10,
+    'TSDB_ROLLUPS': False,
+    'TSDB_RETENTION': 0,
+    'TSDB_RETENTION_TYPES': {},
+    'TSDB_RETENTION_COMPANIES': {},
     'STATIC_FILE_METHOD': None,
     'STATIC_SITE_STORAGE': None,
     'STORAGE_BACKENDS': {'default': 'fs:/opt/snms/uploads'},
@@ -100,7 +120,28 @@ DEFAULTS = {
     'MQTT_TLS_VERSION': None,
     'MQTT_TLS_CIPHERS': None,
     'MQTT_TLS_INSECURE': None,
+    'MQTT_AMQP_PORT': 5672,
+    'MQTT_ECHO_AMQP': True,
+    'MQTT_CONSUMER_ENGINE': 'rabbitmq',
+    'MQTT_SHARED_GROUP': 'snms',
+    'MQTT_CONSUMER_QOS': 1,
+    'MQTT_CONSUMER_PROTOCOL': 5,
+    'MQTT_CONSUMER_PREFETCH': 100,
+    'MQTT_CONSUMER_THREADS': 8,
+    'MQTT_CONSUMER_BATCH_SIZE': 0,
+    'MQTT_CONSUMER_BATCH_WAIT': 50,
+    'MQTT_TENANT_WEIGHTS': {},
+    'MQTT_PRIORITY_SENSOR_TYPES': [],
     'FLOORMAP_STORAGE': 'default',
+    'INGEST_MAX_BACKFILL_DAYS': 30,
+    'SENSOR_TYPE_CACHE_TTL': 60,
+    'SENSOR_CACHE_TTL': 5,
+    'SENSOR_STATE_BUFFER': False,
+    'SENSOR_STATE_FLUSH_INTERVAL': 0.5,
+    'SENSOR_STATE_STALE_AFTER': 60,
+    'INGEST_DEDUP': False,
+    'INGEST_DEDUP_WINDOW': 300,
+    'INGEST_DEDUP_SIZE': 100000,
 }
 
 # Default values for settings that cannot be set in the config file
@@ -0,0 +1,12 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Standalone device ingest server.
+
+Started with ``snms ingest``. Requires the optional ``aiohttp`` and
+``asyncpg`` packages.
+"""
@@ -0,0 +1,21 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+import sys
+
+from flask import current_app
+
+from snms.utils.console import cformat
+
+
+def ingest_cmd(host, port, pool_size, threads):
+    try:
+        from snms.core.ingest.server import IngestServer
+    except ImportError as e:
+        print(cformat('%{red!}The ingest server requires aiohttp and asyncpg: {}').format(e))
+        sys.exit(1)
+    server = IngestServer(current_app._get_current_object(), pool_size=pool_size, threads=threads)
+    server.run(host, port)
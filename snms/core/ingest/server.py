@@ -0,0 +1,368 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Device ingest server.
+
+Serves only the routes used by devices - posting values and polling the
+configuration - on an asyncio event loop, without the Flask request stack
+and with asyncpg instead of a SQLAlchemy session. Readings are processed
+with the same rules as `post_sensor_values`; time series writes, alerts
+and MQTT publishing run on a thread pool.
+
+Only the request handling and the sensor row updates are asynchronous.
+The time series clients, alert checks and MQTT publishing are blocking,
+so the readings saved per second are still bounded by the threads of the
+pool, as they are by the workers of the Flask app; the server saves the
+overhead of the Flask request stack and the ORM, not the writes.
+
+File uploads are not supported; readings with files are refused with
+422 and have to be posted to the API.
+"""
+
+import asyncio
+import datetime
+import functools
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncpg
+from aiohttp import web
+
+from snms.core.config import config
+from snms.core.logger import Logger
+from snms.core.mqtt.echo import publish_value
+from snms.database import tsdb
+from snms.modules.sensors.dedup import dedup_key, is_duplicate, remember
+from snms.modules.sensors.controllers import time_in_range, reading_time, sensor_state_data, validate_readings
+from snms.modules.sensors.identity import SensorIdentity, sensor_identities
+from snms.modules.sensors.models.sensors import SensorState
+from snms.modules.sensors.validators import ValueValidator, InvalidValue, cached_validator, cache_validator
+from snms.utils.check_alerts import process_sensor_alerts
+
+_LOGGER = Logger.get(__name__)
+
+IDENTITY_QUERY = """
+    SELECT s.id, s.uid, s.hid, s.type, s.company_id, c.uid, s.key, c.key, s.time_start, s.time_end, s.deleted
+    FROM sensors s JOIN companies c ON c.id = s.company_id
+    WHERE s.deleted = FALSE AND {}
+    LIMIT 1
+"""
+
+LAST_UPDATE_QUERY = "SELECT last_update FROM sensors WHERE id = $1"
+
+SENSOR_TYPE_QUERY = "SELECT type, value_fields FROM sensor_types WHERE type = $1 AND deleted = FALSE"
+
+CONFIG_QUERY = """
+    SELECT s.config, t.config_fields
+    FROM sensors s LEFT JOIN sensor_types t ON t.type = s.type AND t.deleted = FALSE
+    WHERE s.id = $1
+"""
+
+UPDATE_STATE_QUERY = """
+    UPDATE sensors
+    SET value = $2::json, last_update = $3, ip = $4,
+        location_lat = COALESCE($5, sensors.location_lat),
+        location_long = COALESCE($6, sensors.location_long),
+        is_down = FALSE, is_inactive = FALSE
+    FROM sensors AS old
+    WHERE sensors.id = old.id AND sensors.id = $1
+    RETURNING sensors.id, old.is_inactive, old.last_update, old.config_updated
+"""
+
+UPDATE_STATES_QUERY = """
+    UPDATE sensors
+    SET value = v.value, last_update = v.last_update, ip = v.ip,
+        location_lat = COALESCE(v.location_lat, sensors.location_lat),
+        location_long = COALESCE(v.location_long, sensors.location_long),
+        is_down = FALSE, is_inactive = FALSE
+    FROM unnest($1::integer[], $2::json[], $3::timestamp[], $4::varchar[], $5::float8[], $6::float8[])
+        AS v (id, value, last_update, ip, location_lat, location_long),
+        sensors AS old
+    WHERE sensors.id = v.id AND old.id = v.id
+    RETURNING sensors.id, old.is_inactive, old.last_update, old.config_updated
+"""
+
+
+def _state_params(sensor_id, data):
+    return (sensor_id, json.dumps(data['value']), data['last_update'], data['ip'],
+            data.get('location_lat'), data.get('location_long'))
+
+
+class IngestServer(object):
+    """
+    Device ingest server.
+
+    :param app: Flask app, used for the configuration of the time series database, Celery and MQTT
+    :param pool_size: Maximum number of database connections
+    :param threads: Threads for time series writes, alerts and MQTT publishing
+    """
+
+    def __init__(self, app, pool_size=10, threads=8):
+        self.app = app
+        self.pool_size = pool_size
+        self.executor = ThreadPoolExecutor(threads)
+        self.pool = None
+        self._pending = {}
+        self._states = {}
+        self._flush_task = None
+
+    def make_app(self):
+        """Create the aiohttp application"""
+        application = web.Application()
+        application.router.add_post('/sensors/{sensor_id}/values', self.post_values)
+        application.router.add_post('/sensors/{sensor_id}/values/bulk', self.post_bulk_values)
+        application.router.add_post('/companies/{company_id}/sensor_by_hid/{sensor_hid}/values', self.post_values)
+        application.router.add_get('/sensors/{sensor_id}/configuration', self.get_configuration)
+        application.router.add_get('/companies/{company_id}/sensor_by_hid/{sensor_hid}/configuration',
+                                   self.get_configuration)
+        application.on_startup.append(self.on_startup)
+        application.on_cleanup.append(self.on_cleanup)
+        return application
+
+    def run(self, host, port):
+        """Serve until interrupted"""
+        web.run_app(self.make_app(), host=host, port=port, access_log=None)
+
+    async def on_startup(self, application):
+        # asyncpg only understands plain postgresql:// URLs
+        dsn = re.sub(r'^postgres(ql)?(\+\w+)?://', 'postgresql://', config.SQLALCHEMY_DATABASE_URI)
+        self.pool = await asyncpg.create_pool(dsn, min_size=1, max_size=self.pool_size)
+        if config.SENSOR_STATE_BUFFER:
+            self._flush_task = asyncio.ensure_future(self._flush_states())
+
+    async def on_cleanup(self, application):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush_states()
+        await self.pool.close()
+        await self.run_sync(tsdb.close_buffer)
+        self.executor.shutdown()
+
+    async def run_sync(self, func, *args, **kwargs):
+        """Run a blocking function on the thread pool"""
+        return await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def get_sensor(self, request):
+        """
+        Get the sensor of a request and check its key.
+
+        The sensor is authorized with the same keys as `access_control`,
+        the sensor key or the key of its company. User tokens are not
+        supported.
+        """
+        info = request.match_info
+        if 'sensor_id' in info:
+            key = ('uid', info['sensor_id'])
+            criteria = ('s.uid = $1',)
+            args = (info['sensor_id'],)
+        else:
+            key = ('hid', info['company_id'], info['sensor_hid'])
+            criteria = ('s.hid = $1', 'c.uid = $2', 'c.deleted = FALSE')
+            args = (info['sensor_hid'], info['company_id'])
+        sensor = sensor_identities.peek(key)
+        if sensor is None:
+            row = await self.pool.fetchrow(IDENTITY_QUERY.format(' AND '.join(criteria)), *args)
+            if row is None:
+                raise web.HTTPNotFound(text=json.dumps({'message': 'Sensor not found'}), content_type='application/json')
+            sensor = SensorIdentity(*row)
+            sensor_identities.put(key, sensor)
+
+        sensor_key = request.headers.get('X-Sensor-Key') or request.query.get('sensor_key')
+        company_key = request.headers.get('X-Company-Key') or request.query.get('company_key')
+        if (sensor_key and sensor.key == sensor_key) or (company_key and sensor.company_key == company_key):
+            return sensor
+        raise web.HTTPForbidden(text=json.dumps({'message': 'Unauthorized access'}), content_type='application/json')
+
+    async def get_validator(self, sensor_type):
+        """Get the compiled validator of a sensor type, None if the type does not exist"""
+        validator = cached_validator(sensor_type)
+        if validator is not None:
+            return validator
+        row = await self.pool.fetchrow(SENSOR_TYPE_QUERY, sensor_type)
+        if row is None:
+            return None
+        value_fields = row['value_fields']
+        if isinstance(value_fields, str):
+            value_fields = json.loads(value_fields)
+        return cache_validator(ValueValidator(row['type'], value_fields))
+
+    async def update_state(self, sensor, data):
+        """
+        Update the state of a sensor, see `SensorStateBuffer.update`.
+
+        :return: SensorState before the update or None if the sensor does not exist
+        """
+        state = self._states.get(sensor.id)
+        pending = self._pending.pop(sensor.id, None)
+        if pending is not None:
+            data = {**pending[1], **data}
+        if config.SENSOR_STATE_BUFFER and state is not None and \
+                (data['last_update'] - state.last_update).total_seconds() < config.SENSOR_STATE_STALE_AFTER:
+            self._pending[sensor.id] = (sensor, data)
+            self._states[sensor.id] = state._replace(last_update=data['last_update'])
+            return state
+        row = await self.pool.fetchrow(UPDATE_STATE_QUERY, *_state_params(sensor.id, data))
+        if row is None:
+            return None
+        state = SensorState(*row[1:])
+        if config.SENSOR_STATE_BUFFER:
+            self._states[sensor.id] = state._replace(is_inactive=False, last_update=data['last_update'])
+        return state
+
+    async def last_update(self, sensor):
+        """
+        Time the newest state of a sensor was received, see `SensorStateBuffer.last_update`.
+
+        :return: Naive UTC datetime, None if the sensor has no state yet
+        """
+        pending = self._pending.get(sensor.id)
+        if pending is not None:
+            return pending[1]['last_update']
+        return await self.pool.fetchval(LAST_UPDATE_QUERY, sensor.id)
+
+    async def flush_states(self):
+        """Write all buffered sensor states with one statement"""
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = {}
+        columns = list(zip(*[_state_params(sensor_id, data) for sensor_id, (_, data) in pending.items()]))
+        try:
+            rows = await self.pool.fetch(UPDATE_STATES_QUERY, *columns)
+        except Exception as e:
+            _LOGGER.error('Dropped state of %d sensors: %s', len(pending), e)
+            return
+        for row in rows:
+            state = SensorState(*row[1:])
+            sensor, data = pending[row[0]]
+            if state.is_inactive:
+                await self.run_sync(process_sensor_alerts, sensor, None, backup_alert=True,
+                                    seconds=(data['last_update'] - state.last_update).total_seconds())
+            known = self._states.get(row[0])
+            if known is not None:
+                self._states[row[0]] = known._replace(config_updated=state.config_updated)
+
+    async def _flush_states(self):
+        while True:
+            await asyncio.sleep(config.SENSOR_STATE_FLUSH_INTERVAL)
+            await self.flush_states()
+
+    async def save_reading(self, sensor, args, ip):
+        """
+        Save a sensor reading, as `post_sensor_values` does.
+
+        :return: SensorState before the update or None if the reading was not saved
+        :raises InvalidValue: If a value can not be converted
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if not time_in_range(sensor.time_start, sensor.time_end, now.time()):
+            return None
+        validator = await self.get_validator(sensor.type)
+        if validator is None:
+            _LOGGER.error("Sensor type not found : %s", sensor.type)
+            return None
+        reading = validator.validate(args)
+        data = sensor_state_data(reading, reading_time(reading, now), now, ip)
+        state = await self.update_state(sensor, data)
+        if state is None:
+            return None
+        if state.is_inactive:
+            await self.run_sync(process_sensor_alerts, sensor, None, backup_alert=True,
+                                seconds=(now - state.last_update.replace(tzinfo=datetime.timezone.utc)).total_seconds())
+        tsdb_data = dict(reading.fields, time=data['value']['time'])
+        await self.run_sync(tsdb.add_point, sensor, tsdb_data)
+        await self.run_sync(process_sensor_alerts, sensor, tsdb_data)
+        await self.publish(sensor, data['value'])
+        return state
+
+    async def publish(self, sensor, value):
+        """Publish a saved value to the MQTT channel of the sensor"""
+        if not config.MQTT_BROKER_URL:
+            return
+        try:
+            await self.run_sync(publish_value, sensor.uid, value)
+        except Exception as e:
+            _LOGGER.error(e)
+
+    async def post_values(self, request):
+        sensor = await self.get_sensor(request)
+        args = dict(request.query)
+        if request.content_type == 'application/json':
+            try:
+                body = await request.json()
+            except ValueError:
+                body = None
+            if isinstance(body, dict):
+                args.update(body)
+        elif request.can_read_body:
+            args.update(await request.post())
+        files = sorted(name for name, value in args.items() if isinstance(value, web.FileField))
+        if files:
+            return web.json_response({'message': 'File fields are not supported: {}'.format(', '.join(files)),
+                                      'code': 422}, status=422)
+        key = dedup_key(sensor.uid, args, request.headers.get('X-Message-Id'))
+        if is_duplicate(key):
+            return web.json_response({"config": False})
+        try:
+            state = await self.save_reading(sensor, args, request.remote)
+        except InvalidValue as e:
+            return web.json_response({'message': {e.field: str(e)}}, status=400)
+        if state is not None:
+            remember(key)
+        return web.json_response({"config": bool(state and state.config_updated)})
+
+    async def post_bulk_values(self, request):
+        sensor = await self.get_sensor(request)
+        try:
+            readings = await request.json()
+        except ValueError:
+            readings = None
+        if not isinstance(readings, list):
+            return web.json_response({'message': 'Expected a list of readings', 'code': 422}, status=422)
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if not time_in_range(sensor.time_start, sensor.time_end, now.time()):
+            return web.json_response({"accepted": 0, "rejected": [], "config": False})
+        validator = await self.get_validator(sensor.type)
+        if validator is None:
+            return web.json_response({'message': 'Sensor type not found', 'code': 422}, status=422)
+        rows, rejected = validate_readings(validator, readings, now)
+        if not rows:
+            return web.json_response({"accepted": 0, "rejected": rejected, "config": False})
+
+        await self.run_sync(tsdb.add_points, sensor, [dict(row.fields, time=row.time.isoformat()) for row in rows])
+        latest = rows[-1]
+        last_update = await self.last_update(sensor)
+        if last_update is not None and latest.time.astimezone(datetime.timezone.utc).replace(tzinfo=None) <= last_update:
+            # History only, the sensor keeps its newer value, see `post_sensor_bulk_values`
+            return web.json_response({"accepted": len(rows), "rejected": rejected, "config": False})
+        data = sensor_state_data(latest, latest.time, now, request.remote)
+        state = await self.update_state(sensor, data)
+        if state is None:
+            return web.json_response({"accepted": len(rows), "rejected": rejected, "config": False})
+        if state.is_inactive:
+            await self.run_sync(process_sensor_alerts, sensor, None, backup_alert=True,
+                                seconds=(now - state.last_update.replace(tzinfo=datetime.timezone.utc)).total_seconds())
+        await self.run_sync(process_sensor_alerts, sensor, dict(latest.fields, time=data['value']['time']))
+        await self.publish(sensor, data['value'])
+        return web.json_response({"accepted": len(rows), "rejected": rejected, "config": bool(state.config_updated)})
+
+    async def get_configuration(self, request):
+        sensor = await self.get_sensor(request)
+        row = await self.pool.fetchrow(CONFIG_QUERY, sensor.id)
+        sensor_config, config_fields = row if row is not None else (None, None)
+        if isinstance(sensor_config, str):
+            sensor_config = json.loads(sensor_config)
+        if isinstance(config_fields, str):
+            config_fields = json.loads(config_fields)
+        if sensor_config:
+            return web.json_response(sensor_config)
+        if config_fields is not None:
+            return web.json_response({field['name']: field['default'] for field in config_fields.values()
+                                      if 'default' in field.keys()})
+        return web.json_response({})
@@ -4,56 +4,101 @@
 #
 # License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
 
-import json
-import datetime
-from flask import current_app
+import multiprocessing
+import signal
+import sys
+import time
 from snms.core.logger import Logger
-from snms.core.mqtt import mqtt, MQTT_LOG_DEBUG
+from snms.core.mqtt import mqtt
 from snms.core.mqtt.consumer import EmqpConsumer
+from snms.core.mqtt.paho_consumer import PahoConsumer
+from snms.core.mqtt.echo import amqp_url
 from snms.core.config import config
-from snms.modules.sensors.controllers import post_sensor_value_with_uid
+from snms.core.db import db
+from snms.utils.console import cformat
 
 _LOGGER = Logger.get(__name__)
 
-USE_RABBITMQ = True
 
-
-def mqtt_cmd(args):
-    if USE_RABBITMQ:
-        host = config.MQTT_BROKER_URL
-        username = config.MQTT_USERNAME
-        password = config.MQTT_PASSWORD
-        amqp_url = "amqp://{}:{}@{}:5672".format(username, password, host)
-        consumer = EmqpConsumer(amqp_url, mqtt.app)
+def _run_consumer(partition, prefetch, threads, batch_size, batch_wait):
+    if config.MQTT_CONSUMER_ENGINE == 'mqtt':
+        consumer = PahoConsumer(mqtt.app, partition=partition, prefetch=prefetch, threads=threads,
+                                batch_size=batch_size, batch_wait=batch_wait)
+    else:
+        consumer = EmqpConsumer(amqp_url(), mqtt.app, partition=partition, prefetch=prefetch, threads=threads,
+                                batch_size=batch_size, batch_wait=batch_wait)
+    try:
         consumer.run()
-        return
+    except KeyboardInterrupt:
+        consumer.stop()
+
+
+def _run_worker(*args):
+    # Connections inherited from the parent process must not be shared.
+    with mqtt.app.app_context():
+        db.engine.dispose()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    _run_consumer(*args)
+
+
+def _start_worker(partition, *args):
+    process = multiprocessing.Process(target=_run_worker, args=(partition,) + args,
+                                      name='snms-mqtt-{}'.format(partition))
+    process.start()
+    _LOGGER.info('Started worker %s for partition %s', process.pid, partition)
+    return process
+
+
+def run_workers(workers, partitions, partition_offset, *args):
+    """
+    Run one consumer process per partition and restart them if they exit.
+
+    :param workers: Number of consumer processes
+    :param partitions: Total number of partitions of all nodes
+    :param partition_offset: First partition consumed by this node
+    :param args: Prefetch, threads, batch size and batch wait of the consumers
+    """
+    if partition_offset + workers > partitions:
+        print(cformat('%{red!}Partitions {}-{} do not exist, there are {} partitions').format(
+            partition_offset, partition_offset + workers - 1, partitions))
+        sys.exit(1)
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    processes = {partition: _start_worker(partition, *args)
+                 for partition in range(partition_offset, partition_offset + workers)}
+    while not stopping:
+        time.sleep(1)
+        for partition, process in list(processes.items()):
+            if not process.is_alive() and not stopping:
+                _LOGGER.warning('Worker %s for partition %s exited with %s, restarting',
+                                process.pid, partition, process.exitcode)
+                processes[partition] = _start_worker(partition, *args)
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join()
+
+
+def mqtt_cmd(workers=1, partitions=None, partition_offset=0, prefetch=None, threads=None, batch_size=None,
+             batch_wait=None):
+    prefetch = prefetch or config.MQTT_CONSUMER_PREFETCH
+    threads = threads or config.MQTT_CONSUMER_THREADS
+    batch_size = config.MQTT_CONSUMER_BATCH_SIZE if batch_size is None else batch_size
+    batch_wait = batch_wait or config.MQTT_CONSUMER_BATCH_WAIT
+    if config.MQTT_CONSUMER_ENGINE not in ('rabbitmq', 'mqtt'):
+        print(cformat('%{red!}Unknown MQTT_CONSUMER_ENGINE: {}').format(config.MQTT_CONSUMER_ENGINE))
+        sys.exit(1)
+    if config.MQTT_CONSUMER_ENGINE == 'mqtt':
+        # Shared subscriptions split the load, there are no partitions.
+        partitions = None
+        partition_offset = 0
+    if workers > 1 or partitions:
+        run_workers(workers, partitions or workers, partition_offset, prefetch, threads, batch_size, batch_wait)
     else:
-        # mqtt.init_app(current_app)
-        _LOGGER.debug("Starting MQTT Command . . . . . .")
-        mqtt.subscribe('sensors/+/values')
-
-        @mqtt.on_log()
-        def handle_logging(client, userdata, level, buf):
-            if level >= MQTT_LOG_DEBUG:
-                _LOGGER.debug('MQTT: {}'.format(buf))
-
-        @mqtt.on_subscribe()
-        def on_subscribe(client, userdata, mid, granted_qos):
-            _LOGGER.debug("Subscribe Callback")
-            _LOGGER.debug(granted_qos)
-
-        @mqtt.on_message()
-        def handle_topic(client, userdata, message):
-            topic = message.topic
-            sensor_uid = topic.split("/")[1]
-            _LOGGER.debug("Sensor UID : {}".format(sensor_uid))
-            data = None
-            try:
-                data = json.loads(str(message.payload.decode('utf-8')))
-                _LOGGER.debug(data)
-                if 'fromServer' not in data.keys():
-                    post_sensor_value_with_uid(sensor_uid, data, datetime.datetime.now(datetime.timezone.utc), from_mqtt=True)
-            except Exception as e:
-                _LOGGER.error(e)
-
-        mqtt.client.loop_forever()
\ No newline at end of file
+        _run_consumer(None, prefetch, threads, batch_size, batch_wait)
@@ -9,17 +9,133 @@ import pika
 from snms.core.logger import Logger
 import json
 import datetime
+import time
 from snms.modules.sensors import Sensor
-from snms.modules.sensors.controllers import post_sensor_value_with_uid, post_sensor_value_with_hid
-from tornado import gen
-from concurrent.futures import ThreadPoolExecutor
+from snms.modules.sensors.controllers import post_sensor_value_with_uid, post_sensor_value_with_hid, \
+    post_sensor_values_batch
+from snms.modules.sensors.dedup import dedup_key, is_duplicate, remember
+from snms.modules.sensors.identity import sensor_identities
+from snms.core.config import config
+from snms.modules.sensors import codecs
+from snms.core.mqtt.echo import ORIGIN_HEADER, ORIGIN_SERVER
+from snms.core.mqtt.dispatcher import Dispatcher, QueueFull
 
 LOGGER = Logger.get(__name__)
 
-executor = ThreadPoolExecutor(8)
 
+class ValueProcessor(object):
+    """Decoding and saving of sensor values, shared by the AMQP and the MQTT
+    consumers. Topics are given in the form of AMQP routing keys, e.g.
+    ``sensors.<uid>.values``.
 
-class EmqpConsumer(object):
+    """
+    app = None
+
+    def message_class(self, topic):
+        """Tenant and priority of a message. Only cached sensor identities
+        are used; the first message of a sensor has no tenant.
+
+        :return: Tuple of company uid and whether the sensor type is one of
+                 MQTT_PRIORITY_SENSOR_TYPES
+
+        """
+        parts = topic.split(".")
+        if parts[0] == 'sensors':
+            identity = sensor_identities.peek(('uid', parts[1]))
+        else:
+            identity = sensor_identities.peek(('hid', None, parts[1]))
+        if identity is None:
+            return None, False
+        return identity.company_uid, identity.type in config.MQTT_PRIORITY_SENSOR_TYPES
+
+    @staticmethod
+    def message_codec(topic, content_type=None):
+        """Codec of a message, None if it is not supported"""
+        parts = topic.split(".")
+        return codecs.get_codec(parts[3] if len(parts) > 3 else None, content_type)
+
+    def decode_message(self, topic, body, content_type=None):
+        """Decode a message into the reading passed to post_sensor_values_batch.
+        Binary payloads are left to be decoded once the sensor type is known.
+
+        :return: Tuple of id type, sensor uid or hid, reading and codec, or
+                 None if the message is to be dropped
+
+        """
+        parts = topic.split(".")
+        sensor_id_type = parts[0]
+        sensor_uid = parts[1]
+        codec = self.message_codec(topic, content_type)
+        if codec is None:
+            LOGGER.error('Unsupported payload format of %s', topic)
+            return None
+        if codec != codecs.JSON:
+            return sensor_id_type, sensor_uid, body, codec
+        try:
+            body = str(body.decode('utf-8'))
+            data = json.loads(body)
+        except Exception as e:
+            LOGGER.error(e)
+            return None
+        LOGGER.info(data)
+        if 'fromServer' in data.keys():
+            return None
+        return sensor_id_type, sensor_uid, data, None
+
+    def process_message(self, topic, body, tag, content_type=None, key=None):
+        """Save the value of a message. Its dedup key is remembered once
+        the value is saved.
+
+        """
+        message = self.decode_message(topic, body, content_type)
+        if message is None:
+            return tag
+        sensor_id_type, sensor_uid, data, codec = message
+        LOGGER.debug(data)
+        state = None
+        try:
+            with self.app.app_context():
+                if sensor_id_type == 'sensors':
+                    state = post_sensor_value_with_uid(sensor_uid, data, datetime.datetime.now(datetime.timezone.utc), from_mqtt=True, codec=codec)
+                elif sensor_id_type == 'sensors_hid':
+                    state = post_sensor_value_with_hid(sensor_uid, data, datetime.datetime.now(datetime.timezone.utc), from_mqtt=True, codec=codec)
+        except Exception as e:
+            LOGGER.error(e)
+        if state is not None:
+            remember(key)
+        return tag
+
+    def process_batch(self, batch):
+        """Save the values of a batch of messages in one database session.
+        Messages which can not be decoded are dropped on their own. The
+        dedup keys of the messages are remembered once the batch is saved.
+
+        :return: True if the batch was saved, False if it is to be retried
+
+        """
+        readings = []
+        for topic, body, tag, content_type, key in batch:
+            try:
+                message = self.decode_message(topic, body, content_type)
+            except Exception as e:
+                LOGGER.error(e)
+                continue
+            if message is not None:
+                readings.append(message)
+        if readings:
+            try:
+                with self.app.app_context():
+                    count = post_sensor_values_batch(readings)
+                LOGGER.info('Saved %d of %d values', count, len(batch))
+            except Exception as e:
+                LOGGER.error(e)
+                return False
+        for item in batch:
+            remember(item[4])
+        return True
+
+
+class EmqpConsumer(ValueProcessor):
     """This is an consumer that will handle unexpected interactions
     with RabbitMQ such as channel and connection closures.
 
@@ -31,18 +147,57 @@ class EmqpConsumer(object):
     If the channel is closed, it will indicate a problem with one of the
     commands that were issued and that should surface in the output as well.
 
+    Sensor values are routed from the MQTT exchange to the queue through
+    the FILTER_EXCHANGE headers exchange. Values republished by the server
+    carry the ORIGIN_HEADER header and are routed to ECHO_EXCHANGE, which
+    has no bindings and drops them; all other values fall through to
+    INGEST_EXCHANGE, its alternate exchange, and reach the queue.
+
+    With a `partition`, the consumer reads from one of the queues bound to
+    HASH_EXCHANGE, a consistent-hash exchange which distributes the values
+    by routing key, i.e. by sensor, so that the values of a sensor are
+    always consumed by the same worker. It requires the
+    rabbitmq_consistent_hash_exchange plugin.
+
+    Messages are processed by a Dispatcher with `threads` worker threads
+    and at most `prefetch` pending messages; the values of each sensor are
+    processed in order, companies take turns and sensors of the
+    MQTT_PRIORITY_SENSOR_TYPES go first. Companies only take turns among
+    the `prefetch` messages received, see Dispatcher. With a `batch_size`,
+    messages are instead collected into batches which are processed one
+    after the other, in order of delivery, each saved in one database
+    session and acknowledged at once; batches are not scheduled by company.
+
     """
     EXCHANGE = 'amq.topic'
     EXCHANGE_TYPE = 'topic'
+    FILTER_EXCHANGE = 'snms.ingest.filter'
+    INGEST_EXCHANGE = 'snms.ingest'
+    ECHO_EXCHANGE = 'snms.echo'
+    HASH_EXCHANGE = 'snms.ingest.hash'
     QUEUE = 'mqtt_consumer_master'
+    PARTITION_QUEUE = 'mqtt_consumer_{}'
     ROUTING_KEY = 'sensors.*.values'
     ROUTING_KEY_HID = 'sensors_hid.*.values'
-
-    def __init__(self, amqp_url, app=None):
+    # Binary payloads, e.g. sensors/<uid>/values/msgpack
+    ROUTING_KEY_CODEC = 'sensors.*.values.*'
+    ROUTING_KEY_HID_CODEC = 'sensors_hid.*.values.*'
+    # Seconds between two log entries of the dispatcher counters
+    STATS_INTERVAL = 60
+    # Seconds to wait for pending messages on stop
+    DRAIN_TIMEOUT = 30
+    BATCH_LANE = 'batch'
+
+    def __init__(self, amqp_url, app=None, partition=None, prefetch=100, threads=8, batch_size=0, batch_wait=50):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
         :param str amqp_url: The AMQP url to connect with
+        :param int partition: Partition queue to consume, the master queue if None
+        :param int prefetch: Number of unacknowledged messages to receive
+        :param int threads: Number of messages processed at once
+        :param int batch_size: Messages processed as one batch, 0 to process them one by one
+        :param int batch_wait: Milliseconds to wait for a batch to fill up
 
         """
         self._connection = None
@@ -51,6 +206,24 @@ class EmqpConsumer(object):
         self._consumer_tag = None
         self._url = amqp_url
         self.app = app
+        self._partition = partition
+        self._queue = self.QUEUE if partition is None else self.PARTITION_QUEUE.format(partition)
+        self._prefetch = prefetch
+        self._dispatcher = Dispatcher(self.schedule, threads=threads, max_size=prefetch,
+                                      weights=config.MQTT_TENANT_WEIGHTS)
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        self._batch = []
+        self._batch_timeout = None
+
+    @property
+    def dispatcher(self):
+        """The Dispatcher processing the messages, see Dispatcher.stats"""
+        return self._dispatcher
+
+    def schedule(self, callback, *args):
+        """Run a callback on the IOLoop; may be called from any thread."""
+        self._connection.ioloop.add_callback(callback, *args)
 
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
@@ -162,12 +335,14 @@ class EmqpConsumer(object):
         """
         LOGGER.info('Channel opened')
         self._channel = channel
+        # Unacknowledged messages of the previous channel are redelivered.
+        self._batch = []
         self.add_on_channel_close_callback()
         self.setup_exchange(self.EXCHANGE)
 
     def set_qos(self):
         LOGGER.info("Setting QOS")
-        self._channel.basic_qos(prefetch_count=10)
+        self._channel.basic_qos(prefetch_count=self._prefetch)
 
     def setup_exchange(self, exchange_name):
         """Setup the exchange on RabbitMQ by invoking the Exchange.Declare RPC
@@ -190,7 +365,51 @@ class EmqpConsumer(object):
 
         """
         LOGGER.info('Exchange declared')
-        self.setup_queue(self.QUEUE)
+        self.setup_filter()
+
+    def setup_filter(self):
+        """Declare the exchanges which keep server echoes out of the queue
+        and bind them to the MQTT exchange. Calls are queued by pika and
+        sent one after the other; setup_queue is invoked when the last one
+        has completed.
+
+        """
+        LOGGER.info('Declaring exchanges %s, %s and %s',
+                    self.FILTER_EXCHANGE, self.INGEST_EXCHANGE, self.ECHO_EXCHANGE)
+        self._channel.exchange_declare(None, self.INGEST_EXCHANGE, 'fanout', durable=True)
+        self._channel.exchange_declare(None, self.ECHO_EXCHANGE, 'fanout', durable=True)
+        self._channel.exchange_declare(None, self.FILTER_EXCHANGE, 'headers', durable=True,
+                                       arguments={'alternate-exchange': self.INGEST_EXCHANGE})
+        self._channel.exchange_bind(None, self.ECHO_EXCHANGE, self.FILTER_EXCHANGE,
+                                    arguments={'x-match': 'all', ORIGIN_HEADER: ORIGIN_SERVER})
+        self._channel.exchange_bind(None, self.FILTER_EXCHANGE, self.EXCHANGE, self.ROUTING_KEY_HID)
+        self._channel.exchange_bind(None, self.FILTER_EXCHANGE, self.EXCHANGE, self.ROUTING_KEY_CODEC)
+        self._channel.exchange_bind(None, self.FILTER_EXCHANGE, self.EXCHANGE, self.ROUTING_KEY_HID_CODEC)
+        self._channel.exchange_bind(self.on_filter_bindok, self.FILTER_EXCHANGE,
+                                    self.EXCHANGE, self.ROUTING_KEY)
+
+    def on_filter_bindok(self, unused_frame):
+        """Invoked by pika when the filter exchange has been bound.
+
+        :param pika.frame.Method unused_frame: Exchange.BindOk response frame
+
+        """
+        LOGGER.info('Filter exchange bound')
+        if self._partition is not None:
+            self.setup_partitions()
+        self.setup_queue(self._queue)
+
+    def setup_partitions(self):
+        """Route the values through the consistent-hash exchange instead of
+        the master queue.
+
+        """
+        LOGGER.info('Declaring exchange %s', self.HASH_EXCHANGE)
+        self._channel.exchange_declare(None, self.HASH_EXCHANGE, 'x-consistent-hash', durable=True)
+        self._channel.exchange_bind(None, self.HASH_EXCHANGE, self.INGEST_EXCHANGE)
+        # The master queue would keep receiving a copy of every value.
+        self._channel.queue_declare(None, self.QUEUE, auto_delete=False, arguments={"x-message-ttl": 600000})
+        self._channel.queue_unbind(None, self.QUEUE, self.INGEST_EXCHANGE, '')
 
     def setup_queue(self, queue_name):
         """Setup the queue on RabbitMQ by invoking the Queue.Declare RPC
@@ -213,12 +432,17 @@ class EmqpConsumer(object):
         :param pika.frame.Method method_frame: The Queue.DeclareOk frame
 
         """
-        LOGGER.info('Binding %s to %s with %s',
-                    self.EXCHANGE, self.QUEUE, self.ROUTING_KEY)
-        self._channel.queue_bind(self.on_bindok, self.QUEUE,
-                                 self.EXCHANGE, self.ROUTING_KEY)
-        self._channel.queue_bind(None, self.QUEUE,
-                                 self.EXCHANGE, self.ROUTING_KEY_HID)
+        # Queues declared by earlier versions are bound to the MQTT exchange
+        # directly, which would deliver every value twice.
+        self._channel.queue_unbind(None, self._queue, self.EXCHANGE, self.ROUTING_KEY)
+        self._channel.queue_unbind(None, self._queue, self.EXCHANGE, self.ROUTING_KEY_HID)
+        if self._partition is None:
+            LOGGER.info('Binding %s to %s', self.INGEST_EXCHANGE, self._queue)
+            self._channel.queue_bind(self.on_bindok, self._queue, self.INGEST_EXCHANGE, '')
+        else:
+            # The routing key of a consistent-hash binding is its weight.
+            LOGGER.info('Binding %s to %s', self.HASH_EXCHANGE, self._queue)
+            self._channel.queue_bind(self.on_bindok, self._queue, self.HASH_EXCHANGE, '1')
 
     def add_on_cancel_callback(self):
         """Add a callback that will be invoked if RabbitMQ cancels the consumer
@@ -241,15 +465,22 @@ class EmqpConsumer(object):
         if self._channel:
             self._channel.close()
 
-    def acknowledge_message(self, delivery_tag):
+    def acknowledge_message(self, delivery_tag, channel=None, multiple=False):
         """Acknowledge the message delivery from RabbitMQ by sending a
-        Basic.Ack RPC method for the delivery tag.
+        Basic.Ack RPC method for the delivery tag. Must be called on the
+        IOLoop; tags of a channel which has been closed in the meantime are
+        dropped, the broker redelivers those messages.
 
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param pika.channel.Channel channel: The channel of the delivery
+        :param bool multiple: Acknowledge all messages up to delivery_tag
 
         """
         # LOGGER.info('Acknowledging message %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        if channel is not None and channel is not self._channel:
+            return
+        if self._channel is not None and self._channel.is_open:
+            self._channel.basic_ack(delivery_tag, multiple=multiple)
 
     def on_message(self, unused_channel, basic_deliver, properties, body):
         """Invoked by pika when a message is delivered from RabbitMQ. The
@@ -267,47 +498,114 @@ class EmqpConsumer(object):
         """
         LOGGER.info('Received message # %s from %s: %s',
                     basic_deliver.delivery_tag, properties.app_id, body)
+        if properties.headers and properties.headers.get(ORIGIN_HEADER) == ORIGIN_SERVER:
+            self.acknowledge_message(basic_deliver.delivery_tag)
+            return
+        topic = basic_deliver.routing_key
+        sensor_ref = topic.split(".")[1] if topic.startswith("sensors.") else topic
+        key = dedup_key(sensor_ref, body, properties.message_id, self.message_codec(topic, properties.content_type))
+        if is_duplicate(key):
+            LOGGER.debug('Duplicate message # %s', basic_deliver.delivery_tag)
+            self.acknowledge_message(basic_deliver.delivery_tag)
+            return
+        if self._batch_size:
+            self.add_to_batch(basic_deliver.routing_key, body, basic_deliver.delivery_tag, properties.content_type, key)
+            return
         try:
             # self.process_message(basic_deliver.routing_key, body)
-            self.save_values(basic_deliver.routing_key, body, basic_deliver.delivery_tag)
+            self.save_values(basic_deliver.routing_key, body, basic_deliver.delivery_tag, properties.content_type, key)
             # self.acknowledge_message(basic_deliver.delivery_tag)
         except Exception as e:
             LOGGER.error(e)
 
-    def process_message(self, topic, body, tag):
+    def add_to_batch(self, topic, body, tag, content_type=None, key=None):
+        """Collect a message into the current batch, which is processed once
+        it has batch_size messages or is batch_wait milliseconds old.
+
+        """
+        self._batch.append((topic, body, tag, content_type, key))
+        if len(self._batch) >= self._batch_size:
+            self.dispatch_batch()
+        elif self._batch_timeout is None:
+            self._batch_timeout = self._connection.add_timeout(self._batch_wait / 1000.0, self.dispatch_batch)
+
+    def dispatch_batch(self):
+        """Hand the current batch to the dispatcher. Batches share one lane
+        and are processed one after the other, in the order of delivery.
+        A saved batch is acknowledged at once; the messages of a batch
+        which could not be saved are rejected and requeued, to be retried
+        until they expire from the queue.
+
+        """
+        if self._batch_timeout is not None:
+            self._connection.remove_timeout(self._batch_timeout)
+            self._batch_timeout = None
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        channel = self._channel
+        last_tag = batch[-1][2]
         try:
-            body = str(body.decode('utf-8'))
-            data = json.loads(body)
-        except Exception as e:
-            LOGGER.error(e)
-            return tag
-        LOGGER.info(data)
-        sensor_uid = topic.split(".")[1]
-        sensor_id_type = topic.split(".")[0]
-        if 'fromServer' not in data.keys():
-            LOGGER.debug(data)
-            try:
-                with self.app.app_context():
-                    if sensor_id_type == 'sensors':
-                        post_sensor_value_with_uid(sensor_uid, data, datetime.datetime.now(datetime.timezone.utc), from_mqtt=True)
-                    elif sensor_id_type == 'sensors_hid':
-                        post_sensor_value_with_hid(sensor_uid, data, datetime.datetime.now(datetime.timezone.utc), from_mqtt=True)
-            except Exception as e:
-                LOGGER.error(e)
-        return tag
+            self._dispatcher.submit(self.BATCH_LANE, self.process_batch, (batch,),
+                                    lambda result: self.settle_batch(result, last_tag, channel))
+        except QueueFull:
+            LOGGER.warning('Dispatcher is full, requeueing %d messages', len(batch))
+            channel.basic_nack(last_tag, multiple=True, requeue=True)
 
-    @gen.coroutine
-    def save_values(self, topic, body, tag):
-        LOGGER.info("Running Coroutine")
-        feature = executor.submit(self.process_message, topic, body, tag)
-        feature.add_done_callback(self.on_done)
-        # LOGGER.info(feature.result())
+    def settle_batch(self, saved, delivery_tag, channel):
+        """Acknowledge a processed batch, or reject and requeue its messages
+        if it was not saved. Must be called on the IOLoop.
 
-    def on_done(self, feature):
-        LOGGER.info(feature.result())
-        tag = feature.result()
-        if tag:
-            self.acknowledge_message(tag)
+        :param bool saved: Result of process_batch, None if it raised
+        :param int delivery_tag: Delivery tag of the last message of the batch
+        :param pika.channel.Channel channel: The channel of the deliveries
+
+        """
+        if saved:
+            self.acknowledge_message(delivery_tag, channel, multiple=True)
+            return
+        if channel is not self._channel or self._channel is None or not self._channel.is_open:
+            return
+        LOGGER.warning('Batch was not saved, requeueing messages up to # %s', delivery_tag)
+        self._channel.basic_nack(delivery_tag, multiple=True, requeue=True)
+
+    def save_values(self, topic, body, tag, content_type=None, key=None):
+        """Queue a message in the lane of its sensor, scheduled by company.
+        It is acknowledged on the IOLoop once processed.
+
+        """
+        channel = self._channel
+        sensor_ref = '.'.join(topic.split('.')[:2])
+        tenant, priority = self.message_class(topic)
+        try:
+            self._dispatcher.submit(sensor_ref, self.process_message, (topic, body, tag, content_type, key),
+                                    lambda result: self.acknowledge_message(tag, channel),
+                                    tenant=tenant, priority=priority)
+        except QueueFull:
+            LOGGER.warning('Dispatcher is full, requeueing message # %s', tag)
+            channel.basic_nack(tag, requeue=True)
+
+    def log_stats(self):
+        """Log the dispatcher counters every STATS_INTERVAL seconds."""
+        LOGGER.info('Dispatcher: %s', self._dispatcher.stats())
+        if not self._closing:
+            self._connection.add_timeout(self.STATS_INTERVAL, self.log_stats)
+
+    def drain(self, callback, deadline=None):
+        """Wait on the IOLoop until all pending messages are processed and
+        acknowledged, at most DRAIN_TIMEOUT seconds, then invoke callback.
+
+        """
+        if deadline is None:
+            self.dispatch_batch()
+            deadline = time.monotonic() + self.DRAIN_TIMEOUT
+            LOGGER.info('Draining %d pending messages', self._dispatcher.pending)
+        if self._dispatcher.idle or time.monotonic() > deadline:
+            if not self._dispatcher.idle:
+                LOGGER.warning('%d messages are still pending', self._dispatcher.pending)
+            callback()
+            return
+        self._connection.add_timeout(0.1, lambda: self.drain(callback, deadline))
 
     def on_cancelok(self, unused_frame):
         """This method is invoked by pika when RabbitMQ acknowledges the
@@ -319,7 +617,7 @@ class EmqpConsumer(object):
 
         """
         LOGGER.info('RabbitMQ acknowledged the cancellation of the consumer')
-        self.close_channel()
+        self.drain(self.close_channel)
 
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
@@ -342,8 +640,11 @@ class EmqpConsumer(object):
         """
         LOGGER.info('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
+        # A partition is consumed by a single worker to keep its values in
+        # order; other workers for it wait for the channel to be reopened.
         self._consumer_tag = self._channel.basic_consume(self.on_message,
-                                                         self.QUEUE)
+                                                         self._queue,
+                                                         exclusive=self._partition is not None)
 
     def on_bindok(self, unused_frame):
         """Invoked by pika when the Queue.Bind method has completed. At this
@@ -380,6 +681,7 @@ class EmqpConsumer(object):
 
         """
         self._connection = self.connect()
+        self._connection.add_timeout(self.STATS_INTERVAL, self.log_stats)
         self._connection.ioloop.start()
 
     def stop(self):
@@ -397,4 +699,5 @@ class EmqpConsumer(object):
         self._closing = True
         self.stop_consuming()
         self._connection.ioloop.start()
+        self._dispatcher.close()
         LOGGER.info('Stopped')
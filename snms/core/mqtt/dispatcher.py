@@ -0,0 +1,240 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Work dispatcher of the MQTT consumer.
+
+Messages are processed by a pool of worker threads. Messages with the same
+key, i.e. of the same sensor, form a lane and are processed one after the
+other, in the order they were submitted; different lanes are processed
+concurrently. Completion callbacks are run through a `schedule` function,
+e.g. on the IOLoop thread where pika may be used.
+
+Ready lanes are picked fairly by tenant, i.e. by company: tenants take
+turns, each taking up to its weight in messages per turn, so that a tenant
+with many messages does not hold back the others. Priority lanes are
+always picked first.
+
+Fairness is bounded by the window of messages the dispatcher holds, at
+most `max_size`, i.e. the prefetch of the consumer: messages still in the
+broker queue are delivered in its order, so a tenant whose messages are
+behind a burst of another one only gets its turn once they are inside the
+window. The window has to be well above the number of threads for
+several tenants to queue at once.
+"""
+
+import threading
+import time
+from collections import deque
+
+from snms.core.logger import Logger
+
+_LOGGER = Logger.get(__name__)
+
+
+class QueueFull(Exception):
+    """The dispatcher already holds `max_size` messages"""
+
+
+class _Lane(object):
+    __slots__ = ('tasks', 'tenant', 'priority')
+
+    def __init__(self, tenant, priority):
+        self.tasks = deque()
+        self.tenant = tenant
+        self.priority = priority
+
+
+class Dispatcher(object):
+    """
+    Bounded work queue with serial per-key lanes.
+
+    :param schedule: Thread-safe function running a callback, e.g.
+                     ``IOLoop.add_callback`` to run it on the IOLoop
+    :param threads: Number of worker threads
+    :param max_size: Maximum number of submitted and unfinished messages,
+                     usually the prefetch count of the channel
+    :param weights: Dict of tenants and the number of messages they may
+                    take per turn, 1 for other tenants
+    """
+
+    def __init__(self, schedule, threads=8, max_size=10, weights=None):
+        self.schedule = schedule
+        self.threads = threads
+        self.max_size = max_size
+        self.weights = weights or {}
+        self._lanes = {}
+        # Ready lanes of each tenant and the tenants in turn order
+        self._tenants = {}
+        self._turns = deque()
+        self._taken = 0
+        self._priority = deque()
+        self._depth = {}
+        self._cond = threading.Condition()
+        self._workers = []
+        self._closed = False
+        # Counters; pending includes messages whose callback has not run yet.
+        self.pending = 0
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.wait_total = 0.0
+
+    def submit(self, key, func, args=(), callback=None, timeout=0, tenant=None, priority=False):
+        """
+        Queue a message.
+
+        Runs ``func(*args)`` on a worker thread once all earlier messages
+        with the same key are done, then schedules ``callback(result)``.
+        The result is None if `func` raised an exception.
+
+        The tenant and priority of a lane are those of the message which
+        opened it.
+
+        :param timeout: Seconds to wait for room in the queue
+        :param tenant: Tenant of the message, e.g. the company uid
+        :param priority: Process the message before all others
+        :raises QueueFull: If `max_size` messages are still pending
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Dispatcher is closed')
+            if self.pending >= self.max_size and timeout:
+                self._cond.wait_for(lambda: self.pending < self.max_size, timeout)
+            if self.pending >= self.max_size:
+                raise QueueFull()
+            self.pending += 1
+            task = (func, args, callback, time.monotonic())
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = _Lane(tenant, priority)
+                lane.tasks.append(task)
+                self._push(key, lane)
+                self._cond.notify_all()
+            else:
+                lane.tasks.append(task)
+            self._depth[lane.tenant] = self._depth.get(lane.tenant, 0) + 1
+            self._ensure_workers()
+
+    def stats(self):
+        """Counters of the dispatcher"""
+        with self._cond:
+            done = self.processed + self.failed
+            return {
+                'depth': self.pending - self.in_flight,
+                'in_flight': self.in_flight,
+                'pending': self.pending,
+                'lanes': len(self._lanes),
+                'processed': self.processed,
+                'failed': self.failed,
+                'latency_avg': self.latency_total / done if done else 0.0,
+                'latency_max': self.latency_max,
+                'wait_avg': self.wait_total / done if done else 0.0,
+                'tenants': dict(self._depth),
+            }
+
+    @property
+    def idle(self):
+        """True if all messages are done and their callbacks have run"""
+        return self.pending == 0
+
+    def close(self):
+        """Stop the worker threads once all queued messages are processed"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            workers = self._workers
+        for worker in workers:
+            worker.join()
+
+    def _push(self, key, lane):
+        """Mark a lane as ready"""
+        if lane.priority:
+            self._priority.append(key)
+            return
+        ready = self._tenants.get(lane.tenant)
+        if ready is None:
+            ready = self._tenants[lane.tenant] = deque()
+            self._turns.append(lane.tenant)
+        ready.append(key)
+
+    def _pop(self):
+        """Take the next ready lane, weighted round-robin by tenant"""
+        if self._priority:
+            return self._priority.popleft()
+        tenant = self._turns[0]
+        ready = self._tenants[tenant]
+        key = ready.popleft()
+        self._taken += 1
+        if not ready:
+            del self._tenants[tenant]
+            self._turns.popleft()
+            self._taken = 0
+        elif self._taken >= self.weights.get(tenant, 1):
+            self._turns.rotate(-1)
+            self._taken = 0
+        return key
+
+    def _ensure_workers(self):
+        if self._workers:
+            return
+        for i in range(max(self.threads, 1)):
+            worker = threading.Thread(target=self._run, name='mqtt-dispatcher-{}'.format(i), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._priority or self._turns) and not (self._closed and not self._lanes):
+                    self._cond.wait()
+                if not (self._priority or self._turns):
+                    return
+                key = self._pop()
+                lane = self._lanes[key]
+                func, args, callback, queued = lane.tasks[0]
+                self.in_flight += 1
+                self._depth[lane.tenant] -= 1
+                if not self._depth[lane.tenant]:
+                    del self._depth[lane.tenant]
+            started = time.monotonic()
+            result = None
+            failed = False
+            try:
+                result = func(*args)
+            except Exception as e:
+                _LOGGER.error(e)
+                failed = True
+            finished = time.monotonic()
+            with self._cond:
+                self.in_flight -= 1
+                if failed:
+                    self.failed += 1
+                else:
+                    self.processed += 1
+                self.latency_total += finished - started
+                self.latency_max = max(self.latency_max, finished - started)
+                self.wait_total += started - queued
+                lane.tasks.popleft()
+                if lane.tasks:
+                    self._push(key, lane)
+                else:
+                    del self._lanes[key]
+                # Idle workers wait for a ready lane, or for the last lane
+                # to be done once the dispatcher is closed
+                self._cond.notify_all()
+            self.schedule(self._done, callback, result)
+
+    def _done(self, callback, result):
+        try:
+            if callback is not None:
+                callback(result)
+        finally:
+            with self._cond:
+                self.pending -= 1
+                self._cond.notify_all()
@@ -0,0 +1,188 @@
+import threading
+import time
+
+import pytest
+
+from snms.core.mqtt.dispatcher import Dispatcher, QueueFull
+
+
+def _run(callback, *args):
+    callback(*args)
+
+
+def _wait_busy(dispatcher, timeout=5):
+    deadline = time.monotonic() + timeout
+    while dispatcher.stats()['in_flight'] == 0:
+        assert time.monotonic() < deadline, 'dispatcher did not start'
+        time.sleep(0.01)
+
+
+def _wait_idle(dispatcher, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not dispatcher.idle:
+        assert time.monotonic() < deadline, 'dispatcher did not finish'
+        time.sleep(0.01)
+
+
+def test_lane_is_serial_and_ordered():
+    dispatcher = Dispatcher(_run, threads=4, max_size=100)
+    done = []
+    running = []
+    overlaps = []
+
+    def work(key, i):
+        running.append(key)
+        if running.count(key) > 1:
+            overlaps.append(key)
+        time.sleep(0.001)
+        done.append((key, i))
+        running.remove(key)
+        return i
+
+    for i in range(20):
+        for key in 'ab':
+            dispatcher.submit(key, work, (key, i))
+    _wait_idle(dispatcher)
+    dispatcher.close()
+    assert overlaps == []
+    for key in 'ab':
+        assert [i for k, i in done if k == key] == list(range(20))
+
+
+def test_lanes_run_concurrently():
+    dispatcher = Dispatcher(_run, threads=2, max_size=10)
+    barrier = threading.Barrier(2, timeout=5)
+    results = []
+    for key in 'ab':
+        dispatcher.submit(key, barrier.wait, callback=lambda result: results.append(result is not None))
+    _wait_idle(dispatcher)
+    dispatcher.close()
+    assert results == [True, True]
+
+
+def test_callback_gets_result():
+    dispatcher = Dispatcher(_run, threads=1)
+    results = []
+
+    def fail():
+        raise ValueError('invalid')
+
+    dispatcher.submit('a', lambda: 42, callback=results.append)
+    dispatcher.submit('a', fail, callback=results.append)
+    _wait_idle(dispatcher)
+    dispatcher.close()
+    assert results == [42, None]
+    stats = dispatcher.stats()
+    assert (stats['processed'], stats['failed'], stats['pending']) == (1, 1, 0)
+
+
+def test_queue_full():
+    dispatcher = Dispatcher(_run, threads=1, max_size=2)
+    release = threading.Event()
+    dispatcher.submit('a', release.wait, (5,))
+    dispatcher.submit('b', lambda: None)
+    with pytest.raises(QueueFull):
+        dispatcher.submit('c', lambda: None)
+    started = time.monotonic()
+    with pytest.raises(QueueFull):
+        dispatcher.submit('c', lambda: None, timeout=0.05)
+    assert time.monotonic() - started >= 0.05
+    release.set()
+    dispatcher.submit('c', lambda: None, timeout=5)
+    _wait_idle(dispatcher)
+    dispatcher.close()
+    assert dispatcher.stats()['processed'] == 3
+
+
+def test_pending_until_callback_ran():
+    scheduled = []
+    dispatcher = Dispatcher(lambda callback, *args: scheduled.append((callback, args)), threads=1, max_size=1)
+    dispatcher.submit('a', lambda: 1)
+    deadline = time.monotonic() + 5
+    while not scheduled:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    # Processed, but the callback has not run on the scheduler yet
+    assert not dispatcher.idle
+    with pytest.raises(QueueFull):
+        dispatcher.submit('b', lambda: 2)
+    callback, args = scheduled.pop()
+    callback(*args)
+    assert dispatcher.idle
+    dispatcher.close()
+
+
+def test_close():
+    dispatcher = Dispatcher(_run, threads=2)
+    done = []
+    for i in range(5):
+        dispatcher.submit('a', done.append, (i,))
+    dispatcher.close()
+    assert done == list(range(5))
+    with pytest.raises(RuntimeError):
+        dispatcher.submit('a', done.append, (5,))
+
+
+def _order(dispatcher, messages, threads=1):
+    """Keys in the order they are processed, queued while the worker is busy"""
+    release = threading.Event()
+    order = []
+    dispatcher.submit('blocker', release.wait, (5,))
+    _wait_busy(dispatcher)
+    for key, tenant, priority in messages:
+        dispatcher.submit(key, order.append, (key,), tenant=tenant, priority=priority)
+    release.set()
+    _wait_idle(dispatcher)
+    dispatcher.close()
+    return order
+
+
+def test_tenants_take_turns():
+    dispatcher = Dispatcher(_run, threads=1, max_size=100)
+    messages = [('a{}'.format(i), 'a', False) for i in range(4)] + [('b{}'.format(i), 'b', False) for i in range(2)]
+    assert _order(dispatcher, messages) == ['a0', 'b0', 'a1', 'b1', 'a2', 'a3']
+
+
+def test_tenant_weights():
+    dispatcher = Dispatcher(_run, threads=1, max_size=100, weights={'a': 2})
+    messages = [('a{}'.format(i), 'a', False) for i in range(4)] + [('b{}'.format(i), 'b', False) for i in range(3)]
+    assert _order(dispatcher, messages) == ['a0', 'a1', 'b0', 'a2', 'a3', 'b1', 'b2']
+
+
+def test_priority_first():
+    dispatcher = Dispatcher(_run, threads=1, max_size=100)
+    messages = [('a0', 'a', False), ('b0', 'b', False), ('p0', 'b', True), ('a1', 'a', False), ('p1', 'a', True)]
+    assert _order(dispatcher, messages) == ['p0', 'p1', 'a0', 'b0', 'a1']
+
+
+def test_lane_keeps_tenant_of_first_message():
+    dispatcher = Dispatcher(_run, threads=1, max_size=100)
+    messages = [('s', None, False), ('t', 'a', False), ('s', 'b', True)]
+    assert _order(dispatcher, messages) == ['s', 't', 's']
+
+
+def test_depth_per_tenant():
+    dispatcher = Dispatcher(_run, threads=1, max_size=100)
+    release = threading.Event()
+    dispatcher.submit('blocker', release.wait, (5,), tenant='x')
+    for i in range(3):
+        dispatcher.submit('a{}'.format(i), lambda: None, tenant='a')
+    dispatcher.submit('b', lambda: None, tenant='b')
+    _wait_busy(dispatcher)
+    assert dispatcher.stats()['tenants'] == {'a': 3, 'b': 1}
+    release.set()
+    _wait_idle(dispatcher)
+    dispatcher.close()
+    assert dispatcher.stats()['tenants'] == {}
+
+
+def test_close_while_running():
+    # Callbacks are not run, as when the IOLoop has stopped
+    dispatcher = Dispatcher(lambda callback, *args: None, threads=3, max_size=100)
+    dispatcher.submit('a', time.sleep, (0.2,))
+    _wait_busy(dispatcher)
+    closer = threading.Thread(target=dispatcher.close, daemon=True)
+    closer.start()
+    closer.join(5)
+    assert not closer.is_alive()
+    assert dispatcher.processed == 1
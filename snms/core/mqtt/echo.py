@@ -0,0 +1,142 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Republishing of saved sensor values.
+
+Values received over HTTP are republished to ``sensors/<uid>/values`` for
+the devices and dashboards subscribed to that topic. With MQTT_ECHO_AMQP
+enabled they are published directly to the ``amq.topic`` exchange of
+RabbitMQ, with the ``x-snms-origin: server`` header. The consumer queue is
+bound so that messages with this header never reach it, while MQTT
+subscribers receive them as before.
+
+If RabbitMQ can not be reached, values are published over MQTT; the
+consumer then discards them by their ``fromServer`` field.
+
+The blocking connection is only served while publishing, so heartbeats are
+disabled; a connection closed by the broker or the network in the
+meantime is reopened once before falling back to MQTT.
+"""
+
+import json
+import os
+import threading
+import time
+
+import pika
+from pika.exceptions import AMQPChannelError, AMQPConnectionError
+
+from snms.core.config import config
+from snms.core.logger import Logger
+from snms.core.mqtt import mqtt
+
+_LOGGER = Logger.get(__name__)
+
+EXCHANGE = 'amq.topic'
+ORIGIN_HEADER = 'x-snms-origin'
+ORIGIN_SERVER = 'server'
+
+# Seconds to publish over MQTT after a failed AMQP connection.
+RETRY_INTERVAL = 30
+
+
+def amqp_url():
+    """AMQP url of the RabbitMQ broker behind MQTT_BROKER_URL"""
+    return "amqp://{}:{}@{}:{}".format(config.MQTT_USERNAME, config.MQTT_PASSWORD,
+                                       config.MQTT_BROKER_URL, config.MQTT_AMQP_PORT)
+
+
+class EchoPublisher(object):
+    """
+    Publishes server echoes over a blocking AMQP connection.
+
+    The connection is opened on first use and reopened in forked worker
+    processes and when it was lost.
+    """
+
+    def __init__(self):
+        self._connection = None
+        self._channel = None
+        self._pid = None
+        self._retry_at = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._connection is not None and self._pid == os.getpid() and self._connection.is_open:
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        try:
+            parameters = pika.URLParameters(amqp_url())
+            # Heartbeats would only be answered while publishing
+            parameters.heartbeat = 0
+            self._connection = pika.BlockingConnection(parameters)
+            self._channel = self._connection.channel()
+            self._pid = os.getpid()
+            return True
+        except Exception as e:
+            _LOGGER.error('Could not connect to RabbitMQ, publishing over MQTT: %s', e)
+            self._reset()
+            return False
+
+    def _close(self):
+        if self._connection is not None and self._pid == os.getpid() and self._connection.is_open:
+            try:
+                # Only the channel may have been closed
+                self._connection.close()
+            except Exception as e:
+                _LOGGER.debug(e)
+        self._connection = None
+        self._channel = None
+
+    def _reset(self):
+        self._close()
+        self._retry_at = time.monotonic() + RETRY_INTERVAL
+
+    def publish(self, topic, payload):
+        """
+        Publish a message to an MQTT topic.
+
+        :return: True if the message was published over AMQP
+        """
+        properties = pika.BasicProperties(content_type='application/json',
+                                          headers={ORIGIN_HEADER: ORIGIN_SERVER})
+        with self._lock:
+            for reconnect in (True, False):
+                if not self._open():
+                    return False
+                try:
+                    self._channel.basic_publish(EXCHANGE, topic.replace('/', '.'), payload, properties)
+                    return True
+                except (AMQPConnectionError, AMQPChannelError) as e:
+                    if not reconnect:
+                        _LOGGER.error('Could not publish to RabbitMQ: %s', e)
+                        break
+                    _LOGGER.warning('RabbitMQ connection lost, reconnecting: %s', e)
+                    self._close()
+                except Exception as e:
+                    _LOGGER.error('Could not publish to RabbitMQ: %s', e)
+                    break
+            self._reset()
+            return False
+
+
+echo_publisher = EchoPublisher()
+
+
+def publish_value(sensor_uid, value):
+    """
+    Republish a saved sensor value to ``sensors/<uid>/values``.
+
+    :param sensor_uid: Sensor uid
+    :param value: Saved value, as stored with the sensor
+    """
+    topic = 'sensors/{}/values'.format(sensor_uid)
+    payload = json.dumps(dict(value, fromServer=True))
+    if config.MQTT_ECHO_AMQP and echo_publisher.publish(topic, payload):
+        return
+    mqtt.publish(topic, payload)
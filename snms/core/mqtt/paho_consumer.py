@@ -0,0 +1,235 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Ingest consumer for plain MQTT brokers.
+
+Used by ``snms mqtt`` with ``MQTT_CONSUMER_ENGINE = 'mqtt'``, e.g. with
+Mosquitto, EMQX or HiveMQ instead of RabbitMQ. All consumers subscribe
+through the ``$share/<MQTT_SHARED_GROUP>/`` shared subscription, so the
+broker splits the values between them. Messages are processed by a
+Dispatcher, never on the paho network thread, in per-sensor lanes or in
+batches, as by `EmqpConsumer`.
+
+With paho-mqtt 2.0 or later, QoS 1 messages are acknowledged once they
+are processed; older versions acknowledge them on receipt. The broker
+delivers the values of a sensor to different consumers unless its shared
+subscription strategy is sticky by topic.
+
+With MQTT 5 the broker sends at most `prefetch` unacknowledged messages
+(ReceiveMaximum), as many as the dispatcher holds, so it is never full.
+With MQTT 3.1.1 the in-flight limit is a setting of the broker, e.g.
+``max_inflight_messages`` of Mosquitto, which should not exceed the
+prefetch. A message arriving while the dispatcher is full is not
+acknowledged, so the broker redelivers it when the session is resumed;
+the network thread never waits for room.
+"""
+
+import socket
+import threading
+import time
+
+from paho.mqtt import client as mqtt_client
+
+from snms.core.config import config
+from snms.core.logger import Logger
+from snms.core.mqtt.consumer import ValueProcessor
+from snms.core.mqtt.dispatcher import Dispatcher, QueueFull
+from snms.modules.sensors.dedup import dedup_key, is_duplicate
+
+LOGGER = Logger.get(__name__)
+
+
+class PahoConsumer(ValueProcessor):
+    """
+    Shared-subscription consumer of sensor values.
+
+    :param app: Flask application
+    :param partition: Number of the consumer, part of its client id
+    :param prefetch: Maximum number of unacknowledged messages
+    :param threads: Number of messages processed at once
+    :param batch_size: Messages processed as one batch, 0 to process them one by one
+    :param batch_wait: Milliseconds to wait for a batch to fill up
+    """
+
+    TOPICS = ['sensors/+/values', 'sensors_hid/+/values', 'sensors/+/values/+', 'sensors_hid/+/values/+']
+    # Seconds to wait for pending messages on stop
+    DRAIN_TIMEOUT = 30
+    # Seconds the broker keeps the session of a stopped consumer, as the
+    # message TTL of the AMQP queue
+    SESSION_EXPIRY = 600
+    BATCH_LANE = 'batch'
+
+    def __init__(self, app, partition=None, prefetch=100, threads=8, batch_size=0, batch_wait=50):
+        self.app = app
+        self._prefetch = prefetch
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        self._batch = []
+        self._batch_timer = None
+        self._lock = threading.Lock()
+        self._dispatcher = Dispatcher(lambda callback, *args: callback(*args), threads=threads,
+                                      max_size=max(prefetch, 1), weights=config.MQTT_TENANT_WEIGHTS)
+        self._v5 = config.MQTT_CONSUMER_PROTOCOL == 5 and hasattr(mqtt_client, 'MQTTv5')
+        self._client = self._create_client('snms-ingest-{}-{}'.format(socket.gethostname(), partition or 0))
+        #: Messages left unacknowledged, or dropped if acknowledged on
+        #: receipt, because the dispatcher was full
+        self.rejected = 0
+
+    @property
+    def dispatcher(self):
+        """The Dispatcher processing the messages, see Dispatcher.stats"""
+        return self._dispatcher
+
+    def _create_client(self, client_id):
+        kwargs = {'client_id': client_id}
+        if self._v5:
+            kwargs['protocol'] = mqtt_client.MQTTv5
+        else:
+            # Keep the subscriptions and queued messages while disconnected
+            kwargs['clean_session'] = False
+        self._manual_ack = hasattr(mqtt_client, 'CallbackAPIVersion')
+        if self._manual_ack:
+            # paho-mqtt >= 2.0
+            kwargs['callback_api_version'] = mqtt_client.CallbackAPIVersion.VERSION1
+            kwargs['manual_ack'] = True
+        client = mqtt_client.Client(**kwargs)
+        if config.MQTT_USERNAME is not None:
+            client.username_pw_set(config.MQTT_USERNAME, config.MQTT_PASSWORD)
+        if config.MQTT_TLS_ENABLED:
+            if config.MQTT_TLS_INSECURE:
+                client.tls_insecure_set(config.MQTT_TLS_INSECURE)
+            client.tls_set(ca_certs=config.MQTT_TLS_CA_CERTS, certfile=config.MQTT_TLS_CERTFILE,
+                           keyfile=config.MQTT_TLS_KEYFILE, cert_reqs=config.MQTT_TLS_CERT_REQS,
+                           tls_version=config.MQTT_TLS_VERSION, ciphers=config.MQTT_TLS_CIPHERS)
+        client.max_inflight_messages_set(max(self._prefetch, 1))
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        return client
+
+    def topic(self, topic):
+        """Subscription filter of a topic, shared unless MQTT_SHARED_GROUP is empty"""
+        if config.MQTT_SHARED_GROUP:
+            return '$share/{}/{}'.format(config.MQTT_SHARED_GROUP, topic)
+        return topic
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc != mqtt_client.MQTT_ERR_SUCCESS:
+            LOGGER.warning('Connection refused: %s', rc)
+            return
+        LOGGER.info('Connected, subscribing to %s', ', '.join(self.TOPICS))
+        client.subscribe([(self.topic(topic), config.MQTT_CONSUMER_QOS) for topic in self.TOPICS])
+
+    def on_message(self, client, userdata, message):
+        """Invoked on the paho network thread; hands the message to the
+        dispatcher and returns.
+
+        """
+        topic = message.topic.replace('/', '.')
+        content_type = None
+        properties = getattr(message, 'properties', None)
+        if properties is not None:
+            content_type = getattr(properties, 'ContentType', None)
+        key = dedup_key(topic.split('.')[1], message.payload, codec=self.message_codec(topic, content_type))
+        if is_duplicate(key):
+            LOGGER.debug('Duplicate message %s', message.mid)
+            self.acknowledge(message)
+            return
+        if self._batch_size:
+            self.add_to_batch(topic, message.payload, message, content_type, key)
+            return
+        tenant, priority = self.message_class(topic)
+        try:
+            self._dispatcher.submit('.'.join(topic.split('.')[:2]), self.process_message,
+                                    (topic, message.payload, message, content_type, key),
+                                    lambda result: self.acknowledge(message),
+                                    tenant=tenant, priority=priority)
+        except QueueFull:
+            self.reject(message)
+
+    def reject(self, *messages):
+        """Leave messages the dispatcher has no room for unacknowledged, for
+        the broker to redeliver them. Without manual acknowledgements or
+        with QoS 0 they are lost.
+
+        """
+        self.rejected += len(messages)
+        if self._manual_ack and all(message.qos > 0 for message in messages):
+            LOGGER.warning('Dispatcher is full, left %d messages for redelivery', len(messages))
+        else:
+            LOGGER.error('Dispatcher is full, dropped %d messages', len(messages))
+
+    def acknowledge(self, *messages):
+        """Acknowledge QoS 1 messages, if acknowledgements are manual"""
+        if not self._manual_ack:
+            return
+        for message in messages:
+            if message.qos > 0:
+                self._client.ack(message.mid, message.qos)
+
+    def add_to_batch(self, topic, body, message, content_type=None, key=None):
+        """Collect a message into the current batch, which is processed once
+        it has batch_size messages or is batch_wait milliseconds old.
+
+        """
+        with self._lock:
+            self._batch.append((topic, body, message, content_type, key))
+            full = len(self._batch) >= self._batch_size
+            if not full and self._batch_timer is None:
+                self._batch_timer = threading.Timer(self._batch_wait / 1000.0, self.dispatch_batch)
+                self._batch_timer.daemon = True
+                self._batch_timer.start()
+        if full:
+            self.dispatch_batch()
+
+    def dispatch_batch(self):
+        """Hand the current batch to the dispatcher. Batches share one lane
+        and are processed one after the other, in the order of delivery.
+
+        """
+        with self._lock:
+            if self._batch_timer is not None:
+                self._batch_timer.cancel()
+                self._batch_timer = None
+            batch, self._batch = self._batch, []
+        if not batch:
+            return
+        messages = [item[2] for item in batch]
+        try:
+            self._dispatcher.submit(self.BATCH_LANE, self.process_batch, (batch,),
+                                    lambda result: self.acknowledge(*messages))
+        except QueueFull:
+            self.reject(*messages)
+
+    def run(self):
+        """Connect to the broker and process messages until interrupted."""
+        kwargs = {'keepalive': config.MQTT_KEEPALIVE}
+        if self._v5:
+            from paho.mqtt.properties import Properties
+            from paho.mqtt.packettypes import PacketTypes
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = self.SESSION_EXPIRY
+            properties.ReceiveMaximum = max(self._prefetch, 1)
+            kwargs.update(clean_start=False, properties=properties)
+        LOGGER.info('Connecting to %s:%s', config.MQTT_BROKER_URL, config.MQTT_BROKER_PORT)
+        self._client.connect_async(config.MQTT_BROKER_URL, config.MQTT_BROKER_PORT, **kwargs)
+        self._client.loop_forever(retry_first_connection=True)
+
+    def stop(self):
+        """Stop receiving messages, process the pending ones and disconnect."""
+        LOGGER.info('Stopping')
+        self._client.loop_start()
+        self._client.unsubscribe([self.topic(topic) for topic in self.TOPICS])
+        self.dispatch_batch()
+        deadline = time.monotonic() + self.DRAIN_TIMEOUT
+        while not self._dispatcher.idle and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if not self._dispatcher.idle:
+            LOGGER.warning('%d messages are still pending', self._dispatcher.pending)
+        self._client.disconnect()
+        self._client.loop_stop()
+        self._dispatcher.close()
+        LOGGER.info('Stopped')
@@ -4,7 +4,7 @@
 #
 # License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
 
-from snms.const import TSDB_CLIENT
 from .tsdb import TSDB, TSDBClient
 
-tsdb = TSDBClient.factory(TSDB_CLIENT)
+#: Time series database; its client is selected by TSDB_CLIENT in init_app
+tsdb = TSDB()
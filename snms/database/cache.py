@@ -0,0 +1,352 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Result cache of grouped sensor history and aggregate queries.
+
+Dashboards poll the same grouped history of a sensor every few seconds,
+while only its newest bucket still changes. The range of a query is split
+into buckets of its group duration (TSDB_QUERY_CACHE_BUCKET for aggregate
+queries) and the count, sum, minimum and maximum of each field are cached
+per bucket once the bucket is closed, i.e. ended TSDB_QUERY_CACHE_GRACE
+seconds ago. Only the open bucket, buckets the range covers partly and
+buckets not cached yet are read from the database, all statistics of a
+run of buckets in one pass (see `TSDBClient.get_stats`). Grouped data, the
+aggregate and the total are all derived from these statistics.
+
+Identical queries running at the same time are answered by one of them.
+Entries of a sensor are dropped when its points are deleted or older points
+are written, by bumping a generation which is part of the keys.
+
+The local backend keeps entries in the process, where points written or
+deleted by other processes (e.g. MQTT consumers) do not invalidate them,
+so it needs a TTL; the redis backend, at REDIS_CACHE_URL, shares them
+between web processes and workers.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from dateutil import parser
+
+from .tsdb import HISTORY_PARTS, TOTAL_NONE, parse_duration, stats_aggregate, stats_rows, stats_total
+
+FUNCTIONS = ('MEAN', 'SUM', 'MIN', 'MAX', 'COUNT')
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _to_micros(value):
+    """UNIX microseconds of an ISO time, naive times being UTC"""
+    value = parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH) // timedelta(microseconds=1)
+
+
+def _format(micros):
+    return (_EPOCH + timedelta(microseconds=micros)).isoformat() + 'Z'
+
+
+def _now():
+    return (datetime.utcnow() - _EPOCH) // timedelta(microseconds=1)
+
+
+class LocalBackend(object):
+    """
+    In-process cache backend.
+
+    Counters are kept apart from the entries and never dropped. Only writes
+    and deletes of the same process invalidate the entries, so those of
+    other processes are seen once the entries expire.
+
+    :param max_size: Maximum number of entries, the least recently used
+                     entries are dropped once reached
+    """
+    shared = False
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        values = []
+        with self._lock:
+            for key in keys:
+                if key in self._counters:
+                    values.append(self._counters[key])
+                    continue
+                entry = self._entries.get(key)
+                if entry is not None and (entry[1] is None or entry[1] > now):
+                    self._entries.move_to_end(key)
+                    values.append(entry[0])
+                else:
+                    values.append(None)
+        return values
+
+    def set_many(self, mapping, ttl=None):
+        expiry = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            for key, value in mapping.items():
+                self._entries[key] = (value, expiry)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters[key] = self._counters.get(key, 0) + 1
+            return value
+
+
+class RedisBackend(object):
+    """
+    Cache backend shared through redis; values are stored as JSON.
+
+    :param url: Redis URL, e.g. REDIS_CACHE_URL
+    :param prefix: Prefix of the keys
+    """
+    shared = True
+
+    def __init__(self, url, prefix='snms:tsdb:'):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [json.loads(value) if value is not None else None
+                for value in self.redis.mget([self.prefix + key for key in keys])]
+
+    def set_many(self, mapping, ttl=None):
+        pipe = self.redis.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(self.prefix + key, json.dumps(value), ex=ttl or None)
+        pipe.execute()
+
+    def incr(self, key):
+        return self.redis.incr(self.prefix + key)
+
+    def add(self, key, value, ttl):
+        """Set `key` unless it exists, return whether it was set"""
+        return bool(self.redis.set(self.prefix + key, json.dumps(value), ex=ttl, nx=True))
+
+    def delete(self, key):
+        self.redis.delete(self.prefix + key)
+
+
+class _Flight(object):
+    """A query being answered, waited for by identical queries"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class QueryCache(object):
+    """
+    Bucket-aware cache of sensor queries, see the module documentation.
+
+    :param backend: LocalBackend or RedisBackend
+    :param bucket: Bucket width of aggregate queries, an InfluxDB duration
+    :param grace: Seconds after its end from which a bucket is cached
+    :param ttl: Seconds for which entries are kept, 0 to keep them until
+                they are invalidated or evicted
+    :param wait: Seconds for which identical queries wait for the first one
+    """
+
+    def __init__(self, backend, bucket='1h', grace=60, ttl=0, wait=10):
+        self.backend = backend
+        self.bucket = bucket
+        self.grace = grace
+        self.ttl = ttl
+        self.wait = wait
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def factory(cls, config):
+        """
+        Query cache set up by TSDB_QUERY_CACHE, or None if it is disabled.
+
+        :param config: Application config
+        """
+        kind = config.get('TSDB_QUERY_CACHE')
+        if not kind:
+            return None
+        if kind == 'redis':
+            backend = RedisBackend(config['REDIS_CACHE_URL'])
+        elif kind == 'local':
+            # Late readings ingested by other processes do not drop the entries
+            if not config['TSDB_QUERY_CACHE_TTL']:
+                raise ValueError('TSDB_QUERY_CACHE_TTL must be set for the local TSDB_QUERY_CACHE')
+            backend = LocalBackend(config['TSDB_QUERY_CACHE_SIZE'])
+        else:
+            raise ValueError('Invalid TSDB_QUERY_CACHE: {}'.format(kind))
+        return cls(backend, bucket=config['TSDB_QUERY_CACHE_BUCKET'], grace=config['TSDB_QUERY_CACHE_GRACE'],
+                   ttl=config['TSDB_QUERY_CACHE_TTL'], wait=config['TSDB_QUERY_CACHE_WAIT'])
+
+    def cacheable(self, group_duration=None, aggregate_only=False, duration=None, start_date=None, **kwargs):
+        """Check if a query is answered by the cache: a grouped or aggregate query of a bounded range"""
+        if not (duration or start_date) or not (group_duration or aggregate_only):
+            return False
+        try:
+            return parse_duration(group_duration or self.bucket) > 0
+        except ValueError:
+            return False
+
+    def invalidate(self, sensor_id=None):
+        """Drop the entries of a sensor, or of all sensors"""
+        self.backend.incr('gen' if sensor_id is None else 'gen:{}'.format(sensor_id))
+
+    def written(self, sensor_id, times):
+        """
+        Drop the entries of a sensor if points were written to closed buckets.
+
+        :param times: ISO times of the written points, None for the current time
+        """
+        times = [value for value in times if value]
+        if not times:
+            return
+        limit = _now() - self.grace * 10 ** 6
+        if any(_to_micros(value) < limit for value in times):
+            self.invalidate(sensor_id)
+
+    def get_points(self, client, sensor, **kwargs):
+        """
+        Get the grouped history or the aggregate of a sensor, see
+        `TSDBClient.get_points`.
+
+        :param client: TSDBClient answering what is not cached
+        """
+        query = {name: value for name, value in kwargs.items() if name not in ('value_fields', 'cursor')}
+        key = hashlib.sha1(json.dumps([sensor.id, query], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return self._single_flight(key, lambda: self._points(client, sensor, **kwargs))
+
+    def _single_flight(self, key, compute):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if flight.done.wait(self.wait) and not flight.failed:
+                return flight.result
+            return compute()
+        try:
+            flight.result = self._shared_flight(key, compute) if self.backend.shared else compute()
+        except Exception:
+            flight.failed = True
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def _shared_flight(self, key, compute):
+        """Answer identical queries of other processes with one result, kept for a second"""
+        lock, result_key = 'flight:' + key, 'result:' + key
+        deadline = time.monotonic() + self.wait
+        while True:
+            result = self.backend.get_many([result_key])[0]
+            if result is not None:
+                return result
+            if self.backend.add(lock, 1, max(1, int(self.wait))):
+                break
+            if time.monotonic() > deadline:
+                return compute()
+            time.sleep(0.05)
+        try:
+            result = compute()
+            self.backend.set_many({result_key: result}, 1)
+            return result
+        finally:
+            self.backend.delete(lock)
+
+    def _points(self, client, sensor, limit=None, order_by=None, start_date=None, end_date=None, duration=None,
+                offset=0, group_duration=None, aggregate_only=False, value_fields=None, aggregate_function=None,
+                offset_interval=None, total=None, include=None, **kwargs):
+        now = _now()
+        if duration:
+            start, end = now - parse_duration(duration), now
+        else:
+            start = _to_micros(start_date)
+            end = _to_micros(end_date) if end_date else now
+        width = parse_duration(group_duration or self.bucket)
+        shift = parse_duration(offset_interval) % width if offset_interval and not aggregate_only else 0
+        function = (aggregate_function or '').upper()
+        function = function if function in FUNCTIONS else 'MEAN'
+
+        parts = {'aggregate'} if aggregate_only else set(HISTORY_PARTS if include is None else include)
+        if total == TOTAL_NONE:
+            parts.discard('total')
+
+        def fetch(lo, hi):
+            """Statistics of the buckets `lo` to `hi`, limited to the range, read in one pass"""
+            stats = {bucket: {} for bucket in range(lo, hi + 1)}
+            result = client.get_stats(sensor, _format(max(start, lo * width + shift)),
+                                      _format(min(end, (hi + 1) * width + shift - 1)), group_duration or self.bucket,
+                                      offset_interval if not aggregate_only else None, value_fields)
+            for micros, fields in result.items():
+                bucket = (micros - shift) // width
+                if bucket in stats:
+                    stats[bucket] = fields
+            return stats
+
+        first, last = (start - shift) // width, (end - shift) // width
+        stats = {}
+        if parts:
+            generation = '.'.join(str(value or 0) for value in
+                                  self.backend.get_many(['gen', 'gen:{}'.format(sensor.id)]))
+            # Buckets within the range which ended before the grace period
+            closed = [bucket for bucket in range(first, last + 1)
+                      if bucket * width + shift >= start and (bucket + 1) * width + shift - 1 <= end and
+                      (bucket + 1) * width + shift <= now - self.grace * 10 ** 6]
+            keys = ['{}:{}:{}:{}:{}'.format(sensor.id, generation, width, shift, bucket) for bucket in closed]
+            for bucket, value in zip(closed, self.backend.get_many(keys)):
+                if value is not None:
+                    stats[bucket] = value
+            missing = [bucket for bucket in closed if bucket not in stats]
+            for lo, hi in _runs(missing):
+                fetched = fetch(lo, hi)
+                stats.update(fetched)
+                self.backend.set_many({'{}:{}:{}:{}:{}'.format(sensor.id, generation, width, shift, bucket): value
+                                       for bucket, value in fetched.items()}, self.ttl)
+            for lo, hi in _runs([bucket for bucket in range(first, last + 1) if bucket not in stats]):
+                stats.update(fetch(lo, hi))
+
+        aggregate = stats_aggregate(stats.values()) if 'aggregate' in parts else None
+        if aggregate_only:
+            return aggregate
+        count = stats_total(stats.values()) if 'total' in parts else None
+        data = None
+        if 'data' in parts:
+            data = stats_rows(stats, function, first, last, width, shift)
+            if order_by and order_by.strip().lower().endswith('desc'):
+                data.reverse()
+            data = data[offset or 0:(offset or 0) + limit if limit is not None else None]
+        return {'data': data, 'total': count, 'aggregate': aggregate, 'next': None}
+
+
+def _runs(buckets):
+    """Runs of consecutive buckets as (first, last) tuples"""
+    runs = []
+    for bucket in sorted(buckets):
+        if runs and runs[-1][1] == bucket - 1:
+            runs[-1][1] = bucket
+        else:
+            runs.append([bucket, bucket])
+    return runs
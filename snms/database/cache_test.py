@@ -0,0 +1,133 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from snms.database import cache
+from snms.database.cache import LocalBackend, QueryCache, _runs
+from snms.database.resample import Resampler
+from snms.database.tsdb import STATS, TSDBClient
+
+HOUR = 3600 * 10 ** 6
+MINUTE = 60 * 10 ** 6
+# Half an hour into the sixth hour: buckets 1 to 4 of a 5h range are closed
+NOW = 5 * HOUR + 30 * MINUTE
+
+SENSOR = SimpleNamespace(id=1)
+
+
+class _Client:
+    """Groups readings every ten minutes with a `Resampler`, recording the queried ranges"""
+
+    def __init__(self):
+        self.times = np.arange(0, NOW, 10 * MINUTE, dtype=np.int64)
+        self.values = (self.times // MINUTE).astype(np.float64)
+        self.calls = []
+
+    def _resample(self, start, end, group_duration, offset_interval=None, function=None):
+        resampler = Resampler(group_duration, offset_interval, function, start, end)
+        keep = (self.times >= start) & (self.times <= end)
+        resampler.add(self.times[keep], {'value': self.values[keep]})
+        return resampler
+
+    def get_points(self, sensor, start_date=None, end_date=None, group_duration=None, offset_interval=None,
+                   aggregate_function=None, **kwargs):
+        resampler = self._resample(cache._to_micros(start_date), cache._to_micros(end_date), group_duration,
+                                   offset_interval, aggregate_function)
+        return {'data': resampler.rows(), 'total': resampler.count, 'next': None}
+
+    def get_stats(self, sensor, start_date, end_date, group_duration, offset_interval=None, value_fields=None):
+        start, end = cache._to_micros(start_date), cache._to_micros(end_date)
+        self.calls.append((start, end))
+        resampler = self._resample(start, end, group_duration, offset_interval)
+        return {time: {name: dict(zip(STATS, values[:4])) for name, values in fields.items()}
+                for time, fields in resampler.intervals()}
+
+
+@pytest.fixture(autouse=True)
+def now(monkeypatch):
+    monkeypatch.setattr(cache, '_now', lambda: NOW)
+
+
+@pytest.fixture
+def client():
+    return _Client()
+
+
+@pytest.fixture
+def query_cache():
+    return QueryCache(LocalBackend(), grace=60)
+
+
+def _query(function='MEAN'):
+    return dict(duration='5h', group_duration='1h', aggregate_function=function, order_by='time ASC')
+
+
+@pytest.mark.parametrize('function', ('MEAN', 'SUM', 'MIN', 'MAX', 'COUNT'))
+def test_points_match_the_client(client, query_cache, function):
+    expected = client.get_points(SENSOR, start_date=cache._format(NOW - 5 * HOUR), end_date=cache._format(NOW),
+                                 group_duration='1h', aggregate_function=function)
+    for _ in range(2):
+        result = query_cache.get_points(client, SENSOR, **_query(function))
+        assert result['data'] == expected['data']
+        assert result['total'] == expected['total']
+
+
+def test_points_read_closed_buckets_once(client, query_cache):
+    query_cache.get_points(client, SENSOR, **_query())
+    client.calls = []
+    query_cache.get_points(client, SENSOR, **_query())
+    # Only the partly covered first bucket and the open last bucket are read again
+    assert [start for start, _ in client.calls] == [NOW - 5 * HOUR, 5 * HOUR]
+
+
+def test_points_after_invalidate(client, query_cache):
+    query_cache.get_points(client, SENSOR, **_query())
+    query_cache.invalidate(SENSOR.id)
+    client.calls = []
+    query_cache.get_points(client, SENSOR, **_query())
+    # One pass per run of buckets, closed ones being cached
+    assert sorted(client.calls) == [(NOW - 5 * HOUR, HOUR - 1), (HOUR, 5 * HOUR - 1), (5 * HOUR, NOW)]
+
+
+class _GroupingClient(TSDBClient, _Client):
+    """Only groups points, for the default `TSDBClient.get_stats`"""
+    __init__ = _Client.__init__
+    get_points = _Client.get_points
+
+
+def test_default_stats_match_the_client(client):
+    start, end = cache._format(NOW - 5 * HOUR), cache._format(NOW)
+    assert _GroupingClient().get_stats(SENSOR, start, end, '1h') == client.get_stats(SENSOR, start, end, '1h')
+
+
+def test_points_aggregate_only(client, query_cache):
+    aggregate = query_cache.get_points(client, SENSOR, duration='5h', aggregate_only=True)
+    values = client.values[client.times >= NOW - 5 * HOUR]
+    assert aggregate['count_value'] == len(values)
+    assert aggregate['sum_value'] == values.sum()
+    assert (aggregate['min_value'], aggregate['max_value']) == (values.min(), values.max())
+    assert aggregate['mean_value'] == pytest.approx(values.mean())
+
+
+def test_points_page_and_order(client, query_cache):
+    data = query_cache.get_points(client, SENSOR, **_query())['data']
+    page = query_cache.get_points(client, SENSOR, offset=1, limit=2, **dict(_query(), order_by='time DESC'))['data']
+    assert page == data[::-1][1:3]
+
+
+@pytest.mark.parametrize(('buckets', 'expected'), (
+    ([], []),
+    ([3], [[3, 3]]),
+    ([5, 1, 2, 3, 7, 8], [[1, 3], [5, 5], [7, 8]]),
+))
+def test_runs(buckets, expected):
+    assert _runs(buckets) == expected
+
+
+def test_local_cache_needs_a_ttl():
+    config = {'TSDB_QUERY_CACHE': 'local', 'TSDB_QUERY_CACHE_SIZE': 10, 'TSDB_QUERY_CACHE_BUCKET': '1h',
+              'TSDB_QUERY_CACHE_GRACE': 60, 'TSDB_QUERY_CACHE_TTL': 0, 'TSDB_QUERY_CACHE_WAIT': 10}
+    with pytest.raises(ValueError):
+        QueryCache.factory(config)
+    assert isinstance(QueryCache.factory(dict(config, TSDB_QUERY_CACHE_TTL=300)).backend, LocalBackend)
@@ -4,44 +4,536 @@
 #
 # License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
 
-"""Cassandra DB"""
+"""
+Cassandra DB
+
+With TSDB_BUCKET_SIZE, or a size set for their type in TSDB_BUCKET_SIZES,
+sensor tables are created with a time-bucketed layout, PRIMARY KEY
+((sensor_id, bucket), time), so the partition of a sensor is split every
+that many seconds. The layout of each measurement is kept in the
+``measurement_layout`` table; measurements without a row there use the
+unbucketed layout of older installs and are moved with
+``snms db bucket-tsdb``. The buckets holding data of a sensor are listed
+in ``measurement_buckets``, and range reads query them in parallel.
+
+Points are counted at ingest per sensor and hour in the ``point_counts``
+counter table, which answers history totals without scanning the range.
+Measurements written before the counters existed are counted with
+``COUNT(*)`` until ``snms db count-tsdb`` has filled their counters.
+Counter updates are not idempotent: a point written again (a retried batch,
+a redelivered message, an overwritten time) is counted again although it
+is stored once, so these totals are approximate and may run high.
+``snms db count-tsdb`` sets them back to the stored rows.
+
+Alert, event and audit history is also written to a time-bucketed table per
+filter of the history pages (HISTORY_TABLES), partitioned by the filtered
+tags. A history series whose layout is ready is read from these tables;
+series of older installs are read from their main table with
+``ALLOW FILTERING`` until ``snms db history-tsdb`` has filled them.
+
+With TSDB_ROLLUPS, the count, sum, minimum, maximum and last value of each
+field are rolled up per sensor into the ``rollups`` table for intervals of
+ROLLUP_RESOLUTIONS, by `update_rollups` every minute and by
+``snms db rollup-tsdb`` for older readings. ``rollup_state`` holds the
+range each rollup is complete for, and grouped reads take what they can
+from the coarsest fitting rollup.
+
+Sensor readings and rollups with a retention (see `Retention`) are written
+with a TTL counted from their time, so Cassandra drops them without a
+delete scan; readings already past it are not written. `expire` drops the
+point counters and bucket lists of the expired hours.
+"""
+from collections import Counter, deque, namedtuple
+from itertools import groupby
 from cassandra.cluster import Cluster
-from cassandra.query import SimpleStatement
+from cassandra.query import BatchStatement, BatchType, SimpleStatement
+from dateutil import parser
 from snms.core.logger import Logger
 from snms.database import TSDBClient
+from snms.database.tsdb import (HISTORY_PARTS, ROLLUP_NAMES, ROLLUP_RESOLUTIONS, TOTAL_ESTIMATE, TOTAL_NONE,
+                                 STATS, decode_cursor, encode_cursor, page_cursor, parse_duration, rollup_resolution,
+                                 stats_aggregate, time_cursor)
+
+from .exceptions import InvalidCursor, MeasurementNotFound
+from .resample import Resampler
 
-from .exceptions import MeasurementNotFound
+from datetime import datetime, timedelta, timezone
+import base64
+import threading
+import time as _time
+from itertools import islice
 
-from datetime import datetime, timezone
-import pandas as pd
+import numpy as np
 
 _LOGGER = Logger.get()
 
+_EPOCH = datetime(1970, 1, 1)
+
+#: Table, bucket size in seconds (None if unbucketed), migration state of a measurement
+#: and whether its points are all in the point counters
+Layout = namedtuple('Layout', ['table', 'bucket_size', 'migrating', 'counted'])
+
+LAYOUT_READY = 'ready'
+LAYOUT_MIGRATING = 'migrating'
+
+#: Tags the tables of each history series are partitioned by, besides the
+#: bucket. The main tables of these series are not bucketed, the bucket size
+#: in their layout is the one of these tables.
+HISTORY_TABLES = {
+    'event_logs': [('company_id',), ('company_id', 'sensor_id')],
+    'alert_history': [('company_id',), ('company_id', 'sensor_id'), ('company_id', 'alert_id'),
+                      ('company_id', 'sensor_id', 'alert_id')],
+    'event_history': [('company_id',), ('company_id', 'sensor_id'), ('company_id', 'event_id'),
+                      ('company_id', 'sensor_id', 'event_id')],
+}
+
 
 class CassandraClient(TSDBClient):
     """
     Cassandra time series database for app.
     """
 
+    # Seconds for which the layout of a measurement is cached
+    LAYOUT_CACHE_TTL = 60
+    # Bucket queries of a range read running at once
+    FANOUT = 8
+    # Known buckets remembered per process, to write each one once
+    KNOWN_BUCKETS = 100000
+    # Rows resampled at once when grouping
+    RESAMPLE_CHUNK = 5000
+    # Seconds of the periods points are counted by
+    COUNT_BUCKET_SIZE = 3600
+    # Seconds per bucket of new history tables
+    HISTORY_BUCKET_SIZE = 7 * 86400
+    # Intervals per partition of the rollups table
+    ROLLUP_PARTITION = 10000
+    # Seconds after its end from which an interval is rolled up
+    ROLLUP_GRACE = 60
+    # Longest TTL Cassandra accepts, 20 years
+    MAX_TTL = 630720000
+
     def __init__(self, app=None):
         super().__init__()
         self.keyspace = None
         self.cluster = None
         self.client = None
+        self.max_inflight = 128
+        self.bucket_size = 0
+        self.bucket_sizes = {}
+        self.rollups = False
+        self._layouts = {}
+        self._rollup_states = {}
+        self._known_buckets = set()
+        self._prepared = {}
+        self._prepare_lock = threading.Lock()
+        self._partition_keys = {}
+        self._inflight = 0
+        self._inflight_cond = threading.Condition()
         if app is not None:
             self.init_app(app)
 
     def init_app(self, app):
         self.app = app
+        self.max_inflight = app.config.get('TSDB_MAX_INFLIGHT', 128)
+        self.bucket_size = app.config.get('TSDB_BUCKET_SIZE', 0)
+        self.bucket_sizes = app.config.get('TSDB_BUCKET_SIZES', {})
+        self.rollups = app.config.get('TSDB_ROLLUPS', False)
+        self.init_retention(app)
         self.start(app=app)
+        self.init_buffer(app)
 
     def start(self, app):
         host = app.config['TSDB_HOST']
         self.keyspace= app.config['TSDB_DB']
         self.cluster = Cluster([host])
         self.client = self.cluster.connect(self.keyspace)
+        self._prepared = {}
+        self._layouts = {}
+        self._rollup_states = {}
+        self._known_buckets = set()
+        self._partition_keys = {}
+        # The in-flight count and condition are kept: writes of the previous
+        # session still release their slots when they complete or fail
         _LOGGER.debug("Cassandra Client started")
 
+    def layout(self, measurement, refresh=False):
+        """
+        Layout of a measurement, cached for LAYOUT_CACHE_TTL seconds.
+
+        :param refresh: Read the layout from the database
+        """
+        cached = self._layouts.get(measurement)
+        if cached is not None and not refresh and cached[1] > _time.monotonic():
+            return cached[0]
+        layout = Layout(measurement, None, False, False)
+        try:
+            rows = list(self.client.execute(self.prepare(
+                "SELECT table_name, bucket_size, state, counted FROM measurement_layout WHERE measurement = ?"),
+                [measurement]))
+            if rows:
+                layout = Layout(rows[0].table_name or measurement, rows[0].bucket_size,
+                                rows[0].state == LAYOUT_MIGRATING, bool(rows[0].counted))
+        except Exception as e:
+            # No layout table yet, all measurements are unbucketed
+            _LOGGER.debug(e)
+        self._layouts[measurement] = (layout, _time.monotonic() + self.LAYOUT_CACHE_TTL)
+        return layout
+
+    def set_layout(self, measurement, table, bucket_size, state):
+        """Store the layout of a measurement."""
+        self.client.execute(self.prepare(
+            "INSERT INTO measurement_layout (measurement, table_name, bucket_size, state) VALUES (?, ?, ?, ?)"),
+            [measurement, table, bucket_size, state])
+        self._layouts.pop(measurement, None)
+
+    def set_counted(self, measurement):
+        """Mark the point counters of a measurement as complete."""
+        self.client.execute(self.prepare("UPDATE measurement_layout SET counted = true WHERE measurement = ?"),
+                            [measurement])
+        self._layouts.pop(measurement, None)
+
+    def create_layout_tables(self):
+        """Create the tables of measurement layouts, sensor buckets, point counts and rollups."""
+        self.client.execute("CREATE TABLE IF NOT EXISTS measurement_layout (measurement text PRIMARY KEY, "
+                            "table_name text, bucket_size int, state text, counted boolean)")
+        try:
+            self.client.execute("ALTER TABLE measurement_layout ADD counted boolean")
+        except Exception as e:
+            # Already there
+            _LOGGER.debug(e)
+        self.client.execute("CREATE TABLE IF NOT EXISTS measurement_buckets (measurement text, sensor_id int, "
+                            "bucket int, PRIMARY KEY ((measurement, sensor_id), bucket)) "
+                            "WITH CLUSTERING ORDER BY (bucket DESC)")
+        self.client.execute("CREATE TABLE IF NOT EXISTS point_counts (measurement text, sensor_id int, "
+                            "bucket int, points counter, PRIMARY KEY ((measurement, sensor_id), bucket)) "
+                            "WITH CLUSTERING ORDER BY (bucket DESC)")
+        self.client.execute("CREATE TABLE IF NOT EXISTS history_buckets (table_name text, key text, bucket int, "
+                            "PRIMARY KEY ((table_name, key), bucket)) WITH CLUSTERING ORDER BY (bucket DESC)")
+        self.client.execute("CREATE TABLE IF NOT EXISTS rollups (sensor_id int, resolution int, bucket int, "
+                            "time timestamp, field text, count bigint, sum double, min double, max double, "
+                            "last double, PRIMARY KEY ((sensor_id, resolution, bucket), time, field))")
+        self.client.execute("CREATE TABLE IF NOT EXISTS rollup_state (measurement text, resolution int, "
+                            "since timestamp, done timestamp, PRIMARY KEY (measurement, resolution))")
+
+    def add_counts(self, measurement, counts):
+        """
+        Add to the point counters of sensors.
+
+        Counters are added to however often the same points are written,
+        so rewritten points are counted more than once, see `total`.
+
+        :param counts: Dict of (sensor_id, bucket) pairs and numbers of points
+        """
+        statement = self.prepare("UPDATE point_counts SET points = points + ? "
+                                 "WHERE measurement = ? AND sensor_id = ? AND bucket = ?")
+        for (sensor_id, bucket), points in counts.items():
+            self.execute_async(statement, [points, measurement, sensor_id, bucket])
+
+    def total(self, measurement, sensor_id, start=None, end=None, estimate=False):
+        """
+        Number of points of a sensor between two times.
+
+        The counters of the COUNT_BUCKET_SIZE periods inside the range are
+        summed, and only the points of the periods the range ends in are
+        counted. An estimate sums the counters of all periods the range
+        touches. Measurements without complete counters are counted.
+
+        Counted totals are approximate: points written more than once, by
+        retries or redelivered messages, are also counted more than once
+        until ``snms db count-tsdb`` recounts them.
+
+        :param start: Naive UTC datetime or None
+        :param end: Naive UTC datetime, inclusive, or None
+        :param estimate: Whether an estimate is enough
+        """
+        if not self.layout(measurement).counted:
+            return self.count(measurement, sensor_id, start, end)
+        size = self.COUNT_BUCKET_SIZE
+        first = bucket_of(start, size) if start is not None else None
+        last = bucket_of(end, size) if end is not None else None
+        if estimate:
+            return self.counted(measurement, sensor_id, first, last + 1 if last is not None else None)
+        if start is not None and start > _bucket_start(first, size):
+            first += 1
+        if first is not None and last is not None and first > last:
+            return self.count(measurement, sensor_id, start, end)
+        total = self.counted(measurement, sensor_id, first, last)
+        if start is not None and start < _bucket_start(first, size):
+            total += self.count(measurement, sensor_id, start, before=_bucket_start(first, size))
+        if end is not None:
+            total += self.count(measurement, sensor_id, _bucket_start(last, size), end)
+        return total
+
+    def counted(self, measurement, sensor_id, first=None, stop=None):
+        """Sum of the point counters of a sensor from bucket `first` to before bucket `stop`"""
+        query = "SELECT points FROM point_counts WHERE measurement = ? AND sensor_id = ?"
+        params = [measurement, sensor_id]
+        if first is not None:
+            query += " AND bucket >= ?"
+            params.append(first)
+        if stop is not None:
+            query += " AND bucket < ?"
+            params.append(stop)
+        return sum(row.points for row in self.client.execute(self.prepare(query), params))
+
+    def count(self, measurement, sensor_id, start=None, end=None, before=None):
+        """
+        Count the points of a sensor with ``COUNT(*)``.
+
+        :param start: Naive UTC datetime or None
+        :param end: Naive UTC datetime, inclusive, or None
+        :param before: Naive UTC datetime, exclusive, or None
+        """
+        layout = self.layout(measurement)
+        bucketed = bool(layout.bucket_size) and not layout.migrating
+        query = 'SELECT COUNT(*) FROM "{}" WHERE sensor_id = ?'.format(layout.table if bucketed else measurement)
+        if bucketed:
+            query += ' AND bucket = ?'
+        params = []
+        for clause, value in ((' AND time >= ?', start), (' AND time <= ?', end), (' AND time < ?', before)):
+            if value is not None:
+                query += clause
+                params.append(value)
+        if bucketed:
+            buckets = self.buckets(measurement, sensor_id, layout.bucket_size, start,
+                                   end if end is not None else before)
+            return sum(row.count for row in self.fanout(query, buckets, lambda bucket: [sensor_id, bucket] + params))
+        return self.client.execute(self.prepare(query), [sensor_id] + params)[0].count
+
+    def recount(self, measurement, log=_LOGGER.info):
+        """
+        Set the point counters of a measurement from its rows.
+
+        Counters are corrected by the difference to the counted rows, so
+        this can run while points are written. A point written to a period
+        while it is being counted may be counted twice; running it again
+        corrects that.
+
+        :param log: Function logging the progress
+        :return: Number of counted points
+        """
+        layout = self.layout(measurement, refresh=True)
+        if layout.migrating:
+            raise ValueError('{} is being moved to buckets'.format(measurement))
+        if not self.table_exists(layout.table):
+            raise MeasurementNotFound('Table {} does not exist'.format(layout.table))
+        self.create_layout_tables()
+        query = 'SELECT DISTINCT sensor_id FROM "{}"'.format(layout.table)
+        if layout.bucket_size:
+            query = 'SELECT DISTINCT sensor_id, bucket FROM "{}"'.format(layout.table)
+        sensor_ids = sorted({row.sensor_id for row in self.client.execute(SimpleStatement(query, fetch_size=1000))})
+        query = 'SELECT time FROM "{}" WHERE sensor_id = ?'.format(layout.table)
+        total = 0
+        for sensor_id in sensor_ids:
+            if layout.bucket_size:
+                rows = self.fanout(query + ' AND bucket = ?',
+                                   self.buckets(measurement, sensor_id, layout.bucket_size),
+                                   lambda bucket: [sensor_id, bucket])
+            else:
+                statement = self.prepare(query).bind([sensor_id])
+                statement.fetch_size = 5000
+                rows = self.client.execute(statement)
+            counts = Counter(bucket_of(row.time, self.COUNT_BUCKET_SIZE) for row in rows)
+            total += sum(counts.values())
+            for row in self.client.execute(self.prepare(
+                    "SELECT bucket, points FROM point_counts WHERE measurement = ? AND sensor_id = ?"),
+                    [measurement, sensor_id]):
+                counts[row.bucket] -= row.points
+            self.add_counts(measurement, {(sensor_id, bucket): points
+                                          for bucket, points in counts.items() if points})
+        self.wait_writes()
+        self.set_counted(measurement)
+        log('{}: counted {} points of {} sensors'.format(measurement, total, len(sensor_ids)))
+        return total
+
+    def record_buckets(self, measurement, buckets):
+        """
+        List the buckets of sensors, each only once per process.
+
+        :param buckets: Set of (sensor_id, bucket) pairs
+        """
+        for sensor_id, bucket in buckets:
+            key = (measurement, sensor_id, bucket)
+            if key in self._known_buckets:
+                continue
+            if len(self._known_buckets) >= self.KNOWN_BUCKETS:
+                self._known_buckets.clear()
+            self._known_buckets.add(key)
+            self.execute_async(self.prepare(
+                "INSERT INTO measurement_buckets (measurement, sensor_id, bucket) VALUES (?, ?, ?)"),
+                [measurement, sensor_id, bucket])
+
+    def buckets(self, measurement, sensor_id, bucket_size, start=None, end=None, order='desc'):
+        """
+        Buckets of a sensor holding data between two times, in time order.
+
+        :param start: Naive UTC datetime or None
+        :param end: Naive UTC datetime or None
+        :param order: 'asc' or 'desc'
+        """
+        query = "SELECT bucket FROM measurement_buckets WHERE measurement = ? AND sensor_id = ?"
+        params = [measurement, sensor_id]
+        if start is not None:
+            query += " AND bucket >= ?"
+            params.append(bucket_of(start, bucket_size))
+        if end is not None:
+            query += " AND bucket <= ?"
+            params.append(bucket_of(end, bucket_size))
+        if order == 'asc':
+            query += " ORDER BY bucket ASC"
+        return [row.bucket for row in self.client.execute(self.prepare(query), params)]
+
+    def record_history_buckets(self, buckets):
+        """
+        List the buckets of history tables, each only once per process.
+
+        :param buckets: Set of (table, key, bucket) tuples
+        """
+        for table, key, bucket in buckets:
+            if (table, key, bucket) in self._known_buckets:
+                continue
+            if len(self._known_buckets) >= self.KNOWN_BUCKETS:
+                self._known_buckets.clear()
+            self._known_buckets.add((table, key, bucket))
+            self.execute_async(self.prepare(
+                "INSERT INTO history_buckets (table_name, key, bucket) VALUES (?, ?, ?)"), [table, key, bucket])
+
+    def history_buckets(self, table, key, bucket_size, start=None, end=None, order='desc'):
+        """
+        Buckets of a partition of a history table between two times, in time order.
+
+        :param key: Tag values of the partition, see `history_key`
+        """
+        query = "SELECT bucket FROM history_buckets WHERE table_name = ? AND key = ?"
+        params = [table, key]
+        if start is not None:
+            query += " AND bucket >= ?"
+            params.append(bucket_of(start, bucket_size))
+        if end is not None:
+            query += " AND bucket <= ?"
+            params.append(bucket_of(end, bucket_size))
+        if order == 'asc':
+            query += " ORDER BY bucket ASC"
+        return [row.bucket for row in self.client.execute(self.prepare(query), params)]
+
+    def fanout(self, query, buckets, params):
+        """
+        Run a query on several buckets, FANOUT at a time.
+
+        Rows are yielded bucket after bucket, in the order of `buckets`.
+        Queries of the following buckets are already running while the rows
+        of a bucket are read.
+
+        :param query: CQL query with placeholders
+        :param buckets: Buckets in the order to read them
+        :param params: Function returning the parameters of the query for a bucket
+        """
+        statement = self.prepare(query)
+        buckets = iter(buckets)
+        pending = deque()
+
+        def submit():
+            for bucket in buckets:
+                pending.append(self.client.execute_async(statement, params(bucket)))
+                return
+
+        for _ in range(self.FANOUT):
+            submit()
+        while pending:
+            future = pending.popleft()
+            submit()
+            for row in future.result():
+                yield row
+
+    def prepare(self, query):
+        """
+        Get a prepared statement for a query, preparing it on first use.
+
+        :param query: CQL query with ``?`` placeholders
+        """
+        statement = self._prepared.get(query)
+        if statement is None:
+            with self._prepare_lock:
+                statement = self._prepared.get(query)
+                if statement is None:
+                    _LOGGER.debug("Preparing: %s", query)
+                    statement = self.client.prepare(query)
+                    self._prepared[query] = statement
+        return statement
+
+    def insert_statement(self, table, columns, ttl=False):
+        """Prepared INSERT for a table and a tuple of columns, with a TTL as last value if `ttl`."""
+        return self.prepare("INSERT INTO {} ({}) VALUES ({}){}".format(
+            table, ', '.join(columns), ', '.join(['?'] * len(columns)), ' USING TTL ?' if ttl else ''))
+
+    def ttl(self, measurement, company_id, time, level='raw'):
+        """
+        TTL of a sensor reading or rollup row, see `Retention.expires`.
+
+        :param time: Naive UTC datetime of the row
+        :return: Seconds, None if it is kept forever, 0 or less if it has
+                 expired
+        """
+        ttl = self.retention.expires(measurement, company_id, time, level)
+        return min(ttl, self.MAX_TTL) if ttl is not None else None
+
+    def partition_key(self, table):
+        """
+        Names of the partition key columns of a table, from the cluster
+        metadata.
+
+        :return: Tuple of names, None if the table is not known
+        """
+        if table not in self._partition_keys:
+            try:
+                columns = self.cluster.metadata.keyspaces[self.keyspace].tables[table].partition_key
+                self._partition_keys[table] = tuple(column.name for column in columns)
+            except (AttributeError, KeyError):
+                return None
+        return self._partition_keys[table]
+
+    def execute_async(self, statement, parameters=None):
+        """
+        Execute a write without waiting for its result.
+
+        At most ``TSDB_MAX_INFLIGHT`` writes are pending at any time; further
+        writes block until one of them completes. Failed writes are logged.
+        """
+        with self._inflight_cond:
+            while self._inflight >= self.max_inflight:
+                self._inflight_cond.wait()
+            self._inflight += 1
+        try:
+            future = self.client.execute_async(statement, parameters)
+        except Exception:
+            self._write_done()
+            raise
+        future.add_callbacks(self._write_done, self._write_failed)
+        return future
+
+    def _write_done(self, *args):
+        with self._inflight_cond:
+            self._inflight -= 1
+            self._inflight_cond.notify_all()
+
+    def _write_failed(self, exc):
+        _LOGGER.error("Cassandra write failed: %s", exc)
+        self._write_done()
+
+    def wait_writes(self):
+        """Block until all pending asynchronous writes are done."""
+        with self._inflight_cond:
+            while self._inflight > 0:
+                self._inflight_cond.wait()
+
+    def flush(self):
+        super().flush()
+        self.wait_writes()
+
+    def close_buffer(self):
+        super().close_buffer()
+        self.wait_writes()
+
     def add_point(self, sensor, data, time=None):
         """
         Add new point to database.
@@ -52,25 +544,23 @@ class CassandraClient(TSDBClient):
         :return:
         """
         try:
-            if "last_update" in data.keys():
-                del data['last_update']
-
-            if "data_json" in data.keys():
-                data = data['data_json']
-            # self.client.write_points(json_body)
-            data["sensor_id"] = sensor.id
-            data["company_id"] = sensor.company_id
-            data["time"] = datetime.utcnow()
-            query = """
-                INSERT INTO {} ({})
-                VALUES ({})
-                """.format(sensor.type, ', '.join(data.keys()), ', '.join(["%s"] * len(data.keys())))
-            _LOGGER.debug(query)
-            self.client.execute(query, (data.values()))
+            self.write_point(sensor.type, self.sensor_point(sensor, data, time))
         except Exception as e:
             # TODO: Check for other Exceptions
             _LOGGER.error(e)
 
+    def add_points(self, sensor, rows):
+        """
+        Add several readings of one sensor as one unlogged batch.
+
+        :param sensor: Sensor
+        :param rows: List of data dicts
+        """
+        try:
+            self.write_points(sensor.type, [self.sensor_point(sensor, data) for data in rows])
+        except Exception as e:
+            _LOGGER.error(e)
+
     def add_series(self, measurement, tags, fields, time=None):
         """
         Add series to database
@@ -81,28 +571,116 @@ class CassandraClient(TSDBClient):
         :param fields: series data fields
         """
         try:
-            fields.update(tags)
-            fields['time'] = datetime.utcnow()
-
-            if time:
-                fields['time'] = time
-            query = """
-                INSERT INTO {} ({})
-                VALUES ({})
-                """.format(measurement, ', '.join(fields.keys()), ', '.join(["%s"] * len(fields.keys())))
-            _LOGGER.debug(query)
-            self.client.execute(query, (fields.values()))
+            self.write_point(measurement, {"tags": tags, "fields": dict(fields), "time": time})
         except Exception as e:
             # TODO: Check for other Exceptions
             _LOGGER.error(e)
 
+    def write_batch(self, measurement, points):
+        """
+        Write points of one measurement.
+
+        Points with the same columns and partition share one unlogged
+        batch, which Cassandra applies on a single replica set; rows of
+        other partitions are sent as separate asynchronous writes. Points
+        of a bucketed measurement get the bucket of their time. Sensor readings
+        get the TTL of their retention; those past it are dropped.
+
+        :param measurement: Measurement name
+        :param points: List of dicts with tags, fields and time
+        """
+        layout = self.layout(measurement)
+        targets = [(layout.table, layout.bucket_size)]
+        history = measurement in HISTORY_TABLES and layout.bucket_size
+        if history:
+            # Bucketed are the history tables, written along with the main one
+            targets = [(measurement, None)]
+        elif layout.migrating:
+            # Written to both tables until the old one is copied
+            targets.append((measurement, None))
+        groups = {}
+        buckets = set()
+        history_buckets = set()
+        counts = Counter()
+        for point in points:
+            row = dict(point['fields'])
+            row.update(point['tags'])
+            row['time'] = _to_datetime(point.get('time'))
+            ttl = None
+            if history:
+                for table, target, key in self.history_rows(measurement, row, layout.bucket_size):
+                    groups.setdefault((table, tuple(target.keys()), False), []).append(list(target.values()))
+                    history_buckets.add((table, key, target['bucket']))
+            if isinstance(row.get('sensor_id'), int):
+                # Sensor values, history series carry sensor UIDs
+                ttl = self.ttl(measurement, row.get('company_id'), row['time'])
+                if ttl is not None and ttl <= 0:
+                    continue
+                counts[(row['sensor_id'], bucket_of(row['time'], self.COUNT_BUCKET_SIZE))] += 1
+            for table, bucket_size in targets:
+                target = row
+                if bucket_size:
+                    target = dict(row, bucket=bucket_of(row['time'], bucket_size))
+                    if row.get('sensor_id') is not None:
+                        buckets.add((row['sensor_id'], target['bucket']))
+                values = list(target.values()) + ([ttl] if ttl is not None else [])
+                groups.setdefault((table, tuple(target.keys()), ttl is not None), []).append(values)
+        if buckets:
+            self.record_buckets(measurement, buckets)
+        if history_buckets:
+            self.record_history_buckets(history_buckets)
+        if counts:
+            self.add_counts(measurement, counts)
+        for (table, columns, ttl), rows in groups.items():
+            statement = self.insert_statement(table, columns, ttl)
+            for partition in self.partitions(table, columns, rows):
+                if len(partition) == 1:
+                    self.execute_async(statement, partition[0])
+                    continue
+                batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                for row in partition:
+                    batch.add(statement, row)
+                self.execute_async(batch)
+
+    def partitions(self, table, columns, rows):
+        """
+        Split rows of a table by their partition.
+
+        :param columns: Column names of the values of the rows
+        :return: List of lists of rows; rows of a table of unknown partition
+                 key are each on their own
+        """
+        key = self.partition_key(table)
+        if not key or any(name not in columns for name in key):
+            return [[row] for row in rows]
+        indexes = [columns.index(name) for name in key]
+        partitions = {}
+        for row in rows:
+            partitions.setdefault(tuple(row[i] for i in indexes), []).append(row)
+        return list(partitions.values())
+
     def get_points(self, sensor, limit=5000, order_by=None, start_date=None, end_date=None,
-                   duration=None, offset=0, function=None, group_duration=None, aggregate_only=False, value_fields=None):
+                   duration=None, offset=0, function=None, group_duration=None, aggregate_only=False, value_fields=None,
+                   aggregate_function=None, offset_interval=None, cursor=None, total=None, include=None):
         """
         Get time series data for sensor.
 
+        Ungrouped pages come with a ``next`` cursor. A page requested with a
+        cursor is read from the time it points at, so it costs the same
+        however deep it is; its ``total`` is None as it is not counted again.
+        The ``total`` of other pages comes from the point counters, see
+        `total`.
+
+        Grouped data is resampled here, see `group`.
+
+        :param cursor: Cursor of the page, from the ``next`` of the previous one
+        :param total: TOTAL_ESTIMATE for an estimated ``total``, TOTAL_NONE for none
+        :param include: HISTORY_PARTS to compute, all by default; the others
+                        are None. There is no ``aggregate``.
         :param aggregate_only: Get only aggregated data
         :param group_duration: Group duration
+        :param aggregate_function: MEAN, SUM, MIN, MAX or COUNT of the groups
+        :param offset_interval: Offset of the groups
         :param offset: Result offset
         :param end_date: End Date for date filter
         :param start_date: Start Date for date filter
@@ -112,96 +690,280 @@ class CassandraClient(TSDBClient):
         :param sensor: Sensor
         :return: List of time series data.
         """
-        # duration = '1d'
-        group_by_clause = None
-        order_by_clause = None
+        order = 'asc' if order_by and not order_by.strip().lower().endswith('desc') else 'desc'
+        parts = set(HISTORY_PARTS if include is None else include)
+        if group_duration and not aggregate_only:
+            if 'data' not in parts:
+                return {'data': None, 'total': None, 'next': None}
+            resampler = self.group(sensor, group_duration, offset_interval, aggregate_function, start_date, end_date,
+                                   value_fields)
+            return {'data': resampler.rows(order == 'desc', offset, limit),
+                    'total': resampler.count if total != TOTAL_NONE and 'total' in parts else None, 'next': None}
 
-        select_clause_min_max = "SELECT MIN(*), MAX(*), MEAN(*)"
         select_clause = "SELECT * "
         if value_fields:
             select_clause = "SELECT {}, time ".format(', '.join(list(value_fields.keys())))
-        select_clause_count = "SELECT COUNT(*)"
-
-        # if (duration or start_date or end_date) and group_duration:
-        #     select_clause = "SELECT MEAN(*)"
-        #     group_by_clause = "GROUP BY time({})".format(group_duration)
-        from_clause = 'FROM "{}"'.format(sensor.type)
-        where_clause = 'WHERE sensor_id = {} '.format(sensor.id)
-        # TODO: Add time duration support
-        # if duration:
-        if False:
-            where_clause += ' AND time >= now() - ' + duration
-        else:
-            if start_date:
-                where_clause += ' AND time >= \'' + start_date + '\''
-            if end_date:
-                where_clause += ' AND time <= \'' + end_date + '\''
-        # if order_by:
-        #     order_by_clause = 'ORDER BY ' + order_by
-        limit_clause = 'LIMIT {}'.format(limit + offset)
-        # offset_clause = 'OFFSET {}'.format(offset)
-
-        # TODO: Aggregate Data Query
-        min_max_clauses = [select_clause_min_max, from_clause, where_clause, order_by_clause]
-        min_max_query = " ".join(filter(None, min_max_clauses))
+        table, bucket_size, where_clause, params, start, end = self.reading_range(sensor, start_date, end_date)
+        from_clause = 'FROM "{}"'.format(table)
+        order_by_clause = 'ORDER BY time ASC' if order == 'asc' else None
+        after = None
+        if cursor is not None and not aggregate_only:
+            after = page_cursor(cursor, order)
+            where_clause += ' AND time {} ?'.format('<=' if order == 'desc' else '>=')
+            params.append(_to_datetime(after[0]))
+            if order == 'desc':
+                end = params[-1]
+            else:
+                start = params[-1]
+        skip = after[1] if after is not None else offset
+        buckets = None
+        if bucket_size:
+            buckets = self.buckets(sensor.type, sensor.id, bucket_size, start, end, order)
+
         # TODO: Include Aggregate data to normal request also
         if aggregate_only:
-            min_max_result = self.client.execute(min_max_query)
-            return list(min_max_result.get_points())[0]
-
-        # count_clauses = [select_clause_count, from_clause, where_clause, group_by_clause, order_by_clause, limit_clause, offset_clause]
-        count_clauses = [select_clause_count, from_clause, where_clause, order_by_clause]
-        all_clauses = [select_clause, from_clause, where_clause, group_by_clause, order_by_clause, limit_clause]
-        paginate_clauses = [select_clause, from_clause, where_clause, group_by_clause, order_by_clause]
-
-        base_query = " ".join(filter(None, all_clauses))
-        base_count_query = " ".join(filter(None, count_clauses))
-        paginate_query = " ".join(filter(None, paginate_clauses))
-
-        _LOGGER.info(min_max_query)
-        _LOGGER.info(base_query)
-        _LOGGER.info(base_count_query)
-        _LOGGER.info(paginate_query)
-
-        # result = self.client.query(base_query+";"+base_count_query)
-        # TODO: Pagination Support
-        # points = self.client.execute(base_query)
-        count_result = self.client.execute(base_count_query)
-        # points = list(result[0].get_points())
-        # count_result = result[1]
-
-        statement = SimpleStatement(paginate_query, fetch_size=1000)
-        count = 0
+            return self.aggregate(table, where_clause, params, buckets)
+
+        query = " ".join(filter(None, [select_clause, from_clause, where_clause, order_by_clause])) + ' LIMIT ?'
+        _LOGGER.info(query)
+        count = None
+        if after is None and total != TOTAL_NONE and 'total' in parts:
+            count = self.total(sensor.type, sensor.id, start, end, estimate=total == TOTAL_ESTIMATE)
+        if 'data' not in parts:
+            return {'data': None, 'total': count, 'next': None}
+
+        if bucket_size:
+            rows = self.fanout(query, buckets, lambda bucket: params[:1] + [bucket] + params[1:] + [skip + limit])
+        else:
+            statement = self.prepare(query).bind(params + [skip + limit])
+            statement.fetch_size = 1000
+            rows = self.client.execute(statement)
         data = []
-        index = 0
-        count = count_result[0].count
-        for row in self.client.execute(statement):
-            index += 1
-            if group_duration or (offset < index < offset + limit + 1):
+        for index, row in enumerate(rows):
+            if index >= skip + limit:
+                break
+            if index >= skip:
+                d = row._asdict()
+                d.pop('bucket', None)
+                d['time'] = str(d['time'].replace(tzinfo=timezone.utc))
+                data.append(d)
+        next_cursor = None
+        if data and len(data) == limit:
+            next_cursor = time_cursor(data, order, after)
+        return {'data': data, 'total': count, 'next': next_cursor}
+
+    def reading_range(self, sensor, start_date=None, end_date=None):
+        """
+        Table and WHERE clause of the readings of a sensor between two times.
+
+        In a bucketed layout the clause has a placeholder for the bucket
+        after the sensor; it is not in the parameters.
+
+        :param start_date: Start time or None
+        :param end_date: End time, inclusive, or None
+        :return: Table, bucket size (None if unbucketed), WHERE clause, its
+                 parameters, and the start and end as naive UTC datetimes
+        """
+        layout = self.layout(sensor.type)
+        bucketed = bool(layout.bucket_size) and not layout.migrating
+        where_clause = 'WHERE sensor_id = ? '
+        if bucketed:
+            where_clause += 'AND bucket = ? '
+        params = [sensor.id]
+        start = end = None
+        if start_date:
+            where_clause += ' AND time >= ?'
+            start = _to_datetime(start_date)
+            params.append(start)
+        if end_date:
+            where_clause += ' AND time <= ?'
+            end = _to_datetime(end_date)
+            params.append(end)
+        # Read from the old table until a move to buckets is done
+        return (layout.table if bucketed else sensor.type, layout.bucket_size if bucketed else None, where_clause,
+                params, start, end)
+
+    def group(self, sensor, group_duration, offset_interval=None, function=None, start_date=None, end_date=None,
+              value_fields=None):
+        """
+        Resample the readings of a sensor, as InfluxDB ``GROUP BY time()`` does.
+
+        Rows are streamed in chunks of RESAMPLE_CHUNK into a `Resampler`, so
+        only one chunk and the buckets are held in memory. Groups made of
+        whole rollup intervals are read from the rollup as far as it is
+        complete, see `rollup_for`; the range is then widened to whole
+        intervals.
+
+        :param function: MEAN, SUM, MIN, MAX or COUNT of the groups
+        :return: Resampler holding the groups
+        """
+        table, bucket_size, where_clause, params, start, end = self.reading_range(sensor, start_date, end_date)
+        select_clause = "SELECT * "
+        if value_fields:
+            select_clause = "SELECT {}, time ".format(', '.join(list(value_fields.keys())))
+        query = '{}FROM "{}" {}'.format(select_clause, table, where_clause)
+        rollup = self.rollup_for(sensor.type, group_duration, offset_interval, start, sensor.company_id)
+        read_start = start
+        if rollup is not None:
+            # Readings before the end of the rollup are read from it
+            read_start = params[1] = max(start, rollup[1])
+        if bucket_size:
+            rows = self.fanout(query, self.buckets(sensor.type, sensor.id, bucket_size, read_start, end),
+                               lambda bucket: params[:1] + [bucket] + params[1:])
+        else:
+            statement = self.prepare(query).bind(params)
+            statement.fetch_size = self.RESAMPLE_CHUNK
+            rows = self.client.execute(statement)
+        if start is not None and end is None:
+            end = datetime.utcnow()
+        resampler = Resampler(group_duration, offset_interval, function,
+                              _to_micros(start) if start is not None else None,
+                              _to_micros(end) if end is not None else None)
+        if rollup is not None:
+            resolution, done = rollup
+            rollup_rows = self.rollup_rows(sensor.id, resolution, _floor(start, resolution),
+                                           min(done, end + timedelta(microseconds=1)))
+            for chunk in _time_chunks(rollup_rows, self.RESAMPLE_CHUNK):
+                resampler.add_rollup(*_rollup_columns(chunk))
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, self.RESAMPLE_CHUNK))
+            if not chunk:
+                break
+            resampler.add(*_columns(chunk))
+        return resampler
+
+    def get_stats(self, sensor, start_date, end_date, group_duration, offset_interval=None, value_fields=None):
+        """
+        Count, sum, minimum and maximum of each field of a sensor per group,
+        all read in one pass, see `TSDBClient.get_stats`.
+        """
+        resampler = self.group(sensor, group_duration, offset_interval, None, start_date, end_date, value_fields)
+        return {time: {name: dict(zip(STATS, values[:4])) for name, values in fields.items()}
+                for time, fields in resampler.intervals()}
+
+    def aggregate(self, table, where_clause, params, buckets=None):
+        """
+        MIN, MAX, MEAN, COUNT and SUM of each value column of a sensor.
+
+        The statistics are computed by Cassandra per partition, one query
+        per bucket in a bucketed layout, and merged here.
+
+        :param where_clause: WHERE clause of the sensor and time range
+        :param params: Parameters of the clause, without the bucket
+        :param buckets: Buckets to read, None for an unbucketed table
+        :return: Aggregate row shaped like the InfluxDB one, None without points
+        """
+        names = self.value_columns(table)
+        if not names:
+            return None
+        # In the order of STATS
+        query = 'SELECT {} FROM "{}" {}'.format(
+            ', '.join('COUNT("{0}"), SUM("{0}"), MIN("{0}"), MAX("{0}")'.format(name) for name in names),
+            table, where_clause)
+        if buckets is None:
+            rows = self.client.execute(self.prepare(query), params)
+        else:
+            rows = self.fanout(query, buckets, lambda bucket: params[:1] + [bucket] + params[1:])
+        return stats_aggregate({name: dict(zip(STATS, row[4 * i:4 * i + 4])) for i, name in enumerate(names)}
+                               for row in rows)
+
+    def value_columns(self, table):
+        """Names of the numeric value columns of a table, from the cluster metadata"""
+        try:
+            columns = self.cluster.metadata.keyspaces[self.keyspace].tables[table].columns
+        except (AttributeError, KeyError):
+            return []
+        return [name for name, column in columns.items()
+                if column.cql_type == 'double' and name not in ('company_id', 'sensor_id', 'bucket')]
+
+    def history_rows(self, measurement, row, bucket_size):
+        """
+        Rows of the history tables for a row of a history series.
+
+        Tables partitioned by a tag the row does not have are skipped.
+
+        :return: List of (table, row, key) tuples
+        """
+        rows = []
+        for keys in HISTORY_TABLES[measurement]:
+            if any(row.get(key) is None for key in keys):
+                continue
+            rows.append((history_table(measurement, keys), dict(row, bucket=bucket_of(row['time'], bucket_size)),
+                         history_key(row, keys)))
+        return rows
+
+    def history(self, measurement, keys, tags, limit=500, order='desc', start=None, end=None, offset=0,
+                count_only=False, cursor=None, total=None):
+        """
+        Read a history series from its table partitioned by `keys`.
+
+        Pages come with a ``next`` cursor. A page requested with a cursor is
+        read from the time it points at and has no ``total``.
+
+        :param keys: Tags the table is partitioned by, which are all the tags
+                     of the query
+        :param start: Naive UTC datetime or None
+        :param end: Naive UTC datetime or None
+        """
+        table = history_table(measurement, keys)
+        bucket_size = self.layout(measurement).bucket_size
+        after = None
+        if cursor is not None and not count_only:
+            after = page_cursor(cursor, order)
+            if order == 'desc':
+                end = _to_datetime(after[0])
+            else:
+                start = _to_datetime(after[0])
+        where = ' AND '.join('{} = ?'.format(key) for key in keys) + ' AND bucket = ?'
+        params = []
+        if start is not None:
+            where += ' AND time >= ?'
+            params.append(start)
+        if end is not None:
+            where += ' AND time <= ?'
+            params.append(end)
+        buckets = self.history_buckets(table, history_key(tags, keys), bucket_size, start, end, order)
+
+        def bucket_params(bucket, *extra):
+            return [tags[key] for key in keys] + [bucket] + params + list(extra)
+        count = None
+        if after is None and (count_only or total != TOTAL_NONE):
+            count = sum(row.count for row in self.fanout(
+                'SELECT COUNT(*) FROM {} WHERE {}'.format(table, where), buckets, bucket_params))
+        if count_only:
+            return {'data': [], 'total': count, 'next': None}
+        skip = after[1] if after is not None else offset
+        query = 'SELECT * FROM {} WHERE {}{} LIMIT ?'.format(table, where, ' ORDER BY time ASC' if order == 'asc' else '')
+        data = []
+        for index, row in enumerate(self.fanout(query, buckets, lambda bucket: bucket_params(bucket, skip + limit))):
+            if index >= skip + limit:
+                break
+            if index >= skip:
                 d = row._asdict()
+                d.pop('bucket', None)
                 d['time'] = str(d['time'].replace(tzinfo=timezone.utc))
                 data.append(d)
-        # TODO: Get all data for grouping
-        if group_duration and len(data) > 0:
-            group_duration = group_duration.replace('ms', 'S')
-            group_duration = group_duration.replace('m', 'T')
-            group_duration = group_duration.replace('s', 'S')
-            r = pd.DataFrame(data)
-            r = r.set_index('time')
-            r.index = pd.to_datetime(r.index)
-            print(r)
-            a = r.resample(group_duration).mean().fillna('null')
-            # TODO: Time Format
-            a['time'] = a.index.strftime("%Y-%m-%dT%H:%M:%SZ")
-            data = a.to_dict('records')
-            count = len(data)
-        return {'data': data, 'total': count}
+        next_cursor = None
+        if data and len(data) == limit:
+            next_cursor = time_cursor(data, order, after)
+        return {'data': data, 'total': count, 'next': next_cursor}
 
     def get_points_raw(self, measurement, tags=None, fields=None, limit=500, order_by=None, start_date=None,
-                       end_date=None, duration=None, offset=0, count_only=False, group_by=None):
+                       end_date=None, duration=None, offset=0, count_only=False, group_by=None, cursor=None,
+                       total=None):
         """
         Get time series data for sensor.
 
+        History series filtered by the tags of one of their HISTORY_TABLES
+        are read from that table, see `history`. Other queries filter the
+        main table. Their pages are read with the paging state of the
+        driver: the first page and pages requested with a cursor come with a
+        ``next`` cursor, which resumes the query where the page ended. Pages
+        requested with a cursor have no ``total``.
+
+        :param cursor: Cursor of the page, from the ``next`` of the previous one
+        :param total: TOTAL_NONE to skip the count query, leaving ``total`` None
         :param group_by: Group By data
         :param count_only: Count only query
         :param offset: Result offset
@@ -219,23 +981,35 @@ class CassandraClient(TSDBClient):
         if isinstance(measurement, list):
             return {'data': [], 'total': 0}
         else:
-            from_clause += measurement
+            layout = self.layout(measurement)
+            from_clause += layout.table if not layout.migrating else measurement
+        if duration:
+            start_date = datetime.utcnow() - timedelta(microseconds=parse_duration(duration))
+        keys = next((table_keys for table_keys in HISTORY_TABLES.get(measurement, ())
+                     if set(table_keys) == set(tags or ())), None)
+        if keys and layout.bucket_size and not layout.migrating:
+            order = 'asc' if order_by and not order_by.strip().lower().endswith('desc') else 'desc'
+            return self.history(measurement, keys, tags, limit, order,
+                                _to_datetime(start_date) if start_date else None,
+                                _to_datetime(end_date) if end_date else None,
+                                offset, count_only, cursor, total)
         query = 'SELECT * {} '.format(from_clause)
         count_query = 'SELECT COUNT(*) {} '.format(from_clause)
         where_query = ''
         where_parts = []
+        params = []
         if tags:
             checks = []
             for key in tags.keys():
-                if type(tags[key]) == str:
-                    checks.append(" {} = '{}' ".format(key, tags[key]))
-                else:
-                    checks.append(" {} = {} ".format(key, tags[key]))
+                checks.append(" {} = ? ".format(key))
+                params.append(tags[key])
             where_parts.append(' AND '.join(checks))
         if start_date:
-            where_parts.append(' time >= \'' + start_date + '\'')
+            where_parts.append(' time >= ?')
+            params.append(_to_datetime(start_date))
         if end_date:
-            where_parts.append(' time <= \'' + end_date + '\'')
+            where_parts.append(' time <= ?')
+            params.append(_to_datetime(end_date))
         if len(where_parts) > 0:
             where_query = ' WHERE '
             where_query += ' AND '.join(where_parts)
@@ -243,34 +1017,66 @@ class CassandraClient(TSDBClient):
         count_query += where_query
         count_query += " ALLOW FILTERING"
         _LOGGER.debug(count_query)
-        # TODO: Add exception handling
-        count_result = self.client.execute(count_query)
-
-        total_count = 0
+        paging_state = None
+        if cursor is not None:
+            try:
+                paging_state = base64.b64decode(decode_cursor(cursor)['p'])
+            except (KeyError, TypeError, ValueError):
+                raise InvalidCursor(cursor)
+        total_count = None
+        if cursor is None and (count_only or total != TOTAL_NONE):
+            # TODO: Add exception handling
+            total_count = self.client.execute(self.prepare(count_query), params)[0].count
         data = []
-        total_count = count_result[0].count
+        next_cursor = None
         if count_only:
             data = []
+        elif cursor is not None or not offset:
+            paginate_query = query + where_query + " ALLOW FILTERING"
+            statement = self.prepare(paginate_query).bind(params)
+            statement.fetch_size = limit
+            result = self.client.execute(statement, paging_state=paging_state)
+            for row in result.current_rows:
+                d = row._asdict()
+                d.pop('bucket', None)
+                d['time'] = str(d['time'].replace(tzinfo=timezone.utc))
+                data.append(d)
+            if result.paging_state is not None:
+                next_cursor = encode_cursor(p=base64.b64encode(result.paging_state).decode('ascii'))
         else:
             paginate_query = query + where_query + " ALLOW FILTERING"
-            statement = SimpleStatement(paginate_query, fetch_size=1000)
+            statement = self.prepare(paginate_query).bind(params)
+            statement.fetch_size = 1000
             data = []
             index = 0
             for row in self.client.execute(statement):
                 index += 1
                 if offset < index < offset + limit + 1:
                     d = row._asdict()
+                    d.pop('bucket', None)
                     d['time'] = str(d['time'].replace(tzinfo=timezone.utc))
                     data.append(d)
-        return {'data': data, 'total': total_count}
+        return {'data': data, 'total': total_count, 'next': next_cursor}
 
     def delete_measurement(self, measurement):
         """Delete a measurement."""
         return
 
     def create_sensor(self, sensor_type, value_fields):
-        """Create a new table for each sensor type"""
+        """
+        Create a new table for each sensor type.
+
+        New tables are bucketed by the TSDB_BUCKET_SIZES of the type or by
+        TSDB_BUCKET_SIZE, and their points are counted from the start;
+        existing tables keep their layout.
+        """
         create_cmd = "CREATE TABLE IF NOT EXISTS {} ( company_id int, sensor_id int, {}, time timestamp, PRIMARY KEY (sensor_id, time)) WITH CLUSTERING ORDER BY (time DESC)"
+        bucket_size = self.bucket_sizes.get(sensor_type, self.bucket_size)
+        new = not self.table_exists(sensor_type)
+        if bucket_size and new:
+            create_cmd = "CREATE TABLE IF NOT EXISTS {} ( company_id int, sensor_id int, bucket int, {}, time timestamp, PRIMARY KEY ((sensor_id, bucket), time)) WITH CLUSTERING ORDER BY (time DESC)"
+        else:
+            bucket_size = None
         columns = []
         for name in value_fields.keys():
             columns.append("{} {}".format(name, get_cassandra_data_type(value_fields[name]['type'])))
@@ -278,10 +1084,337 @@ class CassandraClient(TSDBClient):
             cmd = create_cmd.format(sensor_type, ", ".join(columns))
             _LOGGER.debug(cmd)
             self.client.execute(cmd)
+            if new:
+                self.create_layout_tables()
+                self.set_counted(sensor_type)
+            if bucket_size:
+                self.set_layout(sensor_type, sensor_type, bucket_size, LAYOUT_READY)
         except Exception as e:
             # TODO: Check for other Exceptions
             _LOGGER.error(e)
 
+    def rollup_state(self, measurement, refresh=False):
+        """
+        Ranges the rollups of a measurement are complete for, cached for
+        LAYOUT_CACHE_TTL seconds.
+
+        :return: Dict of resolutions and (since, done) pairs of naive UTC
+                 datetimes, the start of the first and of the next interval
+                 to roll up
+        """
+        cached = self._rollup_states.get(measurement)
+        if cached is not None and not refresh and cached[1] > _time.monotonic():
+            return cached[0]
+        try:
+            state = {row.resolution: (row.since, row.done) for row in self.client.execute(self.prepare(
+                "SELECT resolution, since, done FROM rollup_state WHERE measurement = ?"), [measurement])}
+        except Exception as e:
+            # No rollup_state table before `snms db prepare` or `snms db rollup-tsdb`
+            _LOGGER.debug(e)
+            state = {}
+        self._rollup_states[measurement] = (state, _time.monotonic() + self.LAYOUT_CACHE_TTL)
+        return state
+
+    def set_rollup_state(self, measurement, resolution, since, done):
+        self.client.execute(self.prepare("INSERT INTO rollup_state (measurement, resolution, since, done) "
+                                         "VALUES (?, ?, ?, ?)"), [measurement, resolution, since, done])
+        self._rollup_states.pop(measurement, None)
+
+    def rollup_for(self, measurement, group_duration, offset_interval, start, company_id=None):
+        """
+        Rollup to read the groups of a query from.
+
+        :param start: Naive UTC datetime the query starts at
+        :param company_id: Company of the sensor, for the retention of the
+                           rollup
+        :return: Resolution and end of the coarsest rollup whose intervals
+                 make up the groups and which is complete from `start` on,
+                 or None
+        """
+        if not self.rollups or start is None:
+            return None
+        resolution = rollup_resolution(group_duration, offset_interval)
+        if resolution is None:
+            return None
+        since, done = self.rollup_state(measurement).get(resolution, (None, None))
+        if since is None or since > _floor(start, resolution) or done <= start:
+            return None
+        if not self.retention.covers(measurement, company_id, ROLLUP_NAMES[resolution], _floor(start, resolution)):
+            return None
+        return resolution, done
+
+    def rollup_rows(self, sensor_id, resolution, start, stop):
+        """Rows of a rollup of a sensor, for the intervals from `start` to before `stop`, in time order"""
+        size = resolution * self.ROLLUP_PARTITION
+        buckets = range(bucket_of(start, size), bucket_of(stop - timedelta(microseconds=1), size) + 1)
+        return self.fanout("SELECT time, field, count, sum, min, max, last FROM rollups WHERE sensor_id = ? "
+                           "AND resolution = ? AND bucket = ? AND time >= ? AND time < ?", buckets,
+                           lambda bucket: [sensor_id, resolution, bucket, start, stop])
+
+    def sensor_rows(self, measurement, sensor_id, start, stop):
+        """Readings of a sensor from `start` to before `stop`"""
+        layout = self.layout(measurement)
+        bucketed = bool(layout.bucket_size) and not layout.migrating
+        query = 'SELECT * FROM "{}" WHERE sensor_id = ?'.format(layout.table if bucketed else measurement)
+        if bucketed:
+            return self.fanout(query + ' AND bucket = ? AND time >= ? AND time < ?',
+                               self.buckets(measurement, sensor_id, layout.bucket_size, start, stop, 'asc'),
+                               lambda bucket: [sensor_id, bucket, start, stop])
+        statement = self.prepare(query + ' AND time >= ? AND time < ?').bind([sensor_id, start, stop])
+        statement.fetch_size = self.RESAMPLE_CHUNK
+        return self.client.execute(statement)
+
+    def rollup(self, measurement, resolution, start, stop, sensors, companies=None):
+        """
+        Roll up the readings of sensors for the intervals from `start` to
+        before `stop`.
+
+        The finest rollup is computed from the readings, the others from the
+        next finer rollup, which has to be complete for the range. Rows get
+        the TTL of the retention of the rollup; expired ones are skipped.
+
+        :param resolution: One of ROLLUP_RESOLUTIONS
+        :param start: Naive UTC datetime at the start of an interval
+        :param stop: Naive UTC datetime at the start of an interval
+        :param sensors: IDs of the sensors
+        :param companies: Dict of sensor IDs and company IDs
+        :return: Number of written rows
+        """
+        level = ROLLUP_RESOLUTIONS.index(resolution)
+        size = resolution * self.ROLLUP_PARTITION
+        columns = ('sensor_id', 'resolution', 'bucket', 'time', 'field', 'count', 'sum', 'min', 'max', 'last')
+        insert = self.insert_statement('rollups', columns)
+        insert_ttl = self.insert_statement('rollups', columns, ttl=True)
+        companies = companies or {}
+        written = 0
+        for sensor_id in sensors:
+            resampler = Resampler('{}s'.format(resolution), start=_to_micros(start), end=_to_micros(stop) - 1)
+            if level:
+                rows = self.rollup_rows(sensor_id, ROLLUP_RESOLUTIONS[level - 1], start, stop)
+                for chunk in _time_chunks(rows, self.RESAMPLE_CHUNK):
+                    resampler.add_rollup(*_rollup_columns(chunk))
+            else:
+                rows = iter(self.sensor_rows(measurement, sensor_id, start, stop))
+                while True:
+                    chunk = list(islice(rows, self.RESAMPLE_CHUNK))
+                    if not chunk:
+                        break
+                    resampler.add(*_columns(chunk))
+            for micros, fields in resampler.intervals():
+                time = _EPOCH + timedelta(microseconds=micros)
+                ttl = self.ttl(measurement, companies.get(sensor_id), time, ROLLUP_NAMES[resolution])
+                if ttl is not None and ttl <= 0:
+                    continue
+                for name, values in fields.items():
+                    row = [sensor_id, resolution, bucket_of(time, size), time, name] + list(values)
+                    if ttl is None:
+                        self.execute_async(insert, row)
+                    else:
+                        self.execute_async(insert_ttl, row + [ttl])
+                    written += 1
+        self.wait_writes()
+        return written
+
+    def update_rollups(self, measurement, sensors, now=None, companies=None):
+        """
+        Roll up the intervals closed since the last update, finest first.
+
+        Intervals are rolled up ROLLUP_GRACE seconds after they end, so that
+        late readings are included. The first update only starts the
+        rollups with the next interval; older readings are rolled up by
+        `backfill_rollups`.
+
+        :param sensors: Dict of sensor IDs and the naive UTC datetime of
+                        their last reading. Sensors whose last reading
+                        is before the intervals are skipped.
+        :param now: Naive UTC datetime, the current time by default
+        :param companies: Dict of sensor IDs and company IDs
+        """
+        now = now or datetime.utcnow()
+        state = self.rollup_state(measurement, refresh=True)
+        for resolution in ROLLUP_RESOLUTIONS:
+            stop = _floor(now - timedelta(seconds=self.ROLLUP_GRACE), resolution)
+            if resolution not in state:
+                start = stop + timedelta(seconds=resolution)
+                self.set_rollup_state(measurement, resolution, start, start)
+                continue
+            since, start = state[resolution]
+            if start >= stop:
+                continue
+            active = [sensor_id for sensor_id, last in sensors.items() if last is not None and last >= start]
+            self.rollup(measurement, resolution, start, stop, active, companies)
+            self.set_rollup_state(measurement, resolution, since, stop)
+
+    def backfill_rollups(self, measurement, sensors, start, log=_LOGGER.info, companies=None):
+        """
+        Roll up the readings of sensors from `start` until where
+        `update_rollups` started.
+
+        :param sensors: IDs of the sensors
+        :param start: Naive UTC datetime
+        :param log: Function logging the progress
+        :param companies: Dict of sensor IDs and company IDs
+        :return: Number of written rows
+        """
+        self.create_layout_tables()
+        state = self.rollup_state(measurement, refresh=True)
+        now = datetime.utcnow()
+        total = 0
+        for resolution in ROLLUP_RESOLUTIONS:
+            first = _floor(start, resolution)
+            stop = _floor(now - timedelta(seconds=self.ROLLUP_GRACE), resolution)
+            since, done = state.get(resolution, (stop, stop))
+            if since > stop:
+                # Updates start with an interval which is not closed yet
+                since = done = stop
+            if first < since:
+                written = self.rollup(measurement, resolution, first, since, sensors, companies)
+                total += written
+                log('{}: {} rollup: {} rows of {} sensors'.format(measurement, ROLLUP_NAMES[resolution], written,
+                                                                  len(sensors)))
+                since = first
+            self.set_rollup_state(measurement, resolution, since, done)
+        return total
+
+    def expire(self, measurement, sensors, now=None):
+        """
+        Drop the point counters and bucket lists of sensors for the hours
+        and buckets whose readings have all expired.
+
+        Readings and rollups expire by their TTL; their counters would still
+        count them.
+
+        :param sensors: Dict of sensor IDs and company IDs
+        :param now: Naive UTC datetime, the current time by default
+        """
+        now = now or datetime.utcnow()
+        layout = self.layout(measurement)
+        counters = self.prepare("SELECT bucket FROM point_counts WHERE measurement = ? AND sensor_id = ? "
+                                "AND bucket < ?")
+        delete_counter = self.prepare("DELETE FROM point_counts WHERE measurement = ? AND sensor_id = ? "
+                                      "AND bucket = ?")
+        delete_buckets = self.prepare("DELETE FROM measurement_buckets WHERE measurement = ? AND sensor_id = ? "
+                                      "AND bucket < ?")
+        for sensor_id, company_id in sensors.items():
+            seconds = self.retention.seconds(measurement, company_id)
+            if not seconds:
+                continue
+            cutoff = now - timedelta(seconds=seconds)
+            # Hours and buckets ending before the cutoff
+            for row in self.client.execute(counters, [measurement, sensor_id,
+                                                      bucket_of(cutoff, self.COUNT_BUCKET_SIZE)]):
+                self.execute_async(delete_counter, [measurement, sensor_id, row.bucket])
+            if layout.bucket_size:
+                self.execute_async(delete_buckets, [measurement, sensor_id, bucket_of(cutoff, layout.bucket_size)])
+        self.wait_writes()
+
+    def table_exists(self, table):
+        """Check if a table exists in the keyspace."""
+        return table.lower() in self.cluster.metadata.keyspaces[self.keyspace].tables
+
+    def migrate_to_buckets(self, measurement, bucket_size, drop=False, log=_LOGGER.info):
+        """
+        Move a measurement to the bucketed layout while it is in use.
+
+        A bucketed copy of the table is created and written to along with
+        the old table. Once writers use both, the old rows are copied, and
+        then readers switch to the new table. An interrupted migration is
+        resumed by running it again.
+
+        :param bucket_size: Seconds per bucket
+        :param drop: Drop the old table once readers have switched
+        :param log: Function logging the progress
+        :return: Number of copied rows, None if the measurement is already bucketed
+        """
+        layout = self.layout(measurement, refresh=True)
+        if layout.bucket_size and not layout.migrating:
+            return None
+        if not self.table_exists(measurement):
+            raise MeasurementNotFound('Table {} does not exist'.format(measurement))
+        if layout.migrating:
+            table, bucket_size = layout.table, layout.bucket_size
+        else:
+            table = '{}_bucketed'.format(measurement)
+        source = self.cluster.metadata.keyspaces[self.keyspace].tables[measurement.lower()]
+        columns = ["{} {}".format(column.name, column.cql_type) for column in source.columns.values()
+                   if column.name != 'bucket']
+        self.client.execute("CREATE TABLE IF NOT EXISTS {} ({}, bucket int, PRIMARY KEY ((sensor_id, bucket), time)) "
+                            "WITH CLUSTERING ORDER BY (time DESC)".format(table, ", ".join(columns)))
+        self.create_layout_tables()
+        self.set_layout(measurement, table, bucket_size, LAYOUT_MIGRATING)
+        log('{}: writing to {} and {}, waiting {}s for all writers'.format(
+            measurement, measurement, table, self.LAYOUT_CACHE_TTL))
+        _time.sleep(self.LAYOUT_CACHE_TTL)
+
+        statement = SimpleStatement('SELECT * FROM {}'.format(measurement), fetch_size=1000)
+        copied = 0
+        for row in self.client.execute(statement):
+            values = row._asdict()
+            values['bucket'] = bucket_of(values['time'], bucket_size)
+            ttl = self.ttl(measurement, values.get('company_id'), values['time'])
+            if ttl is not None and ttl <= 0:
+                continue
+            self.execute_async(self.insert_statement(table, tuple(values.keys()), ttl is not None),
+                               list(values.values()) + ([ttl] if ttl is not None else []))
+            self.record_buckets(measurement, [(values['sensor_id'], values['bucket'])])
+            copied += 1
+            if copied % 100000 == 0:
+                log('{}: copied {} rows'.format(measurement, copied))
+        self.wait_writes()
+        self.set_layout(measurement, table, bucket_size, LAYOUT_READY)
+        log('{}: copied {} rows, reading from {}'.format(measurement, copied, table))
+        if drop:
+            _time.sleep(self.LAYOUT_CACHE_TTL)
+            self.client.execute('DROP TABLE IF EXISTS {}'.format(measurement))
+            log('{}: dropped the old table'.format(measurement))
+        return copied
+
+    def create_history_tables(self, measurement):
+        """Create the HISTORY_TABLES of a history series, with the columns of its main table."""
+        source = self.cluster.metadata.keyspaces[self.keyspace].tables[measurement]
+        columns = ", ".join("{} {}".format(column.name, column.cql_type) for column in source.columns.values())
+        for keys in HISTORY_TABLES[measurement]:
+            self.client.execute("CREATE TABLE IF NOT EXISTS {} ({}, bucket int, PRIMARY KEY (({}, bucket), time)) "
+                                "WITH CLUSTERING ORDER BY (time DESC)".format(
+                                    history_table(measurement, keys), columns, ", ".join(keys)))
+
+    def migrate_history(self, measurement, bucket_size, log=_LOGGER.info):
+        """
+        Fill the HISTORY_TABLES of a history series while it is in use.
+
+        As with `migrate_to_buckets`, the history tables are written to
+        along with the main table first, then the main table is copied to
+        them, and then readers switch to them.
+
+        :param bucket_size: Seconds per bucket
+        :param log: Function logging the progress
+        :return: Number of copied rows, None if the tables are already in use
+        """
+        layout = self.layout(measurement, refresh=True)
+        if layout.bucket_size and not layout.migrating:
+            return None
+        bucket_size = layout.bucket_size or bucket_size
+        self.create_layout_tables()
+        self.create_history_tables(measurement)
+        self.set_layout(measurement, measurement, bucket_size, LAYOUT_MIGRATING)
+        log('{}: writing to the history tables, waiting {}s for all writers'.format(
+            measurement, self.LAYOUT_CACHE_TTL))
+        _time.sleep(self.LAYOUT_CACHE_TTL)
+
+        statement = SimpleStatement('SELECT * FROM {}'.format(measurement), fetch_size=1000)
+        copied = 0
+        for row in self.client.execute(statement):
+            for table, values, key in self.history_rows(measurement, row._asdict(), bucket_size):
+                self.execute_async(self.insert_statement(table, tuple(values.keys())), list(values.values()))
+                self.record_history_buckets([(table, key, values['bucket'])])
+            copied += 1
+            if copied % 100000 == 0:
+                log('{}: copied {} rows'.format(measurement, copied))
+        self.wait_writes()
+        self.set_layout(measurement, measurement, bucket_size, LAYOUT_READY)
+        log('{}: copied {} rows, reading from the history tables'.format(measurement, copied))
+        return copied
+
     def delete_sensor(self, sensor_type):
         # TODO: Implement
         pass
@@ -294,6 +1427,7 @@ class CassandraClient(TSDBClient):
         if self.client is not None:
             self.client.shutdown()
         self.start(self.app)
+        self.reset_buffer()
 
     def create_defaults(self):
         """Create Default tables"""
@@ -312,11 +1446,107 @@ class CassandraClient(TSDBClient):
                                      "active_sensors int, message_count int,period varchar,series_type varchar," \
                                      "time timestamp,PRIMARY KEY (company_id, time))WITH CLUSTERING ORDER BY (time DESC)"
 
+        new = [measurement for measurement in HISTORY_TABLES if not self.table_exists(measurement)]
         self.client.execute(event_logs_cmd)
         self.client.execute(alert_history_cmd)
         self.client.execute(event_history_cmd)
         self.client.execute(system_daily_analytics_cmd)
+        self.create_layout_tables()
+        for measurement in HISTORY_TABLES:
+            self.create_history_tables(measurement)
+        for measurement in new:
+            # Nothing to copy
+            self.set_layout(measurement, measurement, self.HISTORY_BUCKET_SIZE, LAYOUT_READY)
+
+
+
+def bucket_of(time, bucket_size):
+    """Bucket of a naive UTC datetime"""
+    return int((time - _EPOCH).total_seconds() // bucket_size)
+
+
+def history_table(measurement, keys):
+    """Name of the history table of a series partitioned by `keys`"""
+    return '{}_by_{}'.format(measurement, '_'.join(key[:-3] if key.endswith('_id') else key for key in keys))
+
+
+def history_key(tags, keys):
+    """Partition of a history table holding `tags`, as listed in ``history_buckets``"""
+    return '/'.join(str(tags[key]) for key in keys)
+
 
+def _bucket_start(bucket, bucket_size):
+    """Naive UTC datetime a bucket starts at"""
+    return _EPOCH + timedelta(seconds=bucket * bucket_size)
+
+
+def _to_datetime(value):
+    """Convert a point time (None, ISO string or datetime) to a naive UTC datetime."""
+    if value is None:
+        return datetime.utcnow()
+    if isinstance(value, str):
+        value = parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _to_micros(value):
+    """UNIX microseconds of a naive UTC datetime"""
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def _floor(time, resolution):
+    """Start of the rollup interval of a naive UTC datetime"""
+    return _bucket_start(bucket_of(time, resolution), resolution)
+
+
+def _time_chunks(rows, size):
+    """Chunks of at least `size` rows, or the remaining ones, without splitting the rows of a time"""
+    chunk = []
+    for _, group in groupby(rows, lambda row: row.time):
+        chunk.extend(group)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _rollup_columns(rows):
+    """Times and statistics columns of a chunk of rollup rows, for `Resampler.add_rollup`"""
+    times = sorted({row.time for row in rows})
+    index = {time: i for i, time in enumerate(times)}
+    columns = {}
+    for row in rows:
+        column = columns.get(row.field)
+        if column is None:
+            column = columns[row.field] = (np.zeros(len(times), np.int64),) + tuple(
+                np.full(len(times), np.nan) for _ in range(4))
+        i = index[row.time]
+        column[0][i] = row.count or 0
+        for array, value in zip(column[1:], (row.sum, row.min, row.max, row.last)):
+            array[i] = value if value is not None else np.nan
+    return np.array([_to_micros(time) for time in times], np.int64), columns
+
+
+def _columns(rows):
+    """
+    Time and numeric value columns of a chunk of rows, for `Resampler.add`.
+
+    Columns holding anything but numbers and nulls are left out.
+    """
+    times = np.array([_to_micros(row.time) for row in rows], np.int64)
+    columns = {}
+    for name in rows[0]._fields:
+        if name in ('company_id', 'sensor_id', 'bucket', 'time'):
+            continue
+        values = [getattr(row, name) for row in rows]
+        if all(value is None or (isinstance(value, (int, float)) and not isinstance(value, bool))
+               for value in values):
+            columns[name] = np.array(values, np.float64)
+    return times, columns
 
 
 def get_cassandra_data_type(_t):
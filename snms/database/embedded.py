@@ -0,0 +1,825 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Embedded time series database.
+
+For single-node installs and local runs: points are stored in files below
+TSDB_DIR, without an external service. The layout is::
+
+    <TSDB_DIR>/<measurement>/<sensor id>/<YYYY-MM-DD>/<segment>.seg
+
+Points without a ``sensor_id`` tag are stored under the ``@`` series. Every
+write adds an immutable segment to the daily partition of its points.
+Compaction is size-tiered: segments are grouped into tiers by number of
+points, each tier COMPACT_SEGMENTS times larger than the one below, and
+once a tier has COMPACT_SEGMENTS segments they are merged into one of the
+next tier. A point is thus rewritten once per tier, not on every
+compaction of its partition.
+
+A segment holds its points sorted by time, column by column: the time
+column of int64 UNIX microseconds, then one column per tag and field,
+either int64, float64 (NaN for none) or JSON values. Segments are memory
+mapped and read in place. Every INDEX_STRIDE-th time is kept in a sparse
+index, so a time range is found by bisecting the index and then a single
+block of the time column. Segment files are little-endian.
+
+As with InfluxDB, tag values are stored as strings and points written
+twice are kept twice. Sensor readings past their retention (see
+`Retention`) are not written, and `expire` removes the daily partitions
+which have expired as a whole. Partitions are locked with ``flock``, so several
+processes may share TSDB_DIR.
+"""
+
+import bisect
+import fcntl
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time as _time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from urllib.parse import quote, unquote
+
+from dateutil import parser
+from snms.core.logger import Logger
+from snms.database import TSDBClient
+from snms.database.tsdb import HISTORY_PARTS, STATS, TOTAL_NONE, page_cursor, parse_duration, time_cursor
+
+from .exceptions import InvalidCursor, MeasurementNotFound
+
+_LOGGER = Logger.get()
+
+MAGIC = b'SNTS'
+VERSION = 1
+SUFFIX = '.seg'
+TIME = 'time'
+# Series of points without a sensor_id tag; quoted names never contain '@'
+NO_SERIES = '@'
+# Rows per entry of the sparse time index
+INDEX_STRIDE = 64
+
+INT = b'q'
+FLOAT = b'd'
+JSON = b'o'
+TAG = 1
+
+# Magic, version, number of columns, rows, first time, last time, index entries
+_HEADER = struct.Struct('<4sHHIqqI')
+# Name length, type, flags, offset, size; followed by the name
+_COLUMN = struct.Struct('<H1sBQQ')
+
+_EPOCH = datetime(1970, 1, 1)
+_AGGREGATES = ('MEAN', 'SUM', 'MIN', 'MAX', 'COUNT')
+
+
+class _Floats(object):
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __getitem__(self, i):
+        value = self.values[i]
+        return None if math.isnan(value) else value
+
+
+class _Json(object):
+    __slots__ = ('offsets', 'blob')
+
+    def __init__(self, data, rows):
+        self.offsets = data[:4 * (rows + 1)].cast('I')
+        self.blob = data[4 * (rows + 1):]
+
+    def __getitem__(self, i):
+        return json.loads(bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8'))
+
+
+class Segment(object):
+    """
+    Read-only, memory-mapped segment file.
+
+    :param path: Path of the segment file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, columns, self.rows, self.first, self.last, entries = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a segment file: {}'.format(path))
+        view = memoryview(self._mmap)
+        pos = _HEADER.size
+        self.index = list(view[pos:pos + 8 * entries].cast('q'))
+        pos += 8 * entries
+        self._directory = OrderedDict()
+        self.tags = set()
+        for _ in range(columns):
+            length, kind, flags, offset, size = _COLUMN.unpack_from(self._mmap, pos)
+            pos += _COLUMN.size
+            name = bytes(view[pos:pos + length]).decode('utf-8')
+            pos += length
+            self._directory[name] = (kind, view[offset:offset + size])
+            if flags & TAG:
+                self.tags.add(name)
+        self.times = self._directory.pop(TIME)[1].cast('q')
+        self._columns = {}
+
+    @property
+    def names(self):
+        """Names of the tag and field columns"""
+        return list(self._directory)
+
+    def column(self, name):
+        """Values of a column, indexed by row, or None if there is no such column"""
+        column = self._columns.get(name)
+        if column is None and name in self._directory:
+            kind, data = self._directory[name]
+            if kind == INT:
+                column = data.cast('q')
+            elif kind == FLOAT:
+                column = _Floats(data.cast('d'))
+            else:
+                column = _Json(data, self.rows)
+            self._columns[name] = column
+        return column
+
+    def search(self, time):
+        """First row at or after a time"""
+        k = bisect.bisect_left(self.index, time)
+        lo = max(k - 1, 0) * INDEX_STRIDE
+        hi = min(k * INDEX_STRIDE, self.rows)
+        return bisect.bisect_left(self.times, time, lo, hi)
+
+    def between(self, start=None, end=None):
+        """Range of the rows from `start` to `end`, both included"""
+        if (start is not None and start > self.last) or (end is not None and end < self.first):
+            return range(0)
+        lo = 0 if start is None or start <= self.first else self.search(start)
+        hi = self.rows if end is None or end >= self.last else self.search(end + 1)
+        return range(lo, hi)
+
+    def matching(self, rows, tags):
+        """Rows of which the tags have the given string values"""
+        columns = [(self.column(name), value) for name, value in tags.items()]
+        if any(column is None for column, value in columns):
+            return []
+        return [i for i in rows if all(column[i] == value for column, value in columns)]
+
+    def row(self, i, names=None):
+        """Dict of the time and the columns of a row"""
+        data = {TIME: self.times[i]}
+        for name in (self._directory if names is None else names):
+            column = self.column(name)
+            data[name] = column[i] if column is not None else None
+        return data
+
+
+def _encode_column(values):
+    if all(type(value) is int for value in values):
+        try:
+            return INT, struct.pack('<{}q'.format(len(values)), *values)
+        except struct.error:
+            pass
+    if all(value is None or type(value) in (int, float) for value in values):
+        return FLOAT, struct.pack('<{}d'.format(len(values)), *[math.nan if value is None else value
+                                                                  for value in values])
+    blobs = [json.dumps(value, default=str).encode('utf-8') for value in values]
+    offsets = list(itertools.accumulate([0] + [len(blob) for blob in blobs]))
+    return JSON, struct.pack('<{}I'.format(len(offsets)), *offsets) + b''.join(blobs)
+
+
+def encode_segment(rows, tags=()):
+    """
+    Encode points into a segment file.
+
+    :param rows: List of (time, dict of columns) pairs, sorted by time
+    :param tags: Names of the tag columns
+    :return: Segment file contents
+    """
+    names = OrderedDict()
+    for _, row in rows:
+        names.update((name, None) for name in row if name != TIME)
+    times = [t for t, _ in rows]
+    columns = [(TIME, 0) + _encode_column(times)]
+    for name in names:
+        values = [row.get(name) for _, row in rows]
+        columns.append((name, TAG if name in tags else 0) + _encode_column(values))
+    index = times[::INDEX_STRIDE]
+    offset = _HEADER.size + 8 * len(index) + sum(_COLUMN.size + len(name.encode('utf-8'))
+                                                   for name, _, _, _ in columns)
+    header = [_HEADER.pack(MAGIC, VERSION, len(columns), len(rows), times[0], times[-1], len(index)),
+              struct.pack('<{}q'.format(len(index)), *index)]
+    data = []
+    for name, flags, kind, values in columns:
+        padding = -offset % 8
+        data.append(b'\0' * padding + values)
+        offset += padding
+        encoded = name.encode('utf-8')
+        header.append(_COLUMN.pack(len(encoded), kind, flags, offset, len(values)) + encoded)
+        offset += len(values)
+    return b''.join(header + data)
+
+
+@contextmanager
+def _flock(path, operation):
+    """Hold an advisory lock on a file; yields False if a non-blocking lock is taken"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+
+def _segment_rows(segment):
+    """Rows of a segment, see `Segment.row`"""
+    return (segment.row(i) for i in range(segment.rows))
+
+
+def _listdir(path):
+    try:
+        return sorted(name for name in os.listdir(path) if not name.startswith('.'))
+    except FileNotFoundError:
+        return []
+
+
+def _to_micros(value):
+    """Convert a point time (None, UNIX time, ISO string or datetime) to UNIX microseconds"""
+    if value is None:
+        value = datetime.utcnow()
+    elif isinstance(value, (int, float)):
+        return int(value * 10 ** 6)
+    elif isinstance(value, str):
+        value = parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH) // timedelta(microseconds=1)
+
+
+def _format(micros):
+    return (_EPOCH + timedelta(microseconds=micros)).isoformat() + 'Z'
+
+
+def _partition(micros):
+    return (_EPOCH + timedelta(microseconds=micros)).strftime('%Y-%m-%d')
+
+
+def _descending(order_by):
+    return bool(order_by) and order_by.strip().lower().endswith('desc')
+
+
+def _time_range(duration=None, start_date=None, end_date=None):
+    if duration:
+        now = _to_micros(None)
+        return now - parse_duration(duration), now
+    return (_to_micros(start_date) if start_date else None,
+            _to_micros(end_date) if end_date else None)
+
+
+def _after(cursor, order, start, end):
+    """
+    Continue a time range after a cursor.
+
+    :return: Time and skip count of the cursor, see `page_cursor`, and the
+             new start and end of the range
+    """
+    after = page_cursor(cursor, order)
+    try:
+        t = _to_micros(after[0])
+    except (TypeError, ValueError, OverflowError):
+        raise InvalidCursor(cursor)
+    if order == 'desc':
+        end = t if end is None else min(end, t)
+    else:
+        start = t if start is None else max(start, t)
+    return after, start, end
+
+
+def _scan(ranges, reverse=False):
+    """Merge the selected rows of several segments by time"""
+    def rows(n, segment, selected):
+        times = segment.times
+        for i in (reversed(selected) if reverse else selected):
+            yield times[i], n, i, segment
+    return heapq.merge(*[rows(n, segment, selected) for n, (segment, selected) in enumerate(ranges)],
+                       reverse=reverse)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class EmbeddedClient(TSDBClient):
+    """
+    Embedded time series database for app.
+    """
+
+    # Segments of a size tier that are merged, and the size ratio of the tiers
+    COMPACT_SEGMENTS = 4
+    # Segments kept memory-mapped per process
+    OPEN_SEGMENTS = 256
+
+    def __init__(self, app=None):
+        super().__init__()
+        self.path = None
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.path = app.config['TSDB_DIR']
+        os.makedirs(self.path, exist_ok=True)
+        self.init_retention(app)
+        self.init_buffer(app)
+
+    def measurement_path(self, measurement):
+        return os.path.join(self.path, quote(measurement, safe=''))
+
+    def add_point(self, sensor, data, time=None):
+        """
+        Add new point to database.
+
+        :param time: Time of series
+        :param sensor: Sensor
+        :param data: Data
+        :return:
+        """
+        try:
+            self.write_point(sensor.type, self.sensor_point(sensor, data, time))
+        except Exception as e:
+            _LOGGER.error(e)
+
+    def add_points(self, sensor, rows):
+        """
+        Add several readings of one sensor as one segment per partition.
+
+        :param sensor: Sensor
+        :param rows: List of data dicts
+        """
+        try:
+            self.write_points(sensor.type, [self.sensor_point(sensor, data) for data in rows])
+        except Exception as e:
+            _LOGGER.error(e)
+
+    def add_series(self, measurement, tags, fields, time=None):
+        """
+        Add series to database
+
+        :param time: Time of series
+        :param measurement: Measurement name
+        :param tags: series tags
+        :param fields: series data fields
+        """
+        try:
+            self.write_point(measurement, {"tags": tags, "fields": dict(fields), "time": time})
+        except Exception as e:
+            _LOGGER.error(e)
+
+    def write_batch(self, measurement, points):
+        """
+        Write points of one measurement, one segment per series and partition.
+        Sensor readings past their retention are dropped.
+
+        :param measurement: Measurement name
+        :param points: List of dicts with tags, fields and time
+        """
+        groups = {}
+        for point in points:
+            t = _to_micros(point.get('time'))
+            if self.retention and isinstance(point['tags'].get('sensor_id'), int):
+                left = self.retention.expires(measurement, point['tags'].get('company_id'),
+                                              _EPOCH + timedelta(microseconds=t))
+                if left is not None and left <= 0:
+                    continue
+            tags = {name: str(value) for name, value in point['tags'].items() if value is not None}
+            row = dict(point['fields'])
+            row.pop(TIME, None)
+            row.update(tags)
+            series = quote(tags['sensor_id'], safe='') if 'sensor_id' in tags else NO_SERIES
+            group = groups.setdefault((series, _partition(t)), ([], set()))
+            group[0].append((t, row))
+            group[1].update(tags)
+        base = self.measurement_path(measurement)
+        for (series, partition), (rows, tags) in groups.items():
+            directory = os.path.join(base, series, partition)
+            os.makedirs(directory, exist_ok=True)
+            rows.sort(key=lambda row: row[0])
+            tmp, path = self._write_segment(directory, encode_segment(rows, tags))
+            os.replace(tmp, path)
+            if len(_listdir(directory)) >= self.COMPACT_SEGMENTS:
+                self.compact(directory)
+
+    def _write_segment(self, directory, data):
+        """
+        Write a new segment to a temporary file.
+
+        Segment names sort in the order they were written.
+
+        :return: Temporary and final path of the segment
+        """
+        name = '{:020d}-{}-{}'.format(_time.time_ns(), os.getpid(), next(self._sequence))
+        tmp = os.path.join(directory, '.{}.tmp'.format(name))
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        return tmp, os.path.join(directory, name + SUFFIX)
+
+    def _swap(self, directory, new, old):
+        """Publish new segments and remove old ones at once for readers"""
+        with _flock(os.path.join(directory, '.lock'), fcntl.LOCK_EX):
+            for tmp, path in new:
+                os.replace(tmp, path)
+            for path in old:
+                os.unlink(path)
+        with self._lock:
+            for path in old:
+                self._segments.pop(path, None)
+
+    def _open(self, path):
+        with self._lock:
+            segment = self._segments.pop(path, None)
+            if segment is None:
+                segment = Segment(path)
+            self._segments[path] = segment
+            while len(self._segments) > self.OPEN_SEGMENTS:
+                self._segments.popitem(last=False)
+        return segment
+
+    def _partition_segments(self, directory):
+        with _flock(os.path.join(directory, '.lock'), fcntl.LOCK_SH):
+            return [self._open(os.path.join(directory, name))
+                    for name in _listdir(directory) if name.endswith(SUFFIX)]
+
+    def _partitions(self, measurement, series=None, start=None, end=None):
+        """Partition directories of a measurement overlapping a time range"""
+        base = self.measurement_path(measurement)
+        for name in ([quote(series, safe='')] if series is not None else _listdir(base)):
+            for partition in _listdir(os.path.join(base, name)):
+                if start is not None and partition < _partition(start):
+                    continue
+                if end is not None and partition > _partition(end):
+                    continue
+                yield os.path.join(base, name, partition)
+
+    def select(self, measurement, tags=None, start=None, end=None):
+        """
+        Find the rows of a measurement matching tags and a time range.
+
+        :return: List of (segment, rows) pairs
+        """
+        tags = {name: str(value) for name, value in (tags or {}).items()}
+        series = tags.pop('sensor_id', None)
+        ranges = []
+        for directory in self._partitions(measurement, series, start, end):
+            for segment in self._partition_segments(directory):
+                rows = segment.between(start, end)
+                if tags and rows:
+                    rows = segment.matching(rows, tags)
+                if rows:
+                    ranges.append((segment, rows))
+        return ranges
+
+    def tier(self, segment):
+        """Size tier of a segment: 0 below COMPACT_SEGMENTS points, 1 below its square and so on"""
+        tier, rows = 0, segment.rows
+        while rows >= self.COMPACT_SEGMENTS:
+            tier, rows = tier + 1, rows // self.COMPACT_SEGMENTS
+        return tier
+
+    def compact(self, directory):
+        """
+        Merge the segments of each full size tier of a partition, unless
+        another process does.
+        """
+        with _flock(os.path.join(directory, '.compact'), fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+            if not locked:
+                return
+            while True:
+                tiers = {}
+                for segment in self._partition_segments(directory):
+                    tiers.setdefault(self.tier(segment), []).append(segment)
+                full = [segments for _, segments in sorted(tiers.items()) if len(segments) >= self.COMPACT_SEGMENTS]
+                if not full:
+                    return
+                # A merged tier may fill the next one
+                segments = full[0]
+                tags = set()
+                for segment in segments:
+                    tags.update(segment.tags)
+                rows = []
+                for row in heapq.merge(*map(_segment_rows, segments), key=lambda row: row[TIME]):
+                    rows.append((row.pop(TIME), row))
+                new = self._write_segment(directory, encode_segment(rows, tags))
+                self._swap(directory, [new], [segment.path for segment in segments])
+                _LOGGER.debug('Compacted %d segments of %s', len(segments), directory)
+
+    def get_points(self, sensor, limit=10000, order_by=None, start_date=None, end_date=None,
+                   duration=None, offset=0, function=None, group_duration=None,
+                   aggregate_only=False, value_fields=None, aggregate_function=None, offset_interval=None,
+                   cursor=None, total=None, include=None):
+        """
+        Get time series data for sensor.
+
+        Ungrouped pages come with a ``next`` cursor. A page requested with a
+        cursor starts at the time it points at instead of skipping `offset`
+        points, and has no ``total`` and ``aggregate``.
+
+        :param cursor: Cursor of the page, from the ``next`` of the previous one
+        :param total: TOTAL_NONE for no ``total``; totals are read from the
+                      segment indexes, so estimates are exact
+        :param include: HISTORY_PARTS to compute, all by default; the others
+                        are None
+        :param aggregate_only: Get only aggregated data
+        :param group_duration: Group duration
+        :param offset: Result offset
+        :param end_date: End Date for date filter
+        :param start_date: Start Date for date filter
+        :param duration: Duration for filter
+        :param order_by: Order by
+        :param limit: Limit of result
+        :param sensor: Sensor
+        :return: List of time series data.
+        """
+        start, end = _time_range(duration, start_date, end_date)
+        grouped = bool((duration or start_date or end_date) and group_duration)
+        reverse = _descending(order_by)
+        order = 'desc' if reverse else 'asc'
+        after = None
+        if cursor is not None and not grouped and not aggregate_only:
+            after, start, end = _after(cursor, order, start, end)
+        ranges = self.select(sensor.type, {'sensor_id': sensor.id}, start, end)
+        if aggregate_only:
+            return self.aggregate(ranges)
+
+        def fields(segment):
+            return [name for name in segment.names if name not in segment.tags]
+        parts = set(HISTORY_PARTS if include is None else include)
+        if total == TOTAL_NONE:
+            parts.discard('total')
+        if after is not None and 'data' in parts:
+            return self.page(ranges, order, after[1], limit, after, fields, aggregate=None)
+        count = sum(len(rows) for _, rows in ranges) if 'total' in parts and after is None else None
+        aggregate = self.aggregate(ranges) if 'aggregate' in parts and after is None else None
+        if 'data' not in parts:
+            return {'data': None, 'total': count, 'aggregate': aggregate, 'next': None}
+        if grouped:
+            data = self.group(ranges, group_duration, offset_interval, aggregate_function, start, end,
+                              reverse, limit, offset)
+            return {'data': data, 'total': count, 'aggregate': aggregate, 'next': None}
+        return dict(self.page(ranges, order, offset, limit, None, fields, aggregate=aggregate), total=count)
+
+    def page(self, ranges, order, skip, limit, after=None, columns=None, **extra):
+        """
+        Read a page of rows sorted by time.
+
+        :param skip: Rows to skip
+        :param after: Time and skip count of the cursor of the page, if any
+        :param columns: Function returning the columns to read of a segment, all by default
+        :return: Dict of the page ``data``, the ``next`` cursor, no ``total``
+                 and `extra`
+        """
+        data = []
+        for t, _, i, segment in islice(_scan(ranges, order == 'desc'), skip, skip + limit):
+            point = segment.row(i, columns(segment) if columns else None)
+            point[TIME] = _format(t)
+            data.append(point)
+        next_cursor = time_cursor(data, order, after) if data and len(data) == limit else None
+        return dict(extra, data=data, total=None, next=next_cursor)
+
+    def aggregate(self, ranges):
+        """MIN, MAX, MEAN, COUNT and SUM of each field, None without points"""
+        stats = OrderedDict()
+        for segment, rows in ranges:
+            for name in segment.names:
+                if name in segment.tags:
+                    continue
+                column = segment.column(name)
+                count, total, low, high = stats.get(name, (0, 0, None, None))
+                for i in rows:
+                    value = column[i]
+                    if value is None:
+                        continue
+                    count += 1
+                    if _is_number(value):
+                        total += value
+                        low = value if low is None else min(low, value)
+                        high = value if high is None else max(high, value)
+                stats[name] = (count, total, low, high)
+        if not stats:
+            return None
+        aggregate = {TIME: _format(0)}
+        for name, (count, total, low, high) in stats.items():
+            aggregate['count_' + name] = count
+            if low is not None:
+                aggregate.update({'min_' + name: low, 'max_' + name: high, 'sum_' + name: total,
+                                  'mean_' + name: total / count})
+        return aggregate
+
+    def group(self, ranges, group_duration, offset_interval=None, function=None, start=None, end=None,
+              reverse=False, limit=10000, offset=0):
+        """
+        Aggregate rows by time buckets, as InfluxDB ``GROUP BY time()``.
+
+        Buckets without values are included with None values.
+
+        :param function: MEAN, SUM, MIN, MAX or COUNT, MEAN by default
+        :return: List of bucket dicts with ``<function>_<field>`` values
+        """
+        function = function if function in _AGGREGATES else 'MEAN'
+        width = parse_duration(group_duration)
+        shift = parse_duration(offset_interval) % width if offset_interval else 0
+        names = OrderedDict()
+        buckets = self.bucket_stats(ranges, width, shift, names)
+        if start is None and not buckets:
+            return []
+        first = (start - shift) // width if start is not None else min(buckets)
+        last = (end if end is not None else _to_micros(None)) - shift
+        last = last // width
+        indexes = range(last, first - 1, -1) if reverse else range(first, last + 1)
+        data = []
+        for index in indexes[offset:offset + limit]:
+            point = {TIME: _format(index * width + shift)}
+            bucket = buckets.get(index, {})
+            for name in names:
+                value = 0 if function == 'COUNT' else None
+                if name in bucket:
+                    count, total, low, high = bucket[name]
+                    value = {'MEAN': total / count, 'SUM': total, 'MIN': low, 'MAX': high, 'COUNT': count}[function]
+                point['{}_{}'.format(function.lower(), name)] = value
+            data.append(point)
+        return data
+
+    @staticmethod
+    def bucket_stats(ranges, width, shift=0, names=None):
+        """
+        Count, sum, minimum and maximum of the numeric values of each field per bucket.
+
+        :param width: Microseconds per bucket
+        :param shift: Microseconds buckets are shifted by
+        :param names: OrderedDict to which the names of the fields with
+                      numeric values are added
+        :return: Dict of bucket indexes and dicts of field names and
+                 (count, sum, minimum, maximum)
+        """
+        buckets = {}
+        for segment, rows in ranges:
+            for name in segment.names:
+                if name in segment.tags:
+                    continue
+                column = segment.column(name)
+                times = segment.times
+                for i in rows:
+                    value = column[i]
+                    if not _is_number(value):
+                        continue
+                    if names is not None:
+                        names[name] = None
+                    bucket = buckets.setdefault((times[i] - shift) // width, {})
+                    count, total, low, high = bucket.get(name, (0, 0, value, value))
+                    bucket[name] = (count + 1, total + value, min(low, value), max(high, value))
+        return buckets
+
+    def get_stats(self, sensor, start_date, end_date, group_duration, offset_interval=None, value_fields=None):
+        """
+        Count, sum, minimum and maximum of each field of a sensor per group,
+        all read in one pass, see `TSDBClient.get_stats`.
+        """
+        width = parse_duration(group_duration)
+        shift = parse_duration(offset_interval) % width if offset_interval else 0
+        ranges = self.select(sensor.type, {'sensor_id': sensor.id}, _to_micros(start_date), _to_micros(end_date))
+        return {index * width + shift: {name: dict(zip(STATS, values)) for name, values in fields.items()}
+                for index, fields in self.bucket_stats(ranges, width, shift).items()}
+
+    def get_points_raw(self, measurement, tags=None, fields=None, limit=500, order_by=None, start_date=None,
+                       end_date=None, duration=None, offset=0, count_only=False, group_by=None, cursor=None,
+                       total=None):
+        """
+        Get time series data for sensor.
+
+        Pages come with a ``next`` cursor. A page requested with a cursor
+        starts at the time it points at instead of skipping `offset` points,
+        and has no ``total``.
+
+        :param cursor: Cursor of the page, from the ``next`` of the previous one
+        :param total: Ignored, totals are read from the segment indexes
+        :param group_by: Group By data
+        :param count_only: Count only query
+        :param offset: Result offset
+        :param fields: Measurement Fields
+        :param tags: Measurement tags
+        :param end_date: End Date for date filter
+        :param start_date: Start Date for date filter
+        :param duration: Duration for filter
+        :param order_by: Order by
+        :param limit: Limit of result
+        :param measurement: Measurement
+        :return: List of time series data and count.
+        """
+        start, end = _time_range(duration, start_date, end_date)
+        order = 'desc' if _descending(order_by) else 'asc'
+        after = None
+        if cursor is not None and not count_only:
+            after, start, end = _after(cursor, order, start, end)
+        ranges = []
+        for name in (measurement if isinstance(measurement, list) else [measurement]):
+            ranges.extend(self.select(name, tags, start, end))
+        total = sum(len(rows) for _, rows in ranges)
+        if count_only:
+            return {'data': [], 'total': total, 'next': None}
+        if after is not None:
+            return self.page(ranges, order, after[1], limit, after)
+        return dict(self.page(ranges, order, offset, limit), total=total)
+
+    def delete_measurement(self, measurement):
+        """Delete a measurement."""
+        path = self.measurement_path(measurement)
+        if not os.path.isdir(path):
+            raise MeasurementNotFound('measurement not found: {}'.format(measurement))
+        shutil.rmtree(path)
+        with self._lock:
+            for key in [key for key in self._segments if key.startswith(path + os.sep)]:
+                del self._segments[key]
+
+    def delete_points(self, measurement=None, tags=None, end_date=None, start_date=None):
+        """
+        Delete the points of a measurement, or of all measurements, matching
+        tags and a time range. Affected segments are rewritten without them.
+
+        """
+        start, end = _time_range(None, start_date, end_date)
+        tags = {name: str(value) for name, value in (tags or {}).items()}
+        series = tags.pop('sensor_id', None)
+        measurements = [measurement] if measurement else [unquote(name) for name in _listdir(self.path)]
+        for name in measurements:
+            for directory in self._partitions(name, series, start, end):
+                with _flock(os.path.join(directory, '.compact'), fcntl.LOCK_EX):
+                    new, old = [], []
+                    for segment in self._partition_segments(directory):
+                        rows = segment.between(start, end)
+                        if tags and rows:
+                            rows = segment.matching(rows, tags)
+                        if not rows:
+                            continue
+                        old.append(segment.path)
+                        deleted = set(rows)
+                        kept = [(segment.times[i], segment.row(i)) for i in range(segment.rows) if i not in deleted]
+                        if kept:
+                            for _, row in kept:
+                                del row[TIME]
+                            new.append(self._write_segment(directory, encode_segment(kept, segment.tags)))
+                    if old:
+                        self._swap(directory, new, old)
+
+    def expire(self, measurement, sensors, now=None):
+        """
+        Remove the daily partitions of sensors whose readings have all
+        expired.
+
+        :param sensors: Dict of sensor IDs and company IDs
+        :param now: Naive UTC datetime, the current time by default
+        """
+        now = now or datetime.utcnow()
+        base = self.measurement_path(measurement)
+        for sensor_id, company_id in sensors.items():
+            seconds = self.retention.seconds(measurement, company_id)
+            if not seconds:
+                continue
+            # Days ending before the cutoff
+            cutoff = (now - timedelta(seconds=seconds)).strftime('%Y-%m-%d')
+            series = os.path.join(base, quote(str(sensor_id), safe=''))
+            for partition in _listdir(series):
+                if partition >= cutoff:
+                    break
+                directory = os.path.join(series, partition)
+                with _flock(os.path.join(directory, '.compact'), fcntl.LOCK_EX):
+                    self._swap(directory, [], [os.path.join(directory, name) for name in _listdir(directory)
+                                               if name.endswith(SUFFIX)])
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def restart(self):
+        with self._lock:
+            self._segments.clear()
+        self.reset_buffer()
+
+    def create_defaults(self):
+        """Create the data directory"""
+        os.makedirs(self.path, exist_ok=True)
@@ -0,0 +1,81 @@
+import math
+
+import pytest
+
+from snms.database.embedded import INDEX_STRIDE, EmbeddedClient, Segment, encode_segment
+
+
+def _segment(tmp_path, rows, tags=()):
+    path = tmp_path / 'test.seg'
+    path.write_bytes(encode_segment(rows, tags))
+    return Segment(str(path))
+
+
+def test_segment_round_trip(tmp_path):
+    rows = [
+        (10, {'sensor_id': '1', 'count': 3, 'value': 1.5, 'state': 'on'}),
+        (20, {'sensor_id': '1', 'count': 4, 'value': None, 'state': {'mode': 'auto'}}),
+        (30, {'sensor_id': '1', 'count': 5, 'value': 2, 'extra': [1, 2]}),
+    ]
+    segment = _segment(tmp_path, rows, tags={'sensor_id'})
+    assert (segment.rows, segment.first, segment.last) == (3, 10, 30)
+    assert segment.names == ['sensor_id', 'count', 'value', 'state', 'extra']
+    assert segment.tags == {'sensor_id'}
+    assert list(segment.times) == [10, 20, 30]
+    assert [segment.row(i) for i in range(3)] == [
+        {'time': t, 'sensor_id': '1', 'count': row['count'], 'value': row['value'],
+         'state': row.get('state'), 'extra': row.get('extra')}
+        for t, row in rows
+    ]
+    assert segment.column('missing') is None
+    assert segment.row(0, ['value', 'missing']) == {'time': 10, 'value': 1.5, 'missing': None}
+
+
+def test_segment_column_types(tmp_path):
+    segment = _segment(tmp_path, [(1, {'int': 2 ** 62, 'float': math.pi, 'big': 2 ** 70})])
+    assert segment.row(0) == {'time': 1, 'int': 2 ** 62, 'float': math.pi, 'big': 2 ** 70}
+
+
+def test_segment_between(tmp_path):
+    rows = [(t * 10, {'value': t}) for t in range(5 * INDEX_STRIDE)]
+    segment = _segment(tmp_path, rows)
+    assert segment.between() == range(len(rows))
+    assert segment.between(15, 45) == range(2, 5)
+    assert segment.between(700, 700 + 10 * INDEX_STRIDE) == range(70, 70 + INDEX_STRIDE + 1)
+    assert segment.between(start=rows[-1][0] + 1) == range(0)
+    assert segment.between(end=-1) == range(0)
+
+
+def test_segment_matching(tmp_path):
+    rows = [(t, {'sensor_id': str(t % 2), 'value': t}) for t in range(6)]
+    segment = _segment(tmp_path, rows, tags={'sensor_id'})
+    assert segment.matching(range(6), {'sensor_id': '1'}) == [1, 3, 5]
+    assert segment.matching(range(6), {'company_id': '1'}) == []
+
+
+def test_segment_rejects_other_files(tmp_path):
+    path = tmp_path / 'other.seg'
+    path.write_bytes(b'\0' * 64)
+    with pytest.raises(ValueError):
+        Segment(str(path))
+
+
+def _segments(client, directory):
+    return sorted(path.name for path in directory.iterdir() if path.suffix == '.seg')
+
+
+def test_compaction_is_size_tiered(tmp_path):
+    client = EmbeddedClient()
+    client.path, client.retention = str(tmp_path), None
+    client.write_batch('temp', [{'tags': {'sensor_id': 1}, 'fields': {'value': t}, 'time': t}
+                                for t in range(1000)])
+    directory = next((tmp_path / 'temp' / '1').iterdir())
+    large = _segments(client, directory)
+    for t in range(1000, 1000 + 4 * EmbeddedClient.COMPACT_SEGMENTS):
+        client.write_batch('temp', [{'tags': {'sensor_id': 1}, 'fields': {'value': t}, 'time': t}])
+    segments = _segments(client, directory)
+    # The small segments were merged without rewriting the large one
+    assert large[0] in segments
+    assert len(segments) < EmbeddedClient.COMPACT_SEGMENTS + 2
+    times = [segment.times[i] for segment, rows in client.select('temp', {'sensor_id': 1}) for i in rows]
+    assert sorted(times) == [t * 10 ** 6 for t in range(1000 + 4 * EmbeddedClient.COMPACT_SEGMENTS)]
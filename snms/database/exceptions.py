@@ -23,3 +23,7 @@ class MeasurementNotFound(Exception):
         )
         self.content = content
         self.code = code
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor can not be decoded."""
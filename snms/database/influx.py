@@ -4,26 +4,125 @@
 #
 # License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
 
-"""Influx DB"""
+"""
+Influx DB
+
+With TSDB_ROLLUPS, continuous queries roll the readings of each sensor type
+up into ``<type>_rollup_1m``, ``_1h`` and ``_1d`` measurements, holding the
+MIN, MAX, SUM, COUNT and LAST of each field per interval. Older readings
+are rolled up by ``snms db rollup-tsdb``; the ``rollup_state`` measurement
+holds the time each rollup starts at.
+
+Sensor readings with a retention (see `Retention`) are written to a
+retention policy per number of days kept, ``keep_<days>d``; readings past
+it are not written. Rollups are written to the policy of the retention of
+their sensor type, as a continuous query rolls up the readings of all
+companies. Readings and rollups are read from all ``keep_*`` policies and
+the default one, so that those written before a retention was set or
+changed are kept in history until their old policy drops them.
+"""
 import json
+import re
+from datetime import datetime, timedelta, timezone
+
+from dateutil import parser
 
 from influxdb import InfluxDBClient
 from influxdb.line_protocol import quote_ident, quote_literal
 from snms.core.logger import Logger
 from snms.database import TSDBClient
+from snms.database.tsdb import (HISTORY_PARTS, ROLLUP_NAMES, ROLLUP_RESOLUTIONS, TOTAL_NONE, merge_stats, page_cursor,
+                                 parse_duration, rollup_measurement, rollup_resolution, stats_aggregate, stats_rows,
+                                 stats_total, time_cursor)
 
-from .exceptions import MeasurementNotFound
+from .exceptions import InvalidCursor, MeasurementNotFound
 
 _LOGGER = Logger.get()
 
+_RFC3339 = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?Z$')
+
+_EPOCH = datetime(1970, 1, 1)
+
+_STATS = ('MIN', 'MAX', 'SUM', 'COUNT')
+
+
+def _rows(result):
+    """Points of a query result, read from its raw series"""
+    for series in result.raw.get('series', []):
+        columns = series['columns']
+        for values in series.get('values', []):
+            yield dict(zip(columns, values))
+
+
+def _count(point):
+    """Number of points counted by a COUNT(*) point, the count of its field with the most values"""
+    counts = [v for k, v in (point or {}).items() if k.startswith('count_') and type(v) is int]
+    return max(counts) if counts else 0
+
+
+def _stats(row):
+    """Statistics of the fields of a row of MIN, MAX, SUM and COUNT values, see `merge_stats`"""
+    fields = {}
+    for key, value in row.items():
+        function, _, name = key.partition('_')
+        if name and value is not None and function.upper() in _STATS:
+            fields.setdefault(name, {})[function.upper()] = value
+    return fields
+
+
+def _to_datetime(value):
+    """Naive UTC datetime of a point time (None, ISO string or datetime), None for other times"""
+    if value is None:
+        return datetime.utcnow()
+    if isinstance(value, str):
+        value = parser.parse(value)
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _source(policy, measurement):
+    """Measurement of a FROM or INTO clause, in a retention policy unless it is None"""
+    if policy is None:
+        return quote_ident(measurement)
+    return '{}.{}'.format(quote_ident(policy), quote_ident(measurement))
+
+
+def _to_micros(value=None):
+    """UNIX microseconds of an ISO time, the current time by default"""
+    value = parser.parse(value) if value is not None else datetime.utcnow()
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH) // timedelta(microseconds=1)
+
+
+def _after(cursor, order_by):
+    """Order, time and skip count of a cursor, see `page_cursor`"""
+    order = 'desc' if order_by and order_by.strip().lower().endswith('desc') else 'asc'
+    if cursor is None:
+        return order, None
+    after = page_cursor(cursor, order)
+    if not isinstance(after[0], str) or not _RFC3339.match(after[0]):
+        raise InvalidCursor(cursor)
+    return order, after
+
 
 class InfluxClient(TSDBClient):
     """
     Influx DB time series database for app.
     """
 
+    # Intervals rolled up per query when rolling up older readings
+    ROLLUP_CHUNK = 1440
+
     def __init__(self, app=None):
         super().__init__()
+        self.db = None
+        self.rollups = False
+        self._policies = set()
+        self._listed = False
         if app is not None:
             self.init_app(app)
 
@@ -33,7 +132,11 @@ class InfluxClient(TSDBClient):
         username = app.config['TSDB_USERNAME']
         password = app.config['TSDB_PASSWORD']
         db = app.config['TSDB_DB']
+        self.db = db
+        self.rollups = app.config.get('TSDB_ROLLUPS', False)
+        self.init_retention(app)
         self.client = InfluxDBClient(host, port=port, username=username, password=password, database=db)
+        self.init_buffer(app)
 
     def add_point(self, sensor, data, time=None):
         """
@@ -45,26 +148,19 @@ class InfluxClient(TSDBClient):
         :return:
         """
         try:
-            if "last_update" in data.keys():
-                del data['last_update']
-            json_body = [
-                {
-                    "measurement": sensor.type,
-                    "tags": {
-                        "sensor_id": sensor.id,
-                        "company_id": sensor.company_id
-                    },
-                    "fields": data
-
-                }
-            ]
-            if "data_json" in data.keys():
-                json_body[0]['fields'] = data['data_json']
-            if 'time' in json_body[0]['fields'].keys():
-                time = json_body[0]['fields']['time']
-            if time:
-                json_body[0]['time'] = time
-            self.client.write_points(json_body)
+            self.write_point(sensor.type, self.sensor_point(sensor, data, time))
+        except Exception as e:
+            _LOGGER.error(e)
+
+    def add_points(self, sensor, rows):
+        """
+        Add several readings of one sensor with a single write.
+
+        :param sensor: Sensor
+        :param rows: List of data dicts
+        """
+        try:
+            self.write_points(sensor.type, [self.sensor_point(sensor, data) for data in rows])
         except Exception as e:
             _LOGGER.error(e)
 
@@ -78,25 +174,116 @@ class InfluxClient(TSDBClient):
         :param fields: series data fields
         """
         try:
-            json_body = [
-                {
-                    "measurement": measurement,
-                    "tags": tags,
-                    "fields": fields
-                }
-            ]
-            if time:
-                json_body[0]['time'] = time
-            self.client.write_points(json_body)
+            self.write_point(measurement, {"tags": tags, "fields": dict(fields), "time": time})
         except Exception as e:
             _LOGGER.error(e)
 
+    def write_batch(self, measurement, points):
+        """
+        Write points of one measurement with a single request per retention
+        policy.
+
+        Sensor readings past their retention are dropped, InfluxDB would
+        reject them.
+
+        :param measurement: Measurement name
+        :param points: List of dicts with tags, fields and time
+        """
+        policies = {}
+        for point in points:
+            policy = None
+            company_id = point['tags'].get('company_id')
+            if self.retention and isinstance(point['tags'].get('sensor_id'), int):
+                # Sensor values, history series carry sensor UIDs
+                time = _to_datetime(point.get('time'))
+                left = self.retention.expires(measurement, company_id, time) if time is not None else None
+                if left is not None and left <= 0:
+                    continue
+                policy = self.policy(measurement, company_id)
+            body = {
+                "measurement": measurement,
+                "tags": point['tags'],
+                "fields": point['fields']
+            }
+            if point.get('time'):
+                body['time'] = point['time']
+            policies.setdefault(policy, []).append(body)
+        for policy, json_body in policies.items():
+            self.client.write_points(json_body, retention_policy=policy)
+
+    def policy(self, measurement, company_id=None, level='raw'):
+        """
+        Retention policy holding a level of the readings of a sensor,
+        created on first use.
+
+        :return: Name of the policy, None for the default one, which keeps
+                 them forever
+        """
+        days = self.retention.days(measurement, company_id, level)
+        if not days:
+            return None
+        name = 'keep_{:g}d'.format(days)
+        if name not in self.stored_policies():
+            try:
+                self.client.query('CREATE RETENTION POLICY {} ON {} DURATION {}h REPLICATION 1'.format(
+                    quote_ident(name), quote_ident(self.db), max(1, int(days * 24))))
+            except Exception as e:
+                # Already there
+                _LOGGER.debug(e)
+            self._policies.add(name)
+            if self.rollups and level == 'raw':
+                # Roll up the readings of the new policy too
+                self.create_rollups(measurement)
+        return name
+
+    def stored_policies(self):
+        """Names of the ``keep_*`` retention policies of the database, listed once"""
+        if not self._listed:
+            try:
+                result = self.client.query('SHOW RETENTION POLICIES ON {}'.format(quote_ident(self.db)))
+                self._policies.update(row['name'] for row in _rows(result) if row['name'].startswith('keep_'))
+                self._listed = True
+            except Exception as e:
+                _LOGGER.error(e)
+        return self._policies
+
+    def policies(self, measurement):
+        """Retention policies the readings of a sensor type are written to"""
+        companies = [None] + list(self.retention.companies)
+        return {self.policy(measurement, company_id) for company_id in companies}
+
+    def source(self, measurement, company_id=None, level='raw'):
+        """Measurement of a level of the readings of a sensor, qualified by its retention policy"""
+        return _source(self.policy(measurement, company_id, level), measurement)
+
+    def sources(self, measurement):
+        """
+        Measurement in the default and all ``keep_*`` retention policies, for
+        a FROM clause reading points whatever retention they were written with,
+        even after it was turned off.
+        """
+        return ','.join(_source(policy, measurement) for policy in [None] + sorted(self.stored_policies()))
+
     def get_points(self, sensor, limit=10000, order_by=None, start_date=None, end_date=None,
                    duration=None, offset=0, function=None, group_duration=None,
-                   aggregate_only=False, value_fields=None, aggregate_function=None, offset_interval=None):
+                   aggregate_only=False, value_fields=None, aggregate_function=None, offset_interval=None,
+                   cursor=None, total=None, include=None):
         """
         Get time series data for sensor.
 
+        Ungrouped pages come with a ``next`` cursor. A page requested with a
+        cursor starts at the time it points at instead of skipping `offset`
+        points, and has no ``total`` and ``aggregate``.
+
+        The queries of the included parts are sent as one request. The
+        ``total`` is taken from the COUNT of the aggregate query when the
+        aggregate is included. Groups made of whole rollup intervals are
+        read from the rollup as far as it is complete, see `rollup_points`.
+
+        :param cursor: Cursor of the page, from the ``next`` of the previous one
+        :param total: TOTAL_NONE for no ``total``
+        :param include: HISTORY_PARTS to compute, all by default; the others
+                        are None
         :param aggregate_only: Get only aggregated data
         :param group_duration: Group duration
         :param offset: Result offset
@@ -117,14 +304,14 @@ class InfluxClient(TSDBClient):
         select_clause_count = "SELECT COUNT(*)"
 
         if (duration or start_date or end_date) and group_duration:
-            if aggregate_function and aggregate_function in ['SUM', 'MEAN', 'MIN', 'MAX']:
+            if aggregate_function and aggregate_function in ['SUM', 'MEAN', 'MIN', 'MAX', 'COUNT']:
                 select_clause = "SELECT {}(*)".format(aggregate_function)
             else:
                 select_clause = "SELECT MEAN(*)"
             group_by_clause = "GROUP BY time({})".format(group_duration)
             if offset_interval:
                 group_by_clause = "GROUP BY time({}, {})".format(group_duration, offset_interval)
-        from_clause = 'FROM "{}"'.format(sensor.type)
+        from_clause = 'FROM {}'.format(self.sources(sensor.type))
         where_clause = 'WHERE "sensor_id" = \'{}\' '.format(sensor.id)
         if duration:
             where_clause += ' AND time >= now() - ' + duration
@@ -138,49 +325,65 @@ class InfluxClient(TSDBClient):
         limit_clause = 'LIMIT {}'.format(limit)
         offset_clause = 'OFFSET {}'.format(offset)
 
-        min_max_clauses = [select_clause_min_max, from_clause, where_clause, order_by_clause, offset_clause]
+        order, after = _after(None if group_by_clause or aggregate_only else cursor, order_by)
+
+        parts = set(HISTORY_PARTS if include is None else include)
+        if total == TOTAL_NONE:
+            parts.discard('total')
+        min_max_clauses = [select_clause_min_max, from_clause, where_clause, order_by_clause]
         min_max_query = " ".join(filter(None, min_max_clauses))
-        min_max_result = self.client.query(min_max_query)
-        aggregate = None
-        try:
-            _points = list(min_max_result.get_points())
-            if len(_points) > 0:
-                aggregate = _points[0]
-        except Exception as e:
-            _LOGGER.error(e)
+        _LOGGER.debug(min_max_query)
         if aggregate_only:
-            return aggregate
+            return next(_rows(self.client.query(min_max_query)), None)
+
+        if group_by_clause and value_fields and (duration or start_date):
+            start = _to_micros() - parse_duration(duration) if duration else _to_micros(start_date)
+            rollup = self.rollup_for(sensor.type, group_duration, offset_interval, start)
+            if rollup is not None:
+                end = _to_micros(end_date) if end_date and not duration else _to_micros()
+                return self.rollup_points(sensor, rollup, start, end, group_by_clause, group_duration,
+                                          offset_interval, aggregate_function, value_fields, order, offset, limit,
+                                          parts)
+
+        queries = {}
+        if after is None and 'aggregate' in parts:
+            queries['aggregate'] = min_max_query
+        elif after is None and 'total' in parts:
+            queries['total'] = " ".join([select_clause_count, from_clause, where_clause])
+
+        if after is not None:
+            where_clause += " AND time {} '{}'".format('<=' if order == 'desc' else '>=', after[0])
+            offset_clause = 'OFFSET {}'.format(after[1])
 
-        count_clauses = [select_clause_count, from_clause, where_clause, order_by_clause]
         all_clauses = [select_clause, from_clause, where_clause, group_by_clause, order_by_clause, limit_clause, offset_clause]
-
-        base_query = " ".join(filter(None, all_clauses))
-        base_count_query = " ".join(filter(None, count_clauses))
-        _LOGGER.debug(min_max_query)
-        _LOGGER.debug(base_query)
-        _LOGGER.debug(base_count_query)
-
-        result = self.client.query(base_query+";"+base_count_query)
-        points = list(result[0].get_points())
-        count_result = result[1]
-
-        count = 0
-        if len(points) > 0:
-            try:
-                for k in count_result.raw['series'][0]['values'][0]:
-                    if type(k) is int and count < k:
-                        count = k
-            except Exception as e:
-                _LOGGER.error(e)
-                count = len(points)
-
-        return {'data': points, 'total': count, 'aggregate': aggregate}
+        if 'data' in parts:
+            queries['data'] = " ".join(filter(None, all_clauses))
+        _LOGGER.debug(queries.get('data'))
+
+        results = dict(zip(queries, self.query_many(list(queries.values()))))
+        points = list(_rows(results['data'])) if 'data' in results else None
+        aggregate = next(_rows(results['aggregate']), None) if 'aggregate' in results else None
+        count = None
+        if after is None and 'total' in parts:
+            count = _count(next(_rows(results.get('aggregate') or results['total']), None))
+
+        next_cursor = None
+        if not group_by_clause and points and len(points) == limit:
+            next_cursor = time_cursor(points, order, after)
+        return {'data': points, 'total': count, 'aggregate': aggregate, 'next': next_cursor}
 
     def get_points_raw(self, measurement, tags=None, fields=None, limit=500, order_by=None, start_date=None,
-                       end_date=None, duration=None, offset=0, count_only=False, group_by=None):
+                       end_date=None, duration=None, offset=0, count_only=False, group_by=None, cursor=None,
+                       total=None):
         """
         Get time series data for sensor.
 
+        Pages come with a ``next`` cursor. A page requested with a cursor
+        starts at the time it points at instead of skipping `offset` points,
+        and has no ``total``.
+
+        :param cursor: Cursor of the page, from the ``next`` of the previous one
+        :param total: TOTAL_NONE to skip the count query, leaving ``total`` None
         :param group_by: Group By data
         :param count_only: Count only query
         :param offset: Result offset
@@ -195,13 +398,14 @@ class InfluxClient(TSDBClient):
         :return: List of time series data.
         """
         from_clause = 'FROM '
-        if isinstance(measurement, list):
-            if len(measurement) > 0:
-                from_clause += '"' + '","'.join(measurement) + '"'
-            else:
-                return {'data': [], 'total': 0}
-        else:
-            from_clause += '"' + measurement + '"'
+        # Sensor readings, tagged with integer IDs unlike history series, are
+        # read from all retention policies
+        tags = tags or {}
+        readings = isinstance(tags.get('company_id'), int) or isinstance(tags.get('sensor_id'), int)
+        measurements = measurement if isinstance(measurement, list) else [measurement]
+        if not measurements:
+            return {'data': [], 'total': 0}
+        from_clause += ','.join(self.sources(name) if readings else _source(None, name) for name in measurements)
         query = 'SELECT * {} '.format(from_clause)
         count_query = 'SELECT COUNT(*) {} '.format(from_clause)
         where_query = ''
@@ -218,6 +422,10 @@ class InfluxClient(TSDBClient):
                 where_parts.append(' time >= \'' + start_date + '\'')
             if end_date:
                 where_parts.append(' time <= \'' + end_date + '\'')
+        order, after = _after(None if count_only else cursor, order_by)
+        if after is not None:
+            where_parts.append(" time {} '{}'".format('<=' if order == 'desc' else '>=', after[0]))
+            offset = after[1]
         if len(where_parts) > 0:
             where_query = ' WHERE '
             where_query += ' AND '.join(where_parts)
@@ -227,25 +435,34 @@ class InfluxClient(TSDBClient):
 
         if order_by:
             where_query += ' ORDER BY ' + order_by
-        count_query += where_query
-        _LOGGER.debug(count_query)
+        queries = []
+        if not count_only:
+            query = query + where_query + ' LIMIT {} OFFSET {}'.format(limit, offset)
+            _LOGGER.debug(query)
+            queries.append(query)
+        counted = after is None and (count_only or total != TOTAL_NONE)
+        if counted:
+            count_query += where_query
+            _LOGGER.debug(count_query)
+            queries.append(count_query)
         # TODO: Add exception handling
-        count_result = self.client.query(count_query)
+        results = self.query_many(queries)
+        points = [] if count_only else list(_rows(results[0]))
+        next_cursor = None
+        if points and len(points) == limit:
+            next_cursor = time_cursor(points, order, after)
+        if not counted:
+            return {'data': points, 'total': None, 'next': next_cursor}
+
+        count_result = results[-1]
         _LOGGER.debug(count_result.raw)
-        points = []
         if count_only:
-            points = list(count_result.get_points())
-        else:
-            query = query + where_query + ' LIMIT {} OFFSET {}'.format(limit, offset)
-            _LOGGER.debug(query)
-            result = self.client.query(query)
-            # print(result)
-            points = list(result.get_points())
+            points = list(_rows(count_result))
 
         total_count = 0
         try:
             if 'series' not in count_result.raw.keys():
-                return {'data': points, 'total': total_count}
+                return {'data': points, 'total': total_count, 'next': next_cursor}
             for series in count_result.raw['series']:
                 count = 0
                 for k in series['values'][0]:
@@ -256,7 +473,234 @@ class InfluxClient(TSDBClient):
             _LOGGER.error(e)
             total_count = len(points)
 
-        return {'data': points, 'total': total_count}
+        return {'data': points, 'total': total_count, 'next': next_cursor}
+
+    def rollup_points(self, sensor, rollup, start, end, group_by_clause, group_duration, offset_interval,
+                      aggregate_function, value_fields, order, offset, limit, parts):
+        """
+        Grouped points of a sensor, read from a rollup and from the readings
+        after its end, in one request.
+
+        The range is widened to whole rollup intervals. The ``total`` and
+        ``aggregate`` come from the same statistics.
+
+        :param rollup: Resolution and end of the rollup, see `rollup_for`
+        :param start: UNIX microseconds the range starts at
+        :param end: UNIX microseconds the range ends at, inclusive
+        """
+        width = parse_duration(group_duration)
+        shift = parse_duration(offset_interval) % width if offset_interval else 0
+        function = aggregate_function if aggregate_function in ('SUM', 'MEAN', 'MIN', 'MAX', 'COUNT') else 'MEAN'
+        stats = {(micros - shift) // width: fields for micros, fields in
+                 self.rollup_stats(sensor, rollup, start, end, group_by_clause, value_fields).items()}
+        data = None
+        if 'data' in parts:
+            data = stats_rows(stats, function, (start - shift) // width, (end - shift) // width, width, shift)
+            if order == 'desc':
+                data.reverse()
+            data = data[offset:offset + limit]
+        return {'data': data, 'total': stats_total(stats.values()) if 'total' in parts else None,
+                'aggregate': stats_aggregate(stats.values()) if 'aggregate' in parts else None, 'next': None}
+
+    def rollup_stats(self, sensor, rollup, start, end, group_by_clause, value_fields):
+        """
+        Statistics of the groups of a sensor, read from a rollup and from the
+        readings after its end, in one request.
+
+        :param rollup: Resolution and end of the rollup, see `rollup_for`
+        :return: Dict of the UNIX microseconds groups start at and their
+                 statistics, see `merge_stats`
+        """
+        resolution, done = rollup
+        where_clause = 'WHERE "sensor_id" = \'{}\''.format(sensor.id)
+        step = resolution * 10 ** 6
+        select = ', '.join('MIN("min_{0}") AS "min_{0}", MAX("max_{0}") AS "max_{0}", SUM("sum_{0}") AS "sum_{0}", '
+                           'SUM("count_{0}") AS "count_{0}"'.format(name) for name in value_fields)
+        rollup_source = self.sources(rollup_measurement(sensor.type, resolution))
+        queries = ['SELECT {} FROM {} {} AND time >= {} AND time < {} {}'.format(
+            select, rollup_source, where_clause, (start - start % step) * 1000, min(done, end + 1) * 1000,
+            group_by_clause)]
+        if done <= end:
+            queries.append('SELECT MIN(*), MAX(*), SUM(*), COUNT(*) FROM {} {} AND time >= {} AND time <= {} {}'.format(
+                self.sources(sensor.type), where_clause, max(start, done) * 1000, end * 1000,
+                group_by_clause))
+        stats = {}
+        for result in self.query_many(queries):
+            for row in _rows(result):
+                micros = _to_micros(row['time'])
+                fields = merge_stats(stats.get(micros, {}), _stats(row))
+                if fields:
+                    stats[micros] = fields
+        return stats
+
+    def get_stats(self, sensor, start_date, end_date, group_duration, offset_interval=None, value_fields=None):
+        """
+        Count, sum, minimum and maximum of each field of a sensor per group,
+        read with one query or from a rollup as in `get_points`, see
+        `TSDBClient.get_stats`.
+        """
+        start, end = _to_micros(start_date), _to_micros(end_date)
+        group_by_clause = "GROUP BY time({})".format(group_duration)
+        if offset_interval:
+            group_by_clause = "GROUP BY time({}, {})".format(group_duration, offset_interval)
+        rollup = self.rollup_for(sensor.type, group_duration, offset_interval, start) if value_fields else None
+        if rollup is not None:
+            return self.rollup_stats(sensor, rollup, start, end, group_by_clause, value_fields)
+        query = 'SELECT MIN(*), MAX(*), SUM(*), COUNT(*) FROM {} WHERE "sensor_id" = \'{}\' AND time >= {} ' \
+                'AND time <= {} {}'.format(self.sources(sensor.type), sensor.id, start * 1000,
+                                           end * 1000, group_by_clause)
+        _LOGGER.debug(query)
+        stats = {}
+        for row in _rows(self.client.query(query)):
+            fields = merge_stats({}, _stats(row))
+            if fields:
+                stats[_to_micros(row['time'])] = fields
+        return stats
+
+    def rollup_query(self, measurement, resolution, where_clause='', policy=None):
+        """InfluxQL statement rolling up the readings of a measurement in a retention policy"""
+        into = _source(self.policy(measurement, level=ROLLUP_NAMES[resolution]),
+                       rollup_measurement(measurement, resolution))
+        return 'SELECT MIN(*), MAX(*), SUM(*), COUNT(*), LAST(*) INTO {} FROM {} {} GROUP BY time({}s), *'.format(
+            into, _source(policy, measurement), where_clause, resolution)
+
+    def rollup_state(self, measurement):
+        """
+        Times the rollups of a measurement start at.
+
+        :return: Dict of resolutions and UNIX microseconds
+        """
+        result = self.client.query('SELECT "since", "resolution" FROM "rollup_state" WHERE "series" = {}'.format(
+            quote_literal(measurement)))
+        return {int(row['resolution']): row['since'] for row in _rows(result)}
+
+    def set_rollup_state(self, measurement, resolution, since):
+        # All at the same time, so that the state of a rollup is overwritten
+        self.client.write_points([{'measurement': 'rollup_state', 'time': 0, 'fields': {'since': since},
+                                   'tags': {'series': measurement, 'resolution': str(resolution)}}])
+
+    def rollup_for(self, measurement, group_duration, offset_interval, start):
+        """
+        Rollup to read the groups of a query from.
+
+        Continuous queries roll up each interval when it ends and again
+        after the next one, for late readings, so a rollup is complete
+        until the interval before the current one.
+
+        :param start: UNIX microseconds the query starts at
+        :return: Resolution and end, in UNIX microseconds, of the coarsest
+                 rollup whose intervals make up the groups and which is
+                 complete from `start` on, or None
+        """
+        if not self.rollups:
+            return None
+        resolution = rollup_resolution(group_duration, offset_interval)
+        if resolution is None:
+            return None
+        since = self.rollup_state(measurement).get(resolution)
+        step = resolution * 10 ** 6
+        now = _to_micros()
+        done = now - now % step - step
+        if since is None or since > start - start % step or done <= start:
+            return None
+        left = self.retention.expires(measurement, None, _EPOCH + timedelta(microseconds=start - start % step),
+                                      ROLLUP_NAMES[resolution])
+        if left is not None and left <= 0:
+            # The start of the range has expired from the rollup
+            return None
+        return resolution, done
+
+    def create_rollups(self, measurement):
+        """
+        Create the continuous queries rolling up a measurement, one per
+        retention policy its readings are written to.
+
+        Rollups of a new measurement start with the current interval.
+        """
+        state = self.rollup_state(measurement)
+        now = _to_micros()
+        for resolution in ROLLUP_RESOLUTIONS:
+            for policy in self.policies(measurement):
+                name = rollup_measurement(measurement, resolution)
+                if policy is not None:
+                    name += '_' + policy
+                try:
+                    self.client.query('CREATE CONTINUOUS QUERY {} ON {} RESAMPLE FOR {}s BEGIN {} END'.format(
+                        quote_ident(name), quote_ident(self.db), 2 * resolution,
+                        self.rollup_query(measurement, resolution, policy=policy)))
+                except Exception as e:
+                    # Already there
+                    _LOGGER.debug(e)
+            if resolution not in state:
+                self.set_rollup_state(measurement, resolution, now - now % (resolution * 10 ** 6))
+
+    def create_sensor(self, sensor_type, value_fields):
+        """Create the continuous queries of a new sensor type, with TSDB_ROLLUPS."""
+        if self.rollups:
+            self.create_rollups(sensor_type)
+
+    def backfill_rollups(self, measurement, sensors, start, log=_LOGGER.info, companies=None):
+        """
+        Roll up the readings of a measurement from `start` until where its
+        continuous queries started, ROLLUP_CHUNK intervals per query.
+
+        :param sensors: Ignored, the readings of all sensors are rolled up
+        :param start: Naive UTC datetime
+        :param log: Function logging the progress
+        :param companies: Ignored, rollups are kept as set for the type
+        :return: Number of written points
+        """
+        self.create_rollups(measurement)
+        state = self.rollup_state(measurement)
+        first = _to_micros(start.isoformat())
+        total = 0
+        for resolution in ROLLUP_RESOLUTIONS:
+            step = resolution * 10 ** 6
+            since, written = state[resolution], 0
+            for lo in range(first - first % step, since, step * self.ROLLUP_CHUNK):
+                where_clause = 'WHERE time >= {} AND time < {}'.format(
+                    lo * 1000, min(lo + step * self.ROLLUP_CHUNK, since) * 1000)
+                for policy in self.policies(measurement):
+                    result = self.client.query(self.rollup_query(measurement, resolution, where_clause, policy))
+                    written += sum(row.get('written', 0) for row in _rows(result))
+            if first - first % step < since:
+                self.set_rollup_state(measurement, resolution, first - first % step)
+            log('{}: {} rollup: {} points'.format(measurement, ROLLUP_NAMES[resolution], written))
+            total += written
+        return total
+
+    def refresh_rollups(self, measurement, tags=None, start_date=None, end_date=None):
+        """Roll up the intervals of a measurement holding deleted points again"""
+        conditions = ['{}={}'.format(quote_ident(k), quote_literal(str(v))) for k, v in (tags or {}).items()]
+        for resolution in ROLLUP_RESOLUTIONS:
+            step = resolution * 10 ** 6
+            where = list(conditions)
+            if start_date:
+                start = _to_micros(start_date)
+                where.append('time >= {}'.format((start - start % step) * 1000))
+            if end_date:
+                end = _to_micros(end_date)
+                where.append('time < {}'.format((end - end % step + step) * 1000))
+            if not where:
+                where_clause = ''
+            else:
+                where_clause = 'WHERE ' + ' AND '.join(where)
+            self.client.query('DELETE FROM {} {}'.format(quote_ident(rollup_measurement(measurement, resolution)),
+                                                         where_clause))
+            if start_date or end_date:
+                for policy in self.policies(measurement):
+                    self.client.query(self.rollup_query(measurement, resolution, where_clause, policy))
+
+    def query_many(self, queries):
+        """
+        Run InfluxQL statements in one request.
+
+        :return: List of the result of each statement
+        """
+        if not queries:
+            return []
+        results = self.client.query(';'.join(queries))
+        return results if isinstance(results, list) else [results]
 
     def delete_measurement(self, measurement):
         """Delete a measurement."""
@@ -266,7 +710,7 @@ class InfluxClient(TSDBClient):
             raise MeasurementNotFound(e)
 
     def restart(self):
-        return
+        self.reset_buffer()
 
     def delete_points(self, measurement=None, tags=None, end_date=None, start_date=None):
         query_str = 'DELETE '
@@ -290,4 +734,6 @@ class InfluxClient(TSDBClient):
             else:
                 query_str += ' WHERE time >= \'' + start_date + '\''
         _LOGGER.debug(query_str)
-        self.client.query(query_str)
\ No newline at end of file
+        self.client.query(query_str)
+        if self.rollups and measurement:
+            self.refresh_rollups(measurement, tags, start_date, end_date)
@@ -0,0 +1,228 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Streaming ``GROUP BY time()`` aggregation.
+
+Used by time series clients without server-side grouping. Rows are added
+in chunks of NumPy column arrays and folded into per-bucket counts, sums,
+minimums and maximums right away, so memory grows with the number of
+buckets and not with the number of rows. Results are shaped like those of
+InfluxDB: one row per bucket of the range, empty buckets included, with
+``<function>_<field>`` values. Rows of rollups, which hold these statistics
+and the last value of each interval, are folded in the same way.
+
+Requires NumPy.
+"""
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .tsdb import parse_duration
+
+FUNCTIONS = ('MEAN', 'SUM', 'MIN', 'MAX', 'COUNT')
+
+_EPOCH = datetime(1970, 1, 1)
+
+#: Statistics kept per bucket and the value of empty buckets: count, sum,
+#: minimum, maximum, time of the last value and last value
+_FILLS = ((0, np.int64), (0.0, np.float64), (np.inf, np.float64), (-np.inf, np.float64),
+          (np.iinfo(np.int64).min, np.int64), (np.nan, np.float64))
+
+
+class Resampler(object):
+    """
+    Aggregate rows into time buckets.
+
+    :param group_duration: Bucket width, an InfluxDB duration like ``1h``
+    :param offset_interval: Shift of the buckets, an InfluxDB duration
+    :param function: MEAN, SUM, MIN, MAX or COUNT, MEAN by default
+    :param start: UNIX microseconds of the range start, or None to start
+                  at the first row
+    :param end: UNIX microseconds of the range end, or None to end at the
+                last row
+    """
+
+    def __init__(self, group_duration, offset_interval=None, function=None, start=None, end=None):
+        self.width = parse_duration(group_duration)
+        if self.width <= 0:
+            raise ValueError('Invalid group duration: {}'.format(group_duration))
+        self.shift = parse_duration(offset_interval) % self.width if offset_interval else 0
+        self.function = function.upper() if function and function.upper() in FUNCTIONS else 'MEAN'
+        self.first = self.bucket(start) if start is not None else None
+        self.last = self.bucket(end) if end is not None else None
+        #: Number of rows added
+        self.count = 0
+        self._base = None
+        self._size = 0
+        # Statistics of each field, per bucket from _base, see _FILLS
+        self._stats = {}
+
+    def bucket(self, micros):
+        """Index of the bucket of a time"""
+        return (micros - self.shift) // self.width
+
+    def _grow(self, lo, hi):
+        """Make room for the buckets from `lo` to `hi`"""
+        if self._base is None:
+            self._base = lo
+        front = max(self._base - lo, 0)
+        back = max(hi - (self._base - front) + 1 - (self._size + front), 0)
+        if not front and not back:
+            return
+        for stats in self._stats.values():
+            for i, (fill, dtype) in enumerate(_FILLS):
+                stats[i] = np.concatenate((np.full(front, fill, dtype), stats[i], np.full(back, fill, dtype)))
+        self._base -= front
+        self._size += front + back
+
+    def _field(self, name):
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = [np.full(self._size, fill, dtype) for fill, dtype in _FILLS]
+        return stats
+
+    def _keep(self, times, columns):
+        """Bucket indexes of rows within the range, and the times and columns of these rows"""
+        times = np.asarray(times, np.int64)
+        buckets = self.bucket(times)
+        keep = np.ones(len(buckets), bool)
+        if self.first is not None:
+            keep &= buckets >= self.first
+        if self.last is not None:
+            keep &= buckets <= self.last
+        if not keep.all():
+            buckets, times = buckets[keep], times[keep]
+            columns = {name: values[keep] if isinstance(values, np.ndarray) else tuple(v[keep] for v in values)
+                       for name, values in columns.items()}
+        return buckets, times, columns
+
+    @staticmethod
+    def _last(stats, at, times, values):
+        """Keep the value of the latest time per bucket"""
+        order = np.lexsort((times, at))
+        at, times, values = at[order], times[order], values[order]
+        ends = np.flatnonzero(np.r_[at[1:] != at[:-1], True])
+        at, times, values = at[ends], times[ends], values[ends]
+        newer = times >= stats[4][at]
+        stats[4][at[newer]] = times[newer]
+        stats[5][at[newer]] = values[newer]
+
+    def add(self, times, columns):
+        """
+        Fold a chunk of rows into the buckets.
+
+        :param times: int64 array of UNIX microseconds
+        :param columns: Dict of field names and float64 arrays, NaN for no value
+        """
+        if not len(times):
+            return
+        buckets, times, columns = self._keep(times, columns)
+        if not len(buckets):
+            return
+        self.count += len(buckets)
+        self._grow(int(buckets.min()), int(buckets.max()))
+        index = buckets - self._base
+        for name, values in columns.items():
+            values = np.asarray(values, np.float64)
+            present = ~np.isnan(values)
+            if not present.any():
+                continue
+            at, values = index[present], values[present]
+            stats = self._field(name)
+            count, total, low, high = stats[:4]
+            count += np.bincount(at, minlength=self._size)
+            total += np.bincount(at, weights=values, minlength=self._size)
+            np.minimum.at(low, at, values)
+            np.maximum.at(high, at, values)
+            self._last(stats, at, times[present], values)
+
+    def add_rollup(self, times, columns):
+        """
+        Fold a chunk of rollup rows into the buckets.
+
+        :param times: int64 array of the UNIX microseconds the intervals start at
+        :param columns: Dict of field names and tuples of count, sum, minimum,
+                        maximum and last value arrays, a count of 0 for no value
+        """
+        if not len(times):
+            return
+        buckets, times, columns = self._keep(times, columns)
+        if not len(buckets):
+            return
+        counts = np.zeros(len(buckets), np.int64)
+        self._grow(int(buckets.min()), int(buckets.max()))
+        index = buckets - self._base
+        for name, (count, total, low, high, last) in columns.items():
+            count = np.asarray(count, np.int64)
+            present = count > 0
+            if not present.any():
+                continue
+            counts = np.maximum(counts, count)
+            at = index[present]
+            stats = self._field(name)
+            stats[0] += np.bincount(at, weights=count[present], minlength=self._size).astype(np.int64)
+            stats[1] += np.bincount(at, weights=np.asarray(total, np.float64)[present], minlength=self._size)
+            np.minimum.at(stats[2], at, np.asarray(low, np.float64)[present])
+            np.maximum.at(stats[3], at, np.asarray(high, np.float64)[present])
+            self._last(stats, at, times[present], np.asarray(last, np.float64)[present])
+        self.count += int(counts.sum())
+
+    def intervals(self):
+        """
+        Statistics of the buckets holding values, the rows of a rollup.
+
+        :return: Iterator of the UNIX microseconds a bucket starts at and a
+                 dict of field names and (count, sum, minimum, maximum, last)
+        """
+        for i in range(self._size):
+            fields = {}
+            for name, stats in self._stats.items():
+                if stats[0][i]:
+                    fields[name] = (int(stats[0][i]), float(stats[1][i]), float(stats[2][i]), float(stats[3][i]),
+                                    float(stats[5][i]))
+            if fields:
+                yield (self._base + i) * self.width + self.shift, fields
+
+    def _value(self, stats, i):
+        count, total, low, high = (array[i] for array in stats[:4])
+        if self.function == 'COUNT':
+            return int(count)
+        if not count:
+            return None
+        if self.function == 'MEAN':
+            return float(total / count)
+        if self.function == 'SUM':
+            return float(total)
+        return float(low if self.function == 'MIN' else high)
+
+    def rows(self, reverse=False, offset=0, limit=None):
+        """
+        Aggregated rows, one per bucket of the range.
+
+        :param reverse: Latest bucket first
+        :param offset: Buckets to skip
+        :param limit: Maximum number of buckets
+        """
+        if self._base is None and (self.first is None or self.last is None):
+            return []
+        first = self.first if self.first is not None else self._base
+        last = self.last if self.last is not None else self._base + self._size - 1
+        indexes = range(last, first - 1, -1) if reverse else range(first, last + 1)
+        indexes = indexes[offset:offset + limit if limit is not None else None]
+        prefix = self.function.lower() + '_'
+        data = []
+        for bucket in indexes:
+            point = {'time': (_EPOCH + timedelta(microseconds=bucket * self.width + self.shift)).isoformat() + 'Z'}
+            i = bucket - self._base if self._base is not None else -1
+            for name, stats in self._stats.items():
+                if 0 <= i < self._size:
+                    point[prefix + name] = self._value(stats, i)
+                else:
+                    point[prefix + name] = 0 if self.function == 'COUNT' else None
+            data.append(point)
+        return data
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from snms.database.resample import Resampler
+
+MINUTE = 60 * 10 ** 6
+
+
+def _columns(**values):
+    return {name: np.array(column, np.float64) for name, column in values.items()}
+
+
+def test_resampler_groups_rows():
+    resampler = Resampler('1m')
+    resampler.add(np.array([0, 10 ** 6, MINUTE, 3 * MINUTE]), _columns(value=[1, 3, 5, 7]))
+    assert resampler.count == 4
+    assert resampler.rows() == [
+        {'time': '1970-01-01T00:00:00Z', 'mean_value': 2.0},
+        {'time': '1970-01-01T00:01:00Z', 'mean_value': 5.0},
+        {'time': '1970-01-01T00:02:00Z', 'mean_value': None},
+        {'time': '1970-01-01T00:03:00Z', 'mean_value': 7.0},
+    ]
+
+
+@pytest.mark.parametrize(('function', 'expected'), (
+    ('SUM', [4.0, None]),
+    ('min', [1.0, None]),
+    ('MAX', [3.0, None]),
+    ('COUNT', [2, 0]),
+    ('median', [2.0, None]),
+))
+def test_resampler_functions(function, expected):
+    resampler = Resampler('1m', function=function, start=0, end=MINUTE)
+    resampler.add(np.array([0, 1]), _columns(value=[1, 3]))
+    assert [row[resampler.function.lower() + '_value'] for row in resampler.rows()] == expected
+
+
+def test_resampler_skips_missing_values():
+    resampler = Resampler('1m', function='COUNT')
+    resampler.add(np.array([0, 1, 2]), _columns(a=[1, np.nan, 2], b=[np.nan, np.nan, np.nan]))
+    assert resampler.rows() == [{'time': '1970-01-01T00:00:00Z', 'count_a': 2}]
+
+
+def test_resampler_keeps_the_range():
+    resampler = Resampler('1m', start=MINUTE, end=3 * MINUTE + 1)
+    resampler.add(np.array([0, MINUTE, 2 * MINUTE + 1, 4 * MINUTE]), _columns(value=[1, 2, 3, 4]))
+    assert resampler.count == 2
+    assert [row['mean_value'] for row in resampler.rows()] == [2.0, 3.0, None]
+
+
+def test_resampler_chunks_out_of_order():
+    resampler = Resampler('1m', function='SUM')
+    resampler.add(np.array([5 * MINUTE]), _columns(value=[1]))
+    resampler.add(np.array([MINUTE, 5 * MINUTE]), _columns(value=[2, 3]))
+    assert [row['sum_value'] for row in resampler.rows()] == [2.0, None, None, None, 4.0]
+
+
+def test_resampler_offset_interval():
+    resampler = Resampler('1h', '15m')
+    resampler.add(np.array([0, 20 * MINUTE]), _columns(value=[1, 3]))
+    assert resampler.rows() == [
+        {'time': '1969-12-31T23:15:00Z', 'mean_value': 1.0},
+        {'time': '1970-01-01T00:15:00Z', 'mean_value': 3.0},
+    ]
+
+
+def test_resampler_rows_page():
+    resampler = Resampler('1m', function='COUNT')
+    resampler.add(np.arange(5) * MINUTE, _columns(value=range(5)))
+    rows = resampler.rows(reverse=True, offset=1, limit=2)
+    assert [row['time'] for row in rows] == ['1970-01-01T00:03:00Z', '1970-01-01T00:02:00Z']
+
+
+def test_resampler_empty():
+    assert Resampler('1m').rows() == []
+    assert Resampler('1m', function='COUNT', start=0, end=MINUTE).rows() == [
+        {'time': '1970-01-01T00:00:00Z'}, {'time': '1970-01-01T00:01:00Z'}]
+
+
+def test_resampler_rollups_and_intervals():
+    resampler = Resampler('1h', function='MAX')
+    resampler.add_rollup(np.array([0, MINUTE]), {'value': ([2, 0], [3.0, 0.0], [1.0, 0.0], [2.0, 0.0], [2.0, 0.0])})
+    resampler.add(np.array([2 * MINUTE]), _columns(value=[5]))
+    assert resampler.count == 3
+    assert resampler.rows() == [{'time': '1970-01-01T00:00:00Z', 'max_value': 5.0}]
+    assert list(resampler.intervals()) == [(0, {'value': (3, 8.0, 1.0, 5.0, 5.0)})]
+
+
+@pytest.mark.parametrize('group_duration', ('0m', 'often'))
+def test_resampler_invalid_group_duration(group_duration):
+    with pytest.raises(ValueError):
+        Resampler(group_duration)
@@ -5,11 +5,454 @@
 # License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
 
 """Time Series database"""
+import atexit
+import base64
+import binascii
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from dateutil import parser
+from snms.core.logger import Logger
+
+from .exceptions import InvalidCursor
+
+_LOGGER = Logger.get(__name__)
+
+_EPOCH = datetime(1970, 1, 1)
+
+_DURATION_UNITS = {
+    'ns': 0.001, 'u': 1, 'us': 1, 'µ': 1, 'ms': 1000, 's': 10 ** 6, 'm': 60 * 10 ** 6,
+    'h': 3600 * 10 ** 6, 'd': 86400 * 10 ** 6, 'w': 7 * 86400 * 10 ** 6,
+}
+_DURATION = re.compile(r'(\d+)(ns|us|u|µ|ms|s|m|h|d|w)')
+
+#: Values of the `total` argument of history queries: an exact count of the
+#: points, an estimate where the client has a cheaper one, or no count
+TOTAL_EXACT = 'exact'
+TOTAL_ESTIMATE = 'estimate'
+TOTAL_NONE = 'none'
+
+#: Parts of a sensor history response which can be computed separately
+HISTORY_PARTS = ('data', 'aggregate', 'total')
+
+#: Statistics of the groups of `TSDBClient.get_stats`
+STATS = ('COUNT', 'SUM', 'MIN', 'MAX')
+
+
+def encode_cursor(**state):
+    """Opaque pagination cursor holding `state`"""
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    State of a pagination cursor.
+
+    :raises InvalidCursor: If the cursor was not made by `encode_cursor`
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError, binascii.Error):
+        raise InvalidCursor(cursor)
+    if not isinstance(state, dict):
+        raise InvalidCursor(cursor)
+    return state
+
+
+def time_cursor(data, order, after=None):
+    """
+    Cursor of the page after `data`, a full page of points sorted by time.
+
+    Pages are continued from the time of the last point, skipping the
+    points of that time which were already returned, so points with the
+    same time are neither lost nor repeated.
+
+    :param order: 'asc' or 'desc'
+    :param after: Time and skip count of this page, see `page_cursor`
+    """
+    last = data[-1]['time']
+    seen = sum(1 for point in data if point['time'] == last)
+    if after is not None and after[0] == last:
+        seen += after[1]
+    return encode_cursor(t=last, n=seen, o=order)
+
+
+def page_cursor(cursor, order):
+    """
+    Decode the cursor of a time-ordered page.
+
+    :return: Tuple of the time to continue from and the number of points of
+             that time to skip
+    :raises InvalidCursor: If the cursor is invalid or of another order
+    """
+    state = decode_cursor(cursor)
+    if state.get('o') != order or 't' not in state or not isinstance(state.get('n'), int):
+        raise InvalidCursor(cursor)
+    return state['t'], state['n']
+
+
+def parse_duration(value):
+    """
+    Length of an InfluxDB duration like ``1h30m`` or ``-15m`` in microseconds
+
+    :raises ValueError: If `value` is not a duration
+    """
+    value = (value or '').strip()
+    sign = -1 if value.startswith('-') else 1
+    body = value[1:] if sign < 0 else value
+    parts = _DURATION.findall(body)
+    if not parts or ''.join(a + b for a, b in parts) != body:
+        raise ValueError('Invalid duration: {}'.format(value))
+    return sign * int(sum(int(amount) * _DURATION_UNITS[unit] for amount, unit in parts))
+
+
+#: Seconds per interval of the rollups kept of sensor readings
+ROLLUP_RESOLUTIONS = (60, 3600, 86400)
+ROLLUP_NAMES = {60: '1m', 3600: '1h', 86400: '1d'}
+
+
+def rollup_resolution(group_duration, offset_interval=None):
+    """
+    Coarsest rollup resolution whose intervals make up the groups of a query.
+
+    :return: Seconds per interval, or None if no rollup fits the groups
+    """
+    try:
+        width = parse_duration(group_duration)
+        shift = parse_duration(offset_interval) % width if offset_interval else 0
+    except (ValueError, ZeroDivisionError):
+        return None
+    for resolution in reversed(ROLLUP_RESOLUTIONS):
+        if width % (resolution * 10 ** 6) == 0 and shift % (resolution * 10 ** 6) == 0:
+            return resolution
+    return None
+
+
+def rollup_measurement(measurement, resolution):
+    """Name of the measurement or table holding a rollup of `measurement`"""
+    return '{}_rollup_{}'.format(measurement, ROLLUP_NAMES[resolution])
+
+
+#: Levels retention is set for: the readings, then each rollup
+RETENTION_LEVELS = ('raw',) + tuple(ROLLUP_NAMES[resolution] for resolution in ROLLUP_RESOLUTIONS)
+
+
+class Retention:
+    """
+    Days for which sensor readings and their rollups are kept.
+
+    A setting is either a number of days for the readings, or a dict of
+    days per level of RETENTION_LEVELS. A level is looked up in the
+    setting of the company of a sensor, then in the one of its type, then
+    in the default; 0 keeps forever.
+    """
+
+    def __init__(self, default=None, types=None, companies=None):
+        self.default = default
+        self.types = types or {}
+        # Companies by ID, from config files or JSON
+        self.companies = {str(company_id): setting for company_id, setting in (companies or {}).items()}
+
+    @classmethod
+    def factory(cls, config):
+        """
+        Retention set by TSDB_RETENTION, TSDB_RETENTION_TYPES and
+        TSDB_RETENTION_COMPANIES.
+
+        :param config: Application config
+        """
+        return cls(config.get('TSDB_RETENTION'), config.get('TSDB_RETENTION_TYPES'),
+                   config.get('TSDB_RETENTION_COMPANIES'))
+
+    def __bool__(self):
+        return bool(self.default or self.types or self.companies)
+
+    def days(self, measurement, company_id=None, level='raw'):
+        """Days a level of the readings of a sensor is kept, 0 for forever"""
+        for setting in (self.companies.get(str(company_id)), self.types.get(measurement), self.default):
+            if isinstance(setting, dict):
+                if level in setting:
+                    return setting[level] or 0
+            elif setting is not None and level == 'raw':
+                return setting
+        return 0
+
+    def seconds(self, measurement, company_id=None, level='raw'):
+        """Seconds a level of the readings of a sensor is kept, 0 for forever"""
+        return int(self.days(measurement, company_id, level) * 86400)
+
+    def expires(self, measurement, company_id, time, level='raw', now=None):
+        """
+        Seconds until a point expires.
+
+        :param time: Naive UTC datetime of the point
+        :param now: Naive UTC datetime, the current time by default
+        :return: None if it is kept forever, 0 or less if it has expired
+        """
+        seconds = self.seconds(measurement, company_id, level)
+        if not seconds:
+            return None
+        age = (now or datetime.utcnow()) - time
+        return seconds - int(age.total_seconds())
+
+    def covers(self, measurement, company_id, level, time):
+        """Whether a rollup level still holds the intervals of the readings kept at `time`"""
+        left = self.expires(measurement, company_id, time, level)
+        if left is None or left > 0:
+            return True
+        raw = self.expires(measurement, company_id, time)
+        return raw is not None and raw <= 0
+
+
+def stats_value(values, function):
+    """
+    Value of an aggregate function for the statistics of a bucket.
+
+    :param values: Dict of COUNT, SUM, MIN, MAX or function results of a field
+    :param function: MEAN, SUM, MIN, MAX or COUNT
+    """
+    if function == 'MEAN' and 'MEAN' not in values:
+        if values.get('SUM') is None or not values.get('COUNT'):
+            return None
+        return values['SUM'] / values['COUNT']
+    if function == 'COUNT':
+        return values.get('COUNT') or 0
+    return values.get(function)
+
+
+def merge_stats(fields, other):
+    """
+    Add the statistics of a bucket to those of another.
+
+    :param fields: Dict of field names and dicts of COUNT, SUM, MIN and MAX,
+                   updated in place
+    :param other: Statistics to add, in the same format
+    :return: `fields`
+    """
+    for name, values in other.items():
+        if not values.get('COUNT'):
+            continue
+        total = fields.setdefault(name, {'COUNT': 0, 'SUM': None, 'MIN': None, 'MAX': None})
+        total['COUNT'] += values['COUNT']
+        if values.get('SUM') is not None:
+            total['SUM'] = values['SUM'] + (total['SUM'] or 0)
+        for func, pick in (('MIN', min), ('MAX', max)):
+            if values.get(func) is not None:
+                total[func] = values[func] if total[func] is None else pick(total[func], values[func])
+    return fields
+
+
+def stats_rows(stats, function, first, last, width, shift=0):
+    """
+    Grouped rows from statistics per bucket, shaped like those of InfluxDB:
+    one row per bucket from `first` to `last`, with ``<function>_<field>``
+    values.
+
+    :param stats: Dict of bucket indexes and statistics, see `merge_stats`
+    :param width: Microseconds per bucket
+    :param shift: Microseconds buckets are shifted by
+    """
+    names = {name for bucket in stats.values() for name, values in bucket.items()
+             if values.get(function) is not None or (function == 'MEAN' and values.get('SUM') is not None)}
+    prefix = function.lower() + '_'
+    data = []
+    for bucket in range(first, last + 1):
+        fields = stats.get(bucket, {})
+        point = {'time': _format_micros(bucket * width + shift)}
+        for name in names:
+            point[prefix + name] = stats_value(fields.get(name, {}), function)
+        data.append(point)
+    return data
+
+
+def stats_total(buckets):
+    """Number of points of many buckets, the count of the field with the most values"""
+    counts = {}
+    for bucket in buckets:
+        for name, values in bucket.items():
+            counts[name] = counts.get(name, 0) + (values.get('COUNT') or 0)
+    return max(counts.values()) if counts else 0
+
+
+def stats_aggregate(buckets):
+    """Aggregate row of the statistics of many buckets, shaped like the InfluxDB one"""
+    fields = {}
+    for bucket in buckets:
+        merge_stats(fields, bucket)
+    if not fields:
+        return None
+    aggregate = {'time': _format_micros(0)}
+    for name, total in fields.items():
+        aggregate.update({'count_' + name: total['COUNT'], 'sum_' + name: total['SUM'], 'min_' + name: total['MIN'],
+                          'max_' + name: total['MAX'], 'mean_' + name: stats_value(total, 'MEAN')})
+    return aggregate
+
+
+def _format_micros(micros):
+    return (_EPOCH + timedelta(microseconds=micros)).isoformat() + 'Z'
+
+
+def _parse_micros(value):
+    """UNIX microseconds of an ISO time, naive times being UTC"""
+    value = parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH) // timedelta(microseconds=1)
+
+
+class WriteBuffer:
+    """
+    In-process buffer for time series writes.
+
+    Points are grouped per measurement and handed to ``flush_callback`` in
+    batches of at most ``batch_size`` points. A flush is triggered as soon as
+    one measurement has a full batch or the oldest buffered point is older
+    than ``max_age`` seconds. Once ``max_size`` points are pending (buffered
+    or being written) ``add`` blocks, so a slow database slows down the
+    ingest path instead of growing the buffer without bound.
+
+    A batch whose write fails is retried up to ``retries`` times, waiting
+    ``max_age`` seconds more before each attempt, and then dropped; the
+    number of dropped points is kept in ``failed``. Points are only in
+    memory until written: those buffered when a process dies, at most
+    ``max_size`` of them written within the last ``max_age`` seconds plus
+    the time of the retries, are lost.
+    """
+
+    def __init__(self, flush_callback, batch_size=500, max_age=1.0, max_size=10000, retries=3):
+        self.flush_callback = flush_callback
+        self.batch_size = max(1, batch_size)
+        self.max_age = max_age
+        self.max_size = max(self.batch_size, max_size)
+        self.retries = max(0, retries)
+        #: Number of points dropped after their writes failed
+        self.failed = 0
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._points = {}
+        self._pending = 0
+        self._oldest = None
+        self._full = False
+        self._closed = False
+        self._thread = None
+        self._pid = None
+
+    def __len__(self):
+        return self._pending
+
+    def add(self, measurement, point):
+        """
+        Buffer a point, blocking while the buffer is full.
+
+        :param measurement: Measurement name
+        :param point: Point dict, as understood by the flush callback
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Write buffer is closed')
+            self._ensure_thread()
+            while self._pending >= self.max_size:
+                self._full = True
+                self._cond.notify_all()
+                self._cond.wait(self.max_age)
+            points = self._points.setdefault(measurement, [])
+            points.append(point)
+            self._pending += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(points) >= self.batch_size:
+                self._full = True
+                self._cond.notify_all()
+
+    def flush(self):
+        """Write all buffered points now."""
+        with self._cond:
+            batches = self._take()
+        self._write(batches)
+
+    def close(self):
+        """Stop the flush thread and drain the buffer."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            thread.join()
+        self.flush()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='tsdb-write-buffer', daemon=True)
+        self._thread.start()
+
+    def _take(self):
+        batches = self._points
+        self._points = {}
+        self._oldest = None
+        self._full = False
+        return batches
+
+    def _due(self):
+        if self._full or self._closed:
+            return True
+        return self._oldest is not None and time.monotonic() - self._oldest >= self.max_age
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    timeout = self.max_age
+                    if self._oldest is not None:
+                        timeout = max(0, self._oldest + self.max_age - time.monotonic())
+                    self._cond.wait(timeout)
+                closed = self._closed
+                batches = self._take()
+            self._write(batches)
+            if closed:
+                return
+
+    def _write(self, batches):
+        if not batches:
+            return
+        with self._write_lock:
+            for measurement, points in batches.items():
+                for i in range(0, len(points), self.batch_size):
+                    batch = points[i:i + self.batch_size]
+                    written = self._write_batch(measurement, batch)
+                    with self._cond:
+                        if not written:
+                            self.failed += len(batch)
+                        self._pending -= len(batch)
+                        self._cond.notify_all()
+
+    def _write_batch(self, measurement, batch):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.max_age * attempt)
+            try:
+                self.flush_callback(measurement, batch)
+                return True
+            except Exception as e:
+                if attempt < self.retries:
+                    _LOGGER.warning('Writing %d points for %s failed, retrying: %s', len(batch), measurement, e)
+                else:
+                    _LOGGER.error('Dropped %d points for %s: %s', len(batch), measurement, e)
+        return False
 
 
 class TSDBClient:
     def __init__(self):
-        pass
+        self.buffer = None
+        self.buffer_options = None
+        self.retention = Retention()
 
     def factory(type):
         if type == 'cassandra':
@@ -18,6 +461,9 @@ class TSDBClient:
         if type == 'influx':
             from .influx import InfluxClient
             return InfluxClient()
+        if type == 'embedded':
+            from .embedded import EmbeddedClient
+            return EmbeddedClient()
         assert 0, "Invalid time series database client type: " + type
 
     factory = staticmethod(factory)
@@ -25,15 +471,162 @@ class TSDBClient:
     def init_app(self, app):
         raise NotImplementedError("Subclass must implement abstract method")
 
+    def init_buffer(self, app):
+        """Create the write buffer if it is enabled in the app config."""
+        if not app.config.get('TSDB_WRITE_BUFFER'):
+            return
+        self.buffer_options = {
+            'batch_size': app.config.get('TSDB_BATCH_SIZE', 500),
+            'max_age': app.config.get('TSDB_FLUSH_INTERVAL', 1.0),
+            'max_size': app.config.get('TSDB_BUFFER_MAX_SIZE', 10000),
+            'retries': app.config.get('TSDB_WRITE_RETRIES', 3),
+        }
+        self.reset_buffer()
+        atexit.register(self.close_buffer)
+
+    def init_retention(self, app):
+        """Read the retention of sensor readings from the app config."""
+        self.retention = Retention.factory(app.config)
+
+    def reset_buffer(self):
+        """
+        Replace the write buffer with an empty one.
+
+        Used after a fork; points buffered by the parent process are flushed by the parent.
+        """
+        if self.buffer_options is not None:
+            self.buffer = WriteBuffer(self.write_batch, **self.buffer_options)
+
+    def close_buffer(self):
+        """Drain the write buffer, e.g. on worker shutdown."""
+        if self.buffer is not None:
+            self.buffer.close()
+
+    def flush(self):
+        """Write all buffered points to the database."""
+        if self.buffer is not None:
+            self.buffer.flush()
+
+    def write_point(self, measurement, point):
+        """
+        Write a single point through the write buffer, if there is one.
+
+        :param measurement: Measurement name
+        :param point: Dict with ``tags``, ``fields`` and ``time``
+        """
+        self.write_points(measurement, [point])
+
+    def write_points(self, measurement, points):
+        """
+        Write points of one measurement through the write buffer, if there is one.
+
+        Buffered points without a time get the current time, so the delay
+        until the next flush does not shift them. The points passed in are
+        not modified.
+
+        :param measurement: Measurement name
+        :param points: List of dicts with ``tags``, ``fields`` and ``time``
+        """
+        if self.buffer is None:
+            self.write_batch(measurement, points)
+            return
+        for point in points:
+            if point.get('time') is None:
+                point = dict(point, time=datetime.utcnow())
+            self.buffer.add(measurement, point)
+
+    def write_batch(self, measurement, points):
+        """
+        Write a batch of points of one measurement.
+
+        :param measurement: Measurement name
+        :param points: List of dicts with ``tags``, ``fields`` and ``time``
+        """
+        raise NotImplementedError("Subclass must implement abstract method")
+
     def add_point(self, sensor, data):
         raise NotImplementedError("Subclass must implement abstract method")
 
+    def add_points(self, sensor, rows):
+        """
+        Add several readings of one sensor.
+
+        :param sensor: Sensor
+        :param rows: List of data dicts, as passed to `add_point`
+        """
+        for data in rows:
+            self.add_point(sensor, data)
+
+    def add_sensor_points(self, items):
+        """
+        Add readings of many sensors, with one write per sensor type.
+
+        :param items: List of (sensor, data) pairs, data as passed to `add_point`
+        """
+        measurements = {}
+        for sensor, data in items:
+            measurements.setdefault(sensor.type, []).append(self.sensor_point(sensor, data))
+        for measurement, points in measurements.items():
+            try:
+                self.write_points(measurement, points)
+            except Exception as e:
+                _LOGGER.error(e)
+
+    def sensor_point(self, sensor, data, time=None):
+        """
+        Build a point from a sensor reading.
+
+        :param sensor: Sensor
+        :param data: Reading, optionally with a ``time`` entry
+        :param time: Time of the reading if not part of ``data``
+        """
+        fields = dict(data.get('data_json', data))
+        fields.pop('last_update', None)
+        if 'time' in fields:
+            time = fields.pop('time')
+        return {
+            "tags": {
+                "sensor_id": sensor.id,
+                "company_id": sensor.company_id
+            },
+            "fields": fields,
+            "time": time
+        }
+
     def add_series(self, measurement, tags, fields, **kwargs):
         raise NotImplementedError("Subclass must implement abstract method")
 
     def get_points(self, sensor, **kwargs):
         raise NotImplementedError("Subclass must implement abstract method")
 
+    def get_stats(self, sensor, start_date, end_date, group_duration, offset_interval=None, value_fields=None):
+        """
+        Count, sum, minimum and maximum of each field of a sensor per group.
+
+        Runs a grouped `get_points` query per statistic; clients which
+        group the readings themselves compute all of them in one pass.
+
+        :param start_date: ISO time the range starts at
+        :param end_date: ISO time the range ends at, inclusive
+        :return: Dict of the UNIX microseconds groups holding values start at
+                 and their statistics, see `merge_stats`
+        """
+        width = parse_duration(group_duration)
+        limit = (_parse_micros(end_date) - _parse_micros(start_date)) // width + 2
+        stats = {}
+        for function in STATS:
+            result = self.get_points(sensor, limit=limit, order_by='time ASC', start_date=start_date,
+                                     end_date=end_date, group_duration=group_duration,
+                                     offset_interval=offset_interval, aggregate_function=function,
+                                     value_fields=value_fields, include=['data'], total=TOTAL_NONE)
+            prefix = function.lower() + '_'
+            for row in result['data'] or []:
+                for name, value in row.items():
+                    if name.startswith(prefix) and value is not None and (function != 'COUNT' or value):
+                        fields = stats.setdefault(_parse_micros(row['time']), {})
+                        fields.setdefault(name[len(prefix):], {})[function] = value
+        return stats
+
     def delete_sensor_type(self, type):
         pass
 
@@ -49,6 +642,15 @@ class TSDBClient:
     def delete_points(self, **kwargs):
         pass
 
+    def update_rollups(self, measurement, sensors, companies=None):
+        pass
+
+    def backfill_rollups(self, measurement, sensors, start, log=None, companies=None):
+        pass
+
+    def expire(self, measurement, sensors):
+        pass
+
 
 class TSDB:
     """Time series database Class"""
@@ -56,6 +658,10 @@ class TSDB:
     def __init__(self):
         self.client = None
         self.logger = None
+        #: QueryCache of grouped and aggregate sensor queries, if enabled
+        self.cache = None
+        #: Retention of sensor readings, see TSDB_RETENTION
+        self.retention = Retention()
 
     def init_app(self, app):
         """
@@ -63,10 +669,11 @@ class TSDB:
 
         :param app: Flask application
         """
-        # if app.config['TSDB_CLIENT'] == 'influx':
-        # from .influx import InfluxClient
-        from .cassandra_client import CassandraClient
-        self.client = CassandraClient(app)
+        from .cache import QueryCache
+        self.client = TSDBClient.factory(app.config['TSDB_CLIENT'])
+        self.client.init_app(app)
+        self.retention = self.client.retention
+        self.cache = QueryCache.factory(app.config)
 
     def add_point(self, sensor, data):
         """
@@ -76,8 +683,32 @@ class TSDB:
         :param data: Data
         :return:
         """
+        if self.cache is not None:
+            self.cache.written(sensor.id, [data.get('time')])
         return self.client.add_point(sensor, data)
 
+    def add_points(self, sensor, rows):
+        """
+        Add several readings of one sensor.
+
+        :param sensor: Sensor
+        :param rows: List of data dicts
+        """
+        if self.cache is not None:
+            self.cache.written(sensor.id, [row.get('time') for row in rows])
+        return self.client.add_points(sensor, rows)
+
+    def add_sensor_points(self, items):
+        """
+        Add readings of many sensors.
+
+        :param items: List of (sensor, data) pairs
+        """
+        if self.cache is not None:
+            for sensor, data in items:
+                self.cache.written(sensor.id, [data.get('time')])
+        return self.client.add_sensor_points(items)
+
     def add_series(self, measurement, tags, fields, **kwargs):
         """
         Add new point to database.
@@ -93,7 +724,14 @@ class TSDB:
         :param start_date: Start Date of date range
         :param end_date: End Date of date range
         :param sensor: Sensor
+        :param cursor: Cursor of the page, from the ``next`` of the previous one
+        :raises InvalidCursor: If the cursor is invalid
+
+        Grouped and aggregate queries are answered from the query cache when
+        it is enabled.
         """
+        if self.cache is not None and self.cache.cacheable(**kwargs):
+            return self.cache.get_points(self.client, sensor, **kwargs)
         return self.client.get_points(sensor, **kwargs)
 
     def get_points_raw(self, measurement, **kwargs):
@@ -101,25 +739,88 @@ class TSDB:
         Get sensor readings from database.
 
         :param measurement: Measurement
+        :param cursor: Cursor of the page, from the ``next`` of the previous one
+        :raises InvalidCursor: If the cursor is invalid
         """
         return self.client.get_points_raw(measurement, **kwargs)
 
     def delete_sensor_type(self, type):
         """Delete a series on deletion of a sensor type."""
         self.client.delete_measurement(type)
+        self.invalidate()
 
     def create_sensor(self, sensor_type, value_fields):
         self.client.create_sensor(sensor_type, value_fields)
 
-    def delete_points(self, **kwargs):
+    def delete_points(self, measurement=None, tags=None, **kwargs):
         """
         Delete from database.
 
+        :param measurement: Measurement
+        :param tags: Tags of the points, like ``sensor_id``
         :param start_date: Start Date of date range
         :param end_date: End Date of date range
-        :param sensor: Sensor
         """
-        return self.client.delete_points(**kwargs)
+        result = self.client.delete_points(measurement=measurement, tags=tags, **kwargs)
+        self.invalidate((tags or {}).get('sensor_id'))
+        return result
+
+    def update_rollups(self, measurement, sensors, companies=None):
+        """
+        Roll up the readings of a sensor type written since the last update,
+        with TSDB_ROLLUPS.
+
+        :param measurement: Sensor type
+        :param sensors: Dict of sensor IDs and the naive UTC datetime of
+                        their last reading
+        :param companies: Dict of sensor IDs and company IDs, for the
+                          retention of the rollups
+        """
+        return self.client.update_rollups(measurement, sensors, companies=companies)
+
+    def backfill_rollups(self, measurement, sensors, start, log=None, companies=None):
+        """
+        Roll up the readings of a sensor type from `start` until where its
+        rollups started.
+
+        :param sensors: IDs of the sensors
+        :param start: Naive UTC datetime
+        :param log: Function logging the progress
+        :param companies: Dict of sensor IDs and company IDs
+        :return: Number of written rollup points, or None if the client has
+                 no rollups
+        """
+        return self.client.backfill_rollups(measurement, sensors, start, log=log or print, companies=companies)
+
+    def expire(self, measurement, sensors):
+        """
+        Drop what the database keeps about readings past their retention
+        and does not expire itself.
+
+        :param measurement: Sensor type
+        :param sensors: Dict of sensor IDs and company IDs
+        """
+        return self.client.expire(measurement, sensors)
+
+    def invalidate(self, sensor_id=None):
+        """Drop the cached queries of a sensor, or of all sensors"""
+        if self.cache is not None:
+            self.cache.invalidate(sensor_id)
+
+    def create_defaults(self):
+        """Create the default series."""
+        self.client.create_defaults()
+
+    def flush(self):
+        """Write all buffered points to the database."""
+        if self.client is not None:
+            self.client.flush()
+
+    def close_buffer(self):
+        """Drain the write buffer, e.g. on worker shutdown."""
+        if self.client is not None:
+            self.client.close_buffer()
 
     def restart(self):
-        self.client.restart()
\ No newline at end of file
+        if self.client is not None:
+            self.client.restart()
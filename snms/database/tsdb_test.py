@@ -0,0 +1,213 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from snms.database.exceptions import InvalidCursor
+from snms.database.tsdb import (Retention, TSDBClient, WriteBuffer, encode_cursor, merge_stats, page_cursor, parse_duration,
+                                stats_aggregate, stats_rows, stats_total, time_cursor)
+
+
+class _Writes:
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+        self.lock = threading.Lock()
+
+    def __call__(self, measurement, points):
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise IOError('database down')
+            self.batches.append((measurement, list(points)))
+
+
+def test_write_buffer_batches_per_measurement():
+    writes = _Writes()
+    buffer = WriteBuffer(writes, batch_size=2, max_age=60)
+    for i in range(3):
+        buffer.add('temperature', {'fields': {'value': i}})
+    buffer.add('humidity', {'fields': {'value': 10}})
+    buffer.close()
+    batches = sorted((measurement, [p['fields']['value'] for p in points]) for measurement, points in writes.batches)
+    assert batches == [('humidity', [10]), ('temperature', [0, 1]), ('temperature', [2])]
+    assert len(buffer) == 0
+
+
+def test_write_buffer_flushes_old_points():
+    flushed = threading.Event()
+
+    def write(measurement, points):
+        flushed.set()
+
+    buffer = WriteBuffer(write, batch_size=100, max_age=0.05)
+    buffer.add('temperature', {'fields': {'value': 1}})
+    assert flushed.wait(5)
+    buffer.close()
+
+
+def test_write_buffer_retries_failed_writes():
+    writes = _Writes(failures=2)
+    buffer = WriteBuffer(writes, max_age=0.01, retries=2)
+    buffer.add('temperature', {'fields': {'value': 1}})
+    buffer.close()
+    assert [len(points) for _, points in writes.batches] == [1]
+    assert buffer.failed == 0
+
+
+def test_write_buffer_counts_dropped_points():
+    writes = _Writes(failures=10)
+    buffer = WriteBuffer(writes, max_age=0.01, retries=1)
+    buffer.add('temperature', {'fields': {'value': 1}})
+    buffer.add('temperature', {'fields': {'value': 2}})
+    buffer.close()
+    assert writes.batches == []
+    assert buffer.failed == 2
+    assert len(buffer) == 0
+
+
+def test_write_buffer_closed():
+    buffer = WriteBuffer(_Writes())
+    buffer.close()
+    with pytest.raises(RuntimeError):
+        buffer.add('temperature', {})
+
+
+def test_write_points_keeps_caller_points():
+    writes = _Writes()
+    client = TSDBClient()
+    client.buffer = WriteBuffer(writes, max_age=60)
+    point = {'tags': {'sensor_id': 1}, 'fields': {'value': 1}, 'time': None}
+    client.write_points('temperature', [point])
+    client.close_buffer()
+    assert point['time'] is None
+    [(_, [written])] = writes.batches
+    assert written['time'] is not None
+    assert written['fields'] == point['fields']
+
+
+def test_time_cursor_round_trip():
+    data = [{'time': 1}, {'time': 2}, {'time': 2}]
+    assert page_cursor(time_cursor(data, 'asc'), 'asc') == (2, 2)
+
+
+def test_time_cursor_adds_skipped_points_of_the_same_time():
+    data = [{'time': 5}, {'time': 5}]
+    assert page_cursor(time_cursor(data, 'desc', after=(5, 3)), 'desc') == (5, 5)
+    assert page_cursor(time_cursor(data, 'desc', after=(6, 3)), 'desc') == (5, 2)
+
+
+@pytest.mark.parametrize('cursor', (
+    'not a cursor',
+    encode_cursor(t=1, n=1, o='desc'),
+    encode_cursor(t=1, o='asc'),
+    encode_cursor(t=1, n='1', o='asc'),
+    encode_cursor(n=1, o='asc'),
+))
+def test_page_cursor_invalid(cursor):
+    with pytest.raises(InvalidCursor):
+        page_cursor(cursor, 'asc')
+
+
+@pytest.mark.parametrize(('value', 'expected'), (
+    ('1s', 10 ** 6),
+    ('1h30m', 90 * 60 * 10 ** 6),
+    ('-15m', -15 * 60 * 10 ** 6),
+    ('2w', 14 * 86400 * 10 ** 6),
+    ('1d12h', 36 * 3600 * 10 ** 6),
+    ('250ms', 250000),
+    ('5us', 5),
+    ('5u', 5),
+    ('5µ', 5),
+    ('3000ns', 3),
+    (' 1m ', 60 * 10 ** 6),
+))
+def test_parse_duration(value, expected):
+    assert parse_duration(value) == expected
+
+
+@pytest.mark.parametrize('value', ('', None, '1', 'm', '1y', '1h 30m', '1.5h', '1h-', '--1h'))
+def test_parse_duration_invalid(value):
+    with pytest.raises(ValueError):
+        parse_duration(value)
+
+
+def test_merge_stats():
+    fields = {'a': {'COUNT': 2, 'SUM': 3.0, 'MIN': 1.0, 'MAX': 2.0}}
+    merge_stats(fields, {'a': {'COUNT': 1, 'SUM': 5.0, 'MIN': 5.0, 'MAX': 5.0},
+                         'b': {'COUNT': 1, 'SUM': None, 'MIN': None, 'MAX': None},
+                         'c': {'COUNT': 0, 'SUM': 0.0, 'MIN': None, 'MAX': None}})
+    assert fields == {'a': {'COUNT': 3, 'SUM': 8.0, 'MIN': 1.0, 'MAX': 5.0},
+                      'b': {'COUNT': 1, 'SUM': None, 'MIN': None, 'MAX': None}}
+
+
+def test_stats_rows():
+    stats = {1: {'a': {'COUNT': 2, 'SUM': 3.0, 'MIN': 1.0, 'MAX': 2.0}}, 3: {'a': {'COUNT': 1, 'SUM': 4.0}}}
+    assert stats_rows(stats, 'MEAN', 0, 3, 60 * 10 ** 6, shift=10 ** 6) == [
+        {'time': '1970-01-01T00:00:01Z', 'mean_a': None},
+        {'time': '1970-01-01T00:01:01Z', 'mean_a': 1.5},
+        {'time': '1970-01-01T00:02:01Z', 'mean_a': None},
+        {'time': '1970-01-01T00:03:01Z', 'mean_a': 4.0},
+    ]
+    assert [row['count_a'] for row in stats_rows(stats, 'COUNT', 0, 3, 60 * 10 ** 6)] == [0, 2, 0, 1]
+    assert [row['max_a'] for row in stats_rows(stats, 'MAX', 1, 3, 60 * 10 ** 6)] == [2.0, None, None]
+    assert stats_rows({}, 'MIN', 0, 1, 10 ** 6) == [{'time': '1970-01-01T00:00:00Z'},
+                                                   {'time': '1970-01-01T00:00:01Z'}]
+
+
+def test_stats_total_and_aggregate():
+    buckets = [{'a': {'COUNT': 2, 'SUM': 3.0, 'MIN': 1.0, 'MAX': 2.0}, 'b': {'COUNT': 1, 'SUM': 7.0}},
+               {'a': {'COUNT': 1, 'SUM': 6.0, 'MIN': 6.0, 'MAX': 6.0}}]
+    assert stats_total(buckets) == 3
+    assert stats_aggregate(buckets)['mean_a'] == 3.0
+    assert stats_aggregate(buckets)['max_a'] == 6.0
+    assert (stats_total([]), stats_aggregate([{}])) == (0, None)
+
+
+@pytest.fixture
+def retention():
+    return Retention.factory({
+        'TSDB_RETENTION': 30,
+        'TSDB_RETENTION_TYPES': {'camera': {'raw': 7, '1h': 90, '1d': 0}},
+        'TSDB_RETENTION_COMPANIES': {5: 1, '6': {'1m': 2}},
+    })
+
+
+@pytest.mark.parametrize(('measurement', 'company_id', 'level', 'days'), (
+    ('temperature', None, 'raw', 30),
+    ('temperature', None, '1h', 0),
+    ('camera', None, 'raw', 7),
+    ('camera', None, '1h', 90),
+    ('camera', None, '1d', 0),
+    ('camera', None, '1m', 0),
+    ('camera', 5, 'raw', 1),
+    ('camera', '5', '1h', 90),
+    ('camera', 6, '1m', 2),
+    ('camera', 6, 'raw', 7),
+))
+def test_retention_days(retention, measurement, company_id, level, days):
+    assert retention.days(measurement, company_id, level) == days
+    assert retention.seconds(measurement, company_id, level) == days * 86400
+
+
+def test_retention_expires(retention):
+    now = datetime(2018, 5, 10)
+    assert retention.expires('camera', None, now - timedelta(days=6), now=now) == 86400
+    assert retention.expires('camera', None, now - timedelta(days=8), now=now) == -86400
+    assert retention.expires('camera', None, now - timedelta(days=8), '1d', now=now) is None
+
+
+def test_retention_covers(retention):
+    now = datetime.utcnow()
+    # The rollup is kept longer than the readings
+    assert retention.covers('camera', None, '1h', now - timedelta(days=30))
+    # Both have expired
+    assert retention.covers('camera', None, '1h', now - timedelta(days=91))
+    # The readings are still kept when the rollup has expired
+    assert not retention.covers('camera', 6, '1m', now - timedelta(days=3))
+
+
+def test_retention_bool():
+    assert not Retention()
+    assert not Retention.factory({})
+    assert Retention(types={'camera': 7})
@@ -11,6 +11,7 @@ from flask_restful import Resource, reqparse
 from werkzeug.exceptions import Forbidden, NotFound
 
 from snms.database import tsdb
+from snms.database.exceptions import InvalidCursor
 from snms.core.db import db
 from snms.models import add_event_log
 from snms.modules.companies import Company #, company_user_table
@@ -144,7 +145,10 @@ class AlertHistoryResource(Resource):
             if alert:
                 tags["alert_id"] = alert.uid
         try:
-            return tsdb.get_points_raw(ALERT_HISTORY_SERIES, tags=tags, order_by='time desc', limit=limit, offset=offset)
+            return tsdb.get_points_raw(ALERT_HISTORY_SERIES, tags=tags, order_by='time desc', limit=limit, offset=offset,
+                                       cursor=request.args.get('cursor'), total=request.args.get('total'))
+        except InvalidCursor:
+            return {'error': 'Invalid cursor'}, 400
         except Exception as e:
             _LOGGER.error(e)
             return {'error': 'Server error'}, 500
@@ -11,6 +11,7 @@ from flask import request
 from flask_restful import Resource
 
 from snms.database import tsdb
+from snms.database.exceptions import InvalidCursor
 from snms.utils import get_filters
 from snms.core.logger import Logger
 from snms.modules.companies import Company, company_required
@@ -112,7 +113,10 @@ class EventLogResource(Resource):
         if "sensor_id" in filter.keys():
             tags["sensor_id"] = filter["sensor_id"]
         try:
-            return tsdb.get_points_raw(EVENT_LOG_SERIES, tags=tags, order_by='time desc', limit=limit, offset=offset)
+            return tsdb.get_points_raw(EVENT_LOG_SERIES, tags=tags, order_by='time desc', limit=limit, offset=offset,
+                                       cursor=request.args.get('cursor'), total=request.args.get('total'))
+        except InvalidCursor:
+            return {'error': 'Invalid cursor'}, 400
         except Exception as e:
             _LOGGER.error(e)
             return {'error': 'Server error'}, 500
\ No newline at end of file
@@ -12,6 +12,7 @@ from werkzeug.exceptions import Forbidden, NotFound
 from datetime import datetime, timezone
 
 from snms.database import tsdb
+from snms.database.exceptions import InvalidCursor
 from snms.core.db import db
 from snms.models import add_event_log
 from snms.modules.companies import Company #, company_user_table
@@ -146,7 +147,10 @@ class EventHistoryResource(Resource):
             if event:
                 tags["event_id"] = event.id
         try:
-            return tsdb.get_points_raw(EVENT_HISTORY_SERIES, tags=tags, order_by='time desc', limit=limit, offset=offset)
+            return tsdb.get_points_raw(EVENT_HISTORY_SERIES, tags=tags, order_by='time desc', limit=limit, offset=offset,
+                                       cursor=request.args.get('cursor'), total=request.args.get('total'))
+        except InvalidCursor:
+            return {'error': 'Invalid cursor'}, 400
         except Exception as e:
             _LOGGER.error(e)
             return {'error': 'Server error'}, 500
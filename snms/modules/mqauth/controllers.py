@@ -14,7 +14,7 @@ from flask import make_response
 
 from snms.core.logger import Logger
 from snms.core.config import config
-from snms.modules.sensors import Sensor
+from snms.modules.sensors.identity import get_sensor_by_uid
 from snms.modules.companies import Company
 _LOGGER = Logger.get(__name__)
 
@@ -43,10 +43,9 @@ class UserPathResource(Resource):
 
         if username.startswith('sensor'):
             sensor_uid = username.split("_")[1]
-            sensor = Sensor.query.filter(Sensor.uid == sensor_uid) \
-                .filter(Sensor.key == password).filter(Sensor.deleted == False).first()
+            sensor = get_sensor_by_uid(sensor_uid)
             _LOGGER.debug("Sensor UID %s", sensor_uid)
-            if sensor:
+            if sensor and sensor.key == password:
                 return make_response("allow")
         elif username.startswith('company'):
             company_uid = username.split("_")[1]
@@ -129,6 +128,8 @@ class ResourcePathResource(Resource):
             sensor_uid = username.split("_")[1]
             if name == 'sensors/{}/values'.format(sensor_uid):
                 return make_response("allow")
+            elif name.startswith('sensors/{}/values/'.format(sensor_uid)) and name.count('/') == 3:
+                return make_response("allow")
             elif name == 'sensors/{}/configuration'.format(sensor_uid):
                 return make_response("allow")
             else:
@@ -136,13 +137,12 @@ class ResourcePathResource(Resource):
                 return make_response("deny")
         elif username.startswith('company') and resource=='topic':
             company_uid = username.split("_")[1]
-            company = Company.query.filter(Company.uid == company_uid).filter(Company.deleted == False).first()
             try:
                 sensor_uid = name.split('/')[1]
             except:
                 return make_response("deny")
-            sensor = Sensor.query.filter(Sensor.uid == sensor_uid).filter(Sensor.deleted == False).first()
-            if company and sensor.company_id == company.id and name.startswith('sensors/'):
+            sensor = get_sensor_by_uid(sensor_uid)
+            if sensor and sensor.company_uid == company_uid and name.startswith('sensors/'):
                 return make_response("allow")
             else:
                 _LOGGER.debug("Resource Denied: %s, %s" % (username, name))
@@ -185,6 +185,8 @@ class TopicPathResource(Resource):
             sensor_uid = username.split("_")[1]
             if routing_key == 'sensors.{}.values'.format(sensor_uid):
                 return make_response("allow")
+            elif routing_key.startswith('sensors.{}.values.'.format(sensor_uid)) and routing_key.count('.') == 3:
+                return make_response("allow")
             elif routing_key == 'sensors.{}.configuration'.format(sensor_uid):
                 return make_response("allow")
             else:
@@ -192,13 +194,12 @@ class TopicPathResource(Resource):
                 return make_response("deny")
         elif username.startswith('company') and resource == 'topic':
             company_uid = username.split("_")[1]
-            company = Company.query.filter(Company.uid == company_uid).filter(Company.deleted == False).first()
             try:
                 sensor_uid = routing_key.split('.')[1]
             except:
                 return make_response("deny")
-            sensor = Sensor.query.filter(Sensor.uid == sensor_uid).filter(Sensor.deleted == False).first()
-            if company and sensor.company_id == company.id and routing_key.startswith('sensors.'):
+            sensor = get_sensor_by_uid(sensor_uid)
+            if sensor and sensor.company_uid == company_uid and routing_key.startswith('sensors.'):
                 return make_response("allow")
             else:
                 _LOGGER.debug("Resource Denied: %s, %s" % (username, routing_key))
@@ -14,7 +14,7 @@ from snms.core.db import db
 from snms.core.logger import Logger
 from snms.modules.ota import Firmware, FirmwareRequestSchema
 from snms.utils import get_filters
-from snms.modules.sensors import Sensor
+from snms.modules.sensors.identity import get_sensor_by_uid, get_sensor_by_hid
 # from snms.web.util import send_file
 _LOGGER = Logger.get()
 
@@ -141,7 +141,7 @@ class FirmwareCheckResource(Resource):
             mgos_header = request.headers.get('X-MGOS-Device-ID')
             if mgos_header:
                 sensor_hid = mgos_header.split()[0]
-                sensor = Sensor.query.filter(Sensor.hid == sensor_hid).first()
+                sensor = get_sensor_by_hid(sensor_hid)
                 if sensor:
                     sensor_uid = sensor.uid
         if not sensor_uid:
@@ -153,9 +153,9 @@ class FirmwareCheckResource(Resource):
                 return {"error": "Sensor id required"}, 404
         sensor = None
         if sensor_uid:
-            sensor = Sensor.query.filter(Sensor.uid == sensor_uid).first()
+            sensor = get_sensor_by_uid(sensor_uid)
         else:
-            sensor = Sensor.query.filter(Sensor.hid == sensor_hid).first()
+            sensor = get_sensor_by_hid(sensor_hid)
             # TODO: Check for sensor type
         if not sensor:
             return {"error": "Sensor not found"}, 404
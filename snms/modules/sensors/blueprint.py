@@ -15,7 +15,7 @@ from snms.modules.sensors.controllers import SensorsCollectionResource, \
     SensorsResource, SensorConfigResource, SensorHIDResource, SensorValueResource, \
     SensorHIDValuesResources, SensorsByTypeResource, SensorHistoryResource, \
     SensorDataExportResource, SensorAggregateResource, SensorHIDConfigResource, \
-    SensorHIDConfigAck, SensorValueDeleteResource
+    SensorHIDConfigAck, SensorValueDeleteResource, SensorBulkValuesResource, CompanyBulkValuesResource
 
 from snms.modules.sensors.sensor_types_controller import SensorTypesCollectionResource, \
     SensorTypeResource, AllSensorTypes, SensorDataTypes
@@ -48,6 +48,8 @@ _api.add_resource(SensorHIDConfigResource, '/companies/<string:company_id>/senso
 _api.add_resource(SensorHIDConfigAck, '/companies/<string:company_id>/sensor_by_hid/<string:sensor_hid>/configuration/ack')
 
 _api.add_resource(SensorValueResource, '/sensors/<string:sensor_id>/values')
+_api.add_resource(SensorBulkValuesResource, '/sensors/<string:sensor_id>/values/bulk')
+_api.add_resource(CompanyBulkValuesResource, '/companies/<string:company_id>/values/bulk')
 _api.add_resource(SensorHistoryResource, 
                   '/sensors/<string:sensor_id>/history',
                   '/companies/<string:company_id>/sensor_by_hid/<string:sensor_hid>/history'
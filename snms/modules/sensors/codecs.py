@@ -0,0 +1,195 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Payload codecs for sensor readings received over MQTT.
+
+The codec of a message is selected by the last part of its topic, e.g.
+``sensors/<uid>/values/msgpack``, or else by the AMQP ``content_type``
+property; JSON is the default. Every codec decodes a payload into the
+mapping of field names and optional ``time`` that `ValueValidator`
+expects.
+
+``msgpack`` and ``cbor`` payloads are maps like the JSON ones, or arrays
+of ``[time, value, ...]`` with the values in the order of the non-file
+`SensorType.value_fields`. ``compact`` payloads are the same array packed
+as a little-endian uint32 UNIX time (0 for none) followed by one float32
+per field (NaN for none).
+
+The ``msgpack`` and ``cbor`` codecs require the optional ``msgpack`` and
+``cbor2`` packages.
+"""
+
+import json
+import math
+import struct
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+CBOR = 'cbor'
+COMPACT = 'compact'
+
+CONTENT_TYPES = {
+    'application/json': JSON,
+    'application/msgpack': MSGPACK,
+    'application/x-msgpack': MSGPACK,
+    'application/cbor': CBOR,
+    'application/vnd.snms.compact': COMPACT,
+}
+
+
+class DecodeError(ValueError):
+    """A payload can not be decoded"""
+
+
+def get_codec(suffix=None, content_type=None):
+    """
+    Get the codec of a message.
+
+    :param suffix: Last part of the topic after ``values``, if any
+    :param content_type: Content type of the message
+    :return: Codec name or None if it is not supported
+    """
+    if suffix:
+        return suffix if suffix in _decoders else None
+    if content_type:
+        return CONTENT_TYPES.get(content_type.split(';')[0].strip().lower())
+    return JSON
+
+
+def positional(validator, items):
+    """
+    Map ``[time, value, ...]`` to the fields of a sensor type.
+
+    :param validator: ValueValidator of the sensor type
+    :param items: Time followed by the values in field order
+    :return: Reading dict
+    """
+    if not items:
+        raise DecodeError('Empty reading')
+    if len(items) - 1 > len(validator.positional_fields):
+        raise DecodeError('Reading has {} values, sensor type has {} fields'.format(
+            len(items) - 1, len(validator.positional_fields)))
+    data = dict(zip(validator.positional_fields, items[1:]))
+    if items[0]:
+        data['time'] = items[0]
+    return data
+
+
+def _mapping(validator, data):
+    if isinstance(data, dict):
+        return data
+    if isinstance(data, (list, tuple)):
+        return positional(validator, data)
+    raise DecodeError('Reading must be a map or an array')
+
+
+def _load_json(payload):
+    try:
+        return json.loads(payload.decode('utf-8'))
+    except ValueError as e:
+        raise DecodeError(str(e))
+
+
+def _load_msgpack(payload):
+    try:
+        import msgpack
+    except ImportError:
+        raise DecodeError('The msgpack codec requires the msgpack package')
+    try:
+        return msgpack.unpackb(payload, raw=False)
+    except Exception as e:
+        raise DecodeError(str(e))
+
+
+def _load_cbor(payload):
+    try:
+        import cbor2
+    except ImportError:
+        raise DecodeError('The cbor codec requires the cbor2 package')
+    try:
+        return cbor2.loads(payload)
+    except Exception as e:
+        raise DecodeError(str(e))
+
+
+def _load_compact(payload):
+    count, rest = divmod(len(payload) - 4, 4)
+    if count < 0 or rest:
+        raise DecodeError('Compact reading must be a time and float32 values')
+    items = struct.unpack('<I{}f'.format(count), payload)
+    return [items[0]] + [None if math.isnan(item) else item for item in items[1:]]
+
+
+def _decode_json(payload, validator):
+    data = _load_json(payload)
+    if not isinstance(data, dict):
+        raise DecodeError('Reading must be a JSON object')
+    return data
+
+
+def _decode_msgpack(payload, validator):
+    return _mapping(validator, _load_msgpack(payload))
+
+
+def _decode_cbor(payload, validator):
+    return _mapping(validator, _load_cbor(payload))
+
+
+def _decode_compact(payload, validator):
+    return positional(validator, _load_compact(payload))
+
+
+_loaders = {
+    JSON: _load_json,
+    MSGPACK: _load_msgpack,
+    CBOR: _load_cbor,
+    COMPACT: _load_compact,
+}
+
+_decoders = {
+    JSON: _decode_json,
+    MSGPACK: _decode_msgpack,
+    CBOR: _decode_cbor,
+    COMPACT: _decode_compact,
+}
+
+
+def decode(codec, payload, validator):
+    """
+    Decode a payload into a reading.
+
+    :param codec: Codec name
+    :param payload: Message body
+    :param validator: ValueValidator of the sensor type
+    :return: Reading dict
+    :raises DecodeError: If the payload can not be decoded
+    """
+    try:
+        decoder = _decoders[codec]
+    except KeyError:
+        raise DecodeError('Unknown codec {}'.format(codec))
+    return decoder(payload, validator)
+
+
+def peek(codec, payload):
+    """
+    Time and message id of a payload, read without the sensor type.
+
+    :param codec: Codec name
+    :param payload: Message body
+    :return: Tuple of the time and the ``message_id`` field, None where the
+             payload has none or can not be decoded
+    """
+    try:
+        data = _loaders[codec](payload)
+    except (KeyError, DecodeError):
+        return None, None
+    if isinstance(data, dict):
+        return data.get('time'), data.get('message_id')
+    if isinstance(data, (list, tuple)) and data and codec != JSON:
+        return data[0] or None, None
+    return None, None
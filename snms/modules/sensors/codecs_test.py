@@ -0,0 +1,100 @@
+import json
+import math
+import struct
+
+import pytest
+
+from snms.modules.sensors import codecs
+from snms.modules.sensors.validators import ValueValidator
+
+
+@pytest.fixture
+def validator():
+    return ValueValidator('weather', {
+        'temperature': {'type': 'number'},
+        'photo': {'type': 'file'},
+        'humidity': {'type': 'number'},
+    })
+
+
+@pytest.mark.parametrize(('suffix', 'content_type', 'expected'), (
+    (None, None, codecs.JSON),
+    ('msgpack', None, codecs.MSGPACK),
+    ('compact', 'application/json', codecs.COMPACT),
+    ('xml', None, None),
+    (None, 'application/CBOR; charset=binary', codecs.CBOR),
+    (None, 'text/plain', None),
+))
+def test_get_codec(suffix, content_type, expected):
+    assert codecs.get_codec(suffix, content_type) == expected
+
+
+def test_decode_json(validator):
+    payload = json.dumps({'temperature': 21.5, 'time': '2018-05-01T10:00:00'}).encode('utf-8')
+    assert codecs.decode(codecs.JSON, payload, validator) == {'temperature': 21.5, 'time': '2018-05-01T10:00:00'}
+
+
+@pytest.mark.parametrize('payload', (b'[1, 2]', b'{"temperature":', b'\xff'))
+def test_decode_json_invalid(validator, payload):
+    with pytest.raises(codecs.DecodeError):
+        codecs.decode(codecs.JSON, payload, validator)
+
+
+def test_decode_msgpack(validator):
+    msgpack = pytest.importorskip('msgpack')
+    assert codecs.decode(codecs.MSGPACK, msgpack.packb({'temperature': 21.5}), validator) == {'temperature': 21.5}
+    assert codecs.decode(codecs.MSGPACK, msgpack.packb([1525168800, 21.5, 40]), validator) == \
+        {'time': 1525168800, 'temperature': 21.5, 'humidity': 40}
+    with pytest.raises(codecs.DecodeError):
+        codecs.decode(codecs.MSGPACK, msgpack.packb('text'), validator)
+
+
+def test_decode_cbor(validator):
+    cbor2 = pytest.importorskip('cbor2')
+    assert codecs.decode(codecs.CBOR, cbor2.dumps({'humidity': 40}), validator) == {'humidity': 40}
+    assert codecs.decode(codecs.CBOR, cbor2.dumps([0, 21.5]), validator) == {'temperature': 21.5}
+    with pytest.raises(codecs.DecodeError):
+        codecs.decode(codecs.CBOR, b'\xff\xff', validator)
+
+
+def test_decode_compact(validator):
+    payload = struct.pack('<I2f', 1525168800, 21.5, float('nan'))
+    assert codecs.decode(codecs.COMPACT, payload, validator) == \
+        {'time': 1525168800, 'temperature': 21.5, 'humidity': None}
+    data = codecs.decode(codecs.COMPACT, struct.pack('<If', 0, 1.25), validator)
+    assert data == {'temperature': 1.25}
+    assert not math.isnan(data['temperature'])
+
+
+@pytest.mark.parametrize('payload', (b'', b'\x00\x00\x00', b'\x00\x00\x00\x00\x00',
+                                     struct.pack('<I3f', 0, 1, 2, 3)))
+def test_decode_compact_invalid(validator, payload):
+    with pytest.raises(codecs.DecodeError):
+        codecs.decode(codecs.COMPACT, payload, validator)
+
+
+def test_decode_unknown_codec(validator):
+    with pytest.raises(codecs.DecodeError):
+        codecs.decode('xml', b'<value/>', validator)
+
+
+@pytest.mark.parametrize(('codec', 'payload', 'expected'), (
+    (codecs.JSON, b'{"time": 5, "message_id": "m", "temperature": 1}', (5, 'm')),
+    (codecs.JSON, b'{"temperature": 1}', (None, None)),
+    (codecs.JSON, b'[5, 1]', (None, None)),
+    (codecs.JSON, b'not json', (None, None)),
+    (codecs.COMPACT, struct.pack('<If', 5, 1.0), (5, None)),
+    (codecs.COMPACT, struct.pack('<If', 0, 1.0), (None, None)),
+    (codecs.COMPACT, b'\0', (None, None)),
+    ('xml', b'<time>5</time>', (None, None)),
+    (None, b'{"time": 5}', (None, None)),
+))
+def test_peek(codec, payload, expected):
+    assert codecs.peek(codec, payload) == expected
+
+
+def test_peek_msgpack():
+    msgpack = pytest.importorskip('msgpack')
+    assert codecs.peek(codecs.MSGPACK, msgpack.packb({'time': 5, 'temperature': 1})) == (5, None)
+    assert codecs.peek(codecs.MSGPACK, msgpack.packb([5, 1.0])) == (5, None)
+    assert codecs.peek(codecs.MSGPACK, msgpack.packb([None, 1.0])) == (None, None)
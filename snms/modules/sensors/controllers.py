@@ -8,29 +8,36 @@
 # pylint: disable=invalid-name, import-error
 import uuid
 from functools import wraps
-from flask_restful import Resource, reqparse
+from flask_restful import Resource, abort
 from flask import g, request, Response, url_for
 from werkzeug.exceptions import Forbidden, NotFound
 import datetime
-import werkzeug
 import json
 from dateutil import parser
 import pytz
 
 from snms.models import add_event_log
 from snms.database import tsdb
+from snms.database.exceptions import InvalidCursor
+from snms.database.tsdb import HISTORY_PARTS
 from snms.core import signals
 from snms.core.config import config
 from snms.core.db import db
 from snms.core.logger import Logger
 from snms.modules.companies import Company, user_company_acl_role
 from snms.modules.sensors import Sensor, get_all_types, access_control
+from snms.modules.sensors.state import sensor_states
+from snms.modules.sensors.identity import get_sensor_by_uid, get_sensor_by_hid, get_sensors
+from snms.modules.sensors.validators import get_validator, InvalidValue
+from snms.modules.sensors import codecs
+from snms.modules.sensors.dedup import dedup_key, is_duplicate, remember
 from .schema import SensorRequestSchema, ValueSchema
 from snms.utils import get_filters
 from snms.utils.check_alerts import process_sensor_alerts
 from snms.utils.crypto import generate_uid, generate_key
 from snms.modules.files import BinFile
 from snms.core.mqtt import mqtt
+from snms.core.mqtt.echo import publish_value
 from snms.const import ROLE_ADMIN, ROLE_READ
 from snms.tasks import delete_sensor_data
 
@@ -323,123 +330,313 @@ def time_in_range(start, end, x):
         return start <= x or x <= end
 
 
-def post_sensor_value_with_uid(sensor_uid, data, now, from_mqtt=False):
-    sensor = Sensor.query.filter(Sensor.uid == sensor_uid).filter(Sensor.deleted == False).first()
+def post_sensor_value_with_uid(sensor_uid, data, now, from_mqtt=False, codec=None):
+    sensor = get_sensor_by_uid(sensor_uid)
     if sensor is None:
         _LOGGER.info("Sensor not found")
-        return
-    post_sensor_values(sensor, data, now, from_mqtt)
+        return None
+    return post_sensor_values(sensor, data, now, from_mqtt, codec)
 
 
-def post_sensor_value_with_hid(sensor_hid, data, now, from_mqtt=False):
-    sensor = Sensor.query.filter(Sensor.hid == sensor_hid).filter(Sensor.deleted == False).first()
+def post_sensor_value_with_hid(sensor_hid, data, now, from_mqtt=False, codec=None):
+    sensor = get_sensor_by_hid(sensor_hid)
     if sensor is None:
         _LOGGER.info("Sensor not found")
-        return
-    post_sensor_values(sensor, data, now, from_mqtt)
+        return None
+    return post_sensor_values(sensor, data, now, from_mqtt, codec)
 
 
-def post_sensor_values(sensor, args=None, now=None, from_mqtt=False):
-    if not time_in_range(sensor.time_start, sensor.time_end, datetime.datetime.utcnow().time()):
-        return {}
+def _save_file(sensor, field_name, input_file):
+    """Save an uploaded file of a file type field to the files database and return its UID"""
+    file_uid = str(uuid.uuid4())
+    meta = {
+        'filename': input_file.filename,
+        'mimetype': input_file.mimetype
+    }
+    new_file = BinFile(sensor_id=sensor.id, file=input_file.read(), meta_info=meta, uid=file_uid)
+    db.session.add(new_file)
+    return file_uid
 
-    sensor_types = get_all_types()
-    ip = None
 
-    # TODO: For MQTT, 'use' now from function params.
-    request_time = None
+def reading_time(reading, now):
+    """Time of a reading, the current time if it is missing or more than a day off"""
+    if reading.time is not None and -1 <= (now - reading.time).days <= 1:
+        return reading.time
+    return now
 
-    if not from_mqtt:
-        _parser = reqparse.RequestParser()
-        for key, field in sensor_types[sensor.type]['fields'].items():
-            if field['type'] == 'file':
-                _parser.add_argument(key, type=werkzeug.FileStorage, location='files')
-            else:
-                _parser.add_argument(key, type=float)
-        _parser.add_argument('time')
-        args = _parser.parse_args()
-
-        if 'time' in args.keys():
-            request_time = args['time']
-            del args['time']
-
-        for field_name in list(args.keys()):
-            if sensor_types[sensor.type]['fields'][field_name]['type'] == 'file':
-                # File type field, save the file to another DB and get the ID or UUID
-                input_file = args[field_name]
-                if not input_file:
-                    del args[field_name]
-                    continue
-                file_uid = str(uuid.uuid4())
-                meta = {
-                    'filename': input_file.filename,
-                    'mimetype': input_file.mimetype
-                }
-                new_file = BinFile(sensor_id=sensor.id, file=input_file.read(), meta_info=meta, uid=file_uid)
-                db.session.add(new_file)
-                args[field_name] = file_uid
 
-        ip = request.remote_addr
+def sensor_state_data(reading, time, now, ip=None):
+    """
+    Build the sensor row update of a validated reading.
 
-    now = datetime.datetime.now(datetime.timezone.utc)
-    lat = None
-    lng = None
+    :param reading: Reading
+    :param time: Time of the reading
+    :param now: Time the reading was received
+    :param ip: IP address of the device
+    :return: Column values, as for `update_sensor_state`
+    """
+    data = {
+        'value': dict(reading.value, time=time.isoformat()),
+        'last_update': now.replace(tzinfo=None),
+        'is_down': False,
+        'is_inactive': False,
+        'ip': ip
+    }
+    if reading.location_lat is not None:
+        data['location_lat'] = reading.location_lat
+    if reading.location_long is not None:
+        data['location_long'] = reading.location_long
+    return data
+
+
+def validate_readings(validator, readings, now):
+    """
+    Validate the readings of a bulk upload.
 
-    for field_name in list(args.keys()):
-        if field_name not in sensor_types[sensor.type]['fields'].keys():
+    Readings need a time, at most a day in the future and at most
+    INGEST_MAX_BACKFILL_DAYS in the past.
+
+    :param validator: ValueValidator of the sensor type
+    :param readings: List of dicts with `time` and field values
+    :param now: Current time
+    :return: Valid readings sorted by time and the list of rejected readings
+    """
+    backfill = datetime.timedelta(days=config.INGEST_MAX_BACKFILL_DAYS)
+    rows = []
+    rejected = []
+    for index, item in enumerate(readings):
+        if not isinstance(item, dict) or 'time' not in item:
+            rejected.append({'index': index, 'message': 'Reading must be an object with a time'})
             continue
-        if sensor_types[sensor.type]['fields'][field_name]['type'] == 'latitude':
-            lat = args[field_name]
-        elif sensor_types[sensor.type]['fields'][field_name]['type'] == 'longitude':
-            lng = args[field_name]
-    # db.session.commit()
-    if request_time is not None:
-        # TODO: Timezone naive issue
         try:
-            time = parser.parse(request_time, ignoretz=True)
-            time = time.replace(tzinfo=datetime.timezone.utc)
-            diff = (now - time).days
-            if -1 <= diff <= 1:
-                args['time'] = request_time
-            else:
-                args['time'] = now.isoformat()
-        except Exception as e:
-            _LOGGER.error('Date parse error : %s', e)
-            args['time'] = now.isoformat()
-    if sensor.is_inactive:
-        process_sensor_alerts(sensor, None, backup_alert=True, seconds=(now - sensor.last_update.replace(tzinfo=datetime.timezone.utc)).total_seconds())
-    data = {'value': args, 'last_update': now.replace(tzinfo=None), 'is_down': False, 'is_inactive': False, 'ip': ip}
-    if lat:
-        data['location_lat'] = lat
-    if lng:
-        data['location_long'] = lng
-    Sensor.query.filter(Sensor.id == sensor.id).update(data)
-    # TODO: Add value with sensor UID
-    # TODO: Add time from request
-
-    tsdb_data = data['value']
-    for key, field in sensor_types[sensor.type]['fields'].items():
-        if field.get('meta', False):
-            # Data is meta data, do not save to time series database
-            if key in tsdb_data.keys():
-                del tsdb_data[key]
+            reading = validator.validate(item)
+        except InvalidValue as e:
+            rejected.append({'index': index, 'message': 'Invalid value for {}: {}'.format(e.field, e)})
+            continue
+        if reading.time is None or reading.time - now > datetime.timedelta(days=1) or now - reading.time > backfill:
+            rejected.append({'index': index, 'message': 'Invalid time'})
+            continue
+        if not reading.value:
+            rejected.append({'index': index, 'message': 'No sensor fields in reading'})
+            continue
+        rows.append(reading)
+    rows.sort(key=lambda row: row.time)
+    return rows, rejected
+
+
+def post_sensor_values(sensor, args=None, now=None, from_mqtt=False, codec=None):
+    """
+    Save a sensor reading.
+
+    :param sensor: Sensor or SensorIdentity
+    :param args: Reading, read from the request if not `from_mqtt`
+    :param from_mqtt: Reading was received over MQTT
+    :param codec: Codec of the MQTT payload if `args` is the undecoded payload
+    :return: SensorState before the update or None if the reading was not saved
+    """
+    if not time_in_range(sensor.time_start, sensor.time_end, datetime.datetime.utcnow().time()):
+        return None
+
+    validator = get_validator(sensor.type)
+    if validator is None:
+        _LOGGER.error("Sensor type not found : %s", sensor.type)
+        return None
+    ip = None
+    files = None
+    key = None
+
+    if not from_mqtt:
+        args = request.values.to_dict()
+        json_data = request.get_json(silent=True)
+        if isinstance(json_data, dict):
+            args.update(json_data)
+        files = request.files
+        ip = request.remote_addr
+        key = dedup_key(sensor.uid, args, request.headers.get('X-Message-Id'))
+        if is_duplicate(key):
+            return None
+    elif codec is not None:
+        try:
+            args = codecs.decode(codec, args, validator)
+        except codecs.DecodeError as e:
+            _LOGGER.error('Invalid %s payload for %s : %s', codec, sensor.uid, e)
+            return None
+
+    try:
+        reading = validator.validate(args, files, lambda name, input_file: _save_file(sensor, name, input_file))
+    except InvalidValue as e:
+        if from_mqtt:
+            _LOGGER.error('Invalid value for %s : %s', e.field, e)
+            return None
+        abort(400, message={e.field: str(e)})
 
+    now = datetime.datetime.now(datetime.timezone.utc)
+    data = sensor_state_data(reading, reading_time(reading, now), now, ip)
+    value = data['value']
+    state = sensor_states.update(sensor, data)
+    if state is None:
+        db.session.rollback()
+        return None
+    if state.is_inactive:
+        process_sensor_alerts(sensor, None, backup_alert=True, seconds=(now - state.last_update.replace(tzinfo=datetime.timezone.utc)).total_seconds())
+
+    # Meta fields are saved with the sensor only, not to the time series database.
+    tsdb_data = dict(reading.fields, time=value['time'])
     tsdb.add_point(sensor, tsdb_data)
 
-    process_sensor_alerts(sensor, data['value'])
+    process_sensor_alerts(sensor, tsdb_data)
     sensor_uid = sensor.uid
     db.session.commit()
+    remember(key)
 
     if not from_mqtt and config.MQTT_BROKER_URL:
-        if request_time is None:
-            args['time'] = now.isoformat()
         # Publish the sensor value to MQTT channel.
         try:
-            args['fromServer'] = True
-            mqtt.publish('sensors/{}/values'.format(sensor_uid), json.dumps(args))
+            publish_value(sensor_uid, value)
+        except Exception as e:
+            _LOGGER.error(e)
+    return state
+
+
+def post_sensor_values_batch(readings):
+    """
+    Save readings of many sensors received over MQTT.
+
+    Sensors are resolved with one query, all readings are written to the
+    time series database with one write per sensor type and the rows of
+    the sensors are updated with one statement, with the newest reading of
+    each sensor. Readings which can not be decoded or validated are
+    dropped without affecting the others.
+
+    :param readings: List of (id type, sensor uid or hid, reading, codec)
+                     tuples; id type is `sensors` or `sensors_hid`, codec
+                     None if the reading is already decoded
+    :return: Number of saved readings
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    by_uid, by_hid = get_sensors(
+        uids={ref for id_type, ref, _, _ in readings if id_type == 'sensors'},
+        hids={ref for id_type, ref, _, _ in readings if id_type == 'sensors_hid'}
+    )
+    saved = []
+    for id_type, ref, data, codec in readings:
+        sensor = (by_uid if id_type == 'sensors' else by_hid).get(ref)
+        if sensor is None:
+            _LOGGER.info("Sensor not found : %s", ref)
+            continue
+        if not time_in_range(sensor.time_start, sensor.time_end, now.time()):
+            continue
+        validator = get_validator(sensor.type)
+        if validator is None:
+            _LOGGER.error("Sensor type not found : %s", sensor.type)
+            continue
+        try:
+            if codec is not None:
+                data = codecs.decode(codec, data, validator)
+            reading = validator.validate(data)
+        except codecs.DecodeError as e:
+            _LOGGER.error('Invalid %s payload for %s : %s', codec, sensor.uid, e)
+            continue
+        except InvalidValue as e:
+            _LOGGER.error('Invalid value for %s : %s', e.field, e)
+            continue
         except Exception as e:
             _LOGGER.error(e)
-    return {}
+            continue
+        saved.append((sensor, reading, sensor_state_data(reading, reading_time(reading, now), now)))
+    if not saved:
+        return 0
+
+    # The newest reading of each sensor, in order of arrival
+    latest = {}
+    for sensor, _, data in saved:
+        latest[sensor.id] = (sensor, data)
+    states = sensor_states.update_many(list(latest.values()))
+    for sensor_id, state in states.items():
+        if state.is_inactive:
+            process_sensor_alerts(latest[sensor_id][0], None, backup_alert=True,
+                                  seconds=(now - state.last_update.replace(tzinfo=datetime.timezone.utc)).total_seconds())
+
+    # Sensors deleted in the meantime have no state
+    points = [(sensor, dict(reading.fields, time=data['value']['time']))
+              for sensor, reading, data in saved if sensor.id in states]
+    tsdb.add_sensor_points(points)
+    for sensor, tsdb_data in points:
+        process_sensor_alerts(sensor, tsdb_data)
+    db.session.commit()
+    return len(points)
+
+
+def publish_values(values):
+    """
+    Publish the new values of sensors to MQTT, if there is a broker.
+
+    :param values: List of (sensor uid, value) pairs
+    """
+    if not config.MQTT_BROKER_URL:
+        return
+    for sensor_uid, value in values:
+        try:
+            publish_value(sensor_uid, value)
+        except Exception as e:
+            _LOGGER.error(e)
+
+
+def post_sensor_bulk_values(sensor, readings, ip=None, commit=True, published=None):
+    """
+    Save many time-stamped readings of one sensor.
+
+    All readings are validated first, then written to the time series
+    database in one batch. The sensor row is updated once with the newest
+    reading and alerts are evaluated once, for that reading. Readings no
+    newer than the last update of the sensor are history only; the sensor
+    keeps its value and no alerts are evaluated.
+
+    :param sensor: Sensor or SensorIdentity
+    :param readings: List of dicts with `time` and field values
+    :param ip: IP address of the device
+    :param commit: Commit the session after updating the sensor and publish
+                   its new value; otherwise both are left to the caller
+    :param published: List to which the (sensor uid, value) to publish is
+                      added if not `commit`, see `publish_values`
+    :return: Number of saved readings, the list of rejected readings and
+             the SensorState before the update, None if it was not updated
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if not time_in_range(sensor.time_start, sensor.time_end, now.time()):
+        return 0, [], None
+    validator = get_validator(sensor.type)
+    if validator is None:
+        return 0, [{'index': index, 'message': 'Sensor type not found'} for index in range(len(readings))], None
+
+    rows, rejected = validate_readings(validator, readings, now)
+    if not rows:
+        return 0, rejected, None
+
+    tsdb.add_points(sensor, [dict(row.fields, time=row.time.isoformat()) for row in rows])
+
+    latest = rows[-1]
+    last_update = sensor_states.last_update(sensor)
+    if last_update is not None and latest.time.astimezone(datetime.timezone.utc).replace(tzinfo=None) <= last_update:
+        # History only, the sensor keeps its newer value
+        return len(rows), rejected, None
+    data = sensor_state_data(latest, latest.time, now, ip)
+    value = data['value']
+    state = sensor_states.update(sensor, data)
+    if state is None:
+        # Deleted in the meantime
+        return len(rows), rejected, None
+    if state.is_inactive:
+        process_sensor_alerts(sensor, None, backup_alert=True, seconds=(now - state.last_update.replace(tzinfo=datetime.timezone.utc)).total_seconds())
+    process_sensor_alerts(sensor, dict(latest.fields, time=value['time']))
+    # Publish only the newest value; subscribers are interested in the current state.
+    if commit:
+        sensor_uid = sensor.uid
+        db.session.commit()
+        publish_values([(sensor_uid, value)])
+    elif published is not None:
+        published.append((sensor.uid, value))
+    return len(rows), rejected, state
 
 
 class SensorValueResource(Resource):
@@ -462,15 +659,76 @@ class SensorValueResource(Resource):
     def post(self, sensor_id):
         """Update sensor value"""
         # TODO: Update Value based on schema
-        sensor = g.sensor
-        if sensor is None:
-            sensor = Sensor.query.filter(Sensor.uid == sensor_id).filter(Sensor.deleted == False).first()
-        post_sensor_values(sensor)
-        if sensor.config_updated:
+        state = post_sensor_values(g.sensor)
+        if state and state.config_updated:
             return {"config": True}
         return {"config": False}
 
 
+class SensorBulkValuesResource(Resource):
+    """
+    Sensor bulk value resource.
+
+    Save many time-stamped readings of a sensor, e.g. readings buffered by a device while offline.
+    """
+    method_decorators = [access_control]
+
+    def post(self, sensor_id):
+        """Save a list of sensor readings"""
+        readings = request.get_json(silent=True)
+        if not isinstance(readings, list):
+            return {'message': 'Expected a list of readings', 'code': 422}, 422
+        accepted, rejected, state = post_sensor_bulk_values(g.sensor, readings, ip=request.remote_addr)
+        return {"accepted": accepted, "rejected": rejected, "config": bool(state and state.config_updated)}
+
+
+class CompanyBulkValuesResource(Resource):
+    """
+    Company bulk value resource.
+
+    Save time-stamped readings of many sensors of a company. The body maps
+    sensor UIDs or HIDs to lists of readings.
+    """
+    method_decorators = [access_control]
+
+    def post(self, company_id):
+        """Save lists of sensor readings"""
+        body = request.get_json(silent=True)
+        role = g.get('company_user_role', ROLE_READ)
+        if not role or role == ROLE_READ:
+            return {'message': 'Write access to the company is required', 'code': 403}, 403
+        if not isinstance(body, dict) or not all(isinstance(v, list) for v in body.values()):
+            return {'message': 'Expected an object of sensor ids and lists of readings', 'code': 422}, 422
+        company = Company.query.filter(Company.uid == company_id).filter(Company.deleted == False).first()
+        if company is None:
+            return {}, 404
+        keys = list(body.keys())
+        sensors = Sensor.query.filter(Sensor.company_id == company.id)\
+            .filter(Sensor.deleted == False)\
+            .filter(db.or_(Sensor.uid.in_(keys), Sensor.hid.in_(keys))).all()
+        by_key = {}
+        for sensor in sensors:
+            by_key.setdefault(sensor.hid, sensor)
+        for sensor in sensors:
+            by_key[sensor.uid] = sensor
+
+        result = {"accepted": 0, "rejected": {}, "not_found": []}
+        published = []
+        for key, readings in body.items():
+            sensor = by_key.get(key)
+            if sensor is None:
+                result['not_found'].append(key)
+                continue
+            accepted, rejected, _ = post_sensor_bulk_values(sensor, readings, ip=request.remote_addr, commit=False,
+                                                            published=published)
+            result['accepted'] += accepted
+            if rejected:
+                result['rejected'][key] = rejected
+        db.session.commit()
+        publish_values(published)
+        return result
+
+
 class SensorHistoryResource(Resource):
     """Sensor value history resource"""
     method_decorators = [access_control]
@@ -478,6 +736,11 @@ class SensorHistoryResource(Resource):
     def get(self, sensor_id=None, sensor_hid=None, company_id=None):
         """
         Get sensor value history.
+
+        The ``total`` argument may be ``estimate`` for a cheaper, estimated
+        total or ``none`` for no total, and ``cursor`` the ``next`` cursor of
+        the previous page. ``include`` lists the parts to compute, like
+        ``data,total``; the others are null.
         :param sensor_id: Sensor ID
         """
         order_by, order_type, offset, limit, filter = get_filters(in_request=request)
@@ -508,18 +771,28 @@ class SensorHistoryResource(Resource):
                 if parser.parse(end_date) > pytz.utc.localize(datetime.datetime.utcnow()):
                     end_date = datetime.datetime.utcnow().replace(microsecond=0).isoformat()+".000Z"
                     _LOGGER.debug(end_date)
+        include = None
+        if request.args.get('include'):
+            include = request.args['include'].split(',')
+            if not set(include) <= set(HISTORY_PARTS):
+                abort(400, message={'include': 'Parts are {}'.format(', '.join(HISTORY_PARTS))})
         order_type = 'DESC'
         sensor_types = get_all_types()
         value_fields = sensor_types[sensor.type]['fields']
-        points = tsdb.get_points(sensor, limit=limit, offset=offset, order_by="time " + order_type,
-                                 duration=duration, start_date=start_date, end_date=end_date, group_duration=group_duration, value_fields= value_fields, aggregate_function=aggregate_function, offset_interval=offset_interval)
+        try:
+            points = tsdb.get_points(sensor, limit=limit, offset=offset, order_by="time " + order_type,
+                                     duration=duration, start_date=start_date, end_date=end_date, group_duration=group_duration, value_fields= value_fields, aggregate_function=aggregate_function, offset_interval=offset_interval,
+                                     cursor=request.args.get('cursor'), total=request.args.get('total'),
+                                     include=include)
+        except InvalidCursor:
+            abort(400, message={'cursor': 'Invalid cursor'})
         points['fields'] = None
         if sensor.type in sensor_types.keys():
             points['fields'] = value_fields
             for field_name, field in value_fields.items():
                 # Do not show files in grouped data
                 if field['type'] == 'file' and group_duration is None:
-                    for point in points['data']:
+                    for point in points['data'] or []:
                         point[field_name] = url_for('files.fileresource', sensor_id=sensor.uid, uid=point[field_name], sensor_key=sensor.key, _external=True) if point[field_name] else ''
         return points
 
@@ -590,12 +863,8 @@ class SensorHIDValuesResources(Resource):
     method_decorators = [access_control]
 
     def post(self, company_id, sensor_hid):
-        company = Company.query.filter(Company.uid == company_id).filter(Company.deleted == False).first()
-        sensor = Sensor.query.filter(Sensor.company_id == company.id).filter(Sensor.hid == sensor_hid).filter(Sensor.deleted == False).first()
-        if sensor is None:
-            return {}, 404
-        post_sensor_values(sensor)
-        if sensor.config_updated:
+        state = post_sensor_values(g.sensor)
+        if state and state.config_updated:
             return {"config": True}
         return {"config": False}
 
@@ -644,8 +913,6 @@ class SensorValueDeleteResource(Resource):
         """Update sensor value"""
         # TODO: Get the values and delete the files also for this period
         sensor = g.sensor
-        if sensor is None:
-            sensor = Sensor.query.filter(Sensor.uid == sensor_id).filter(Sensor.deleted == False).first()
         data = request.json
         # try:
         time = data.get('time', None)
@@ -665,5 +932,7 @@ class SensorValueDeleteResource(Resource):
             #         "company_id": sensor.company_id
             #     }, end_date=end_date, start_date=start_date)
             delete_sensor_data.delay(sensor.type, sensor.company_id, sensor.id, start_date, end_date)
+            # Dropped again by the task once the points are deleted
+            tsdb.invalidate(sensor.id)
 
         return {}
@@ -0,0 +1,154 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Deduplication of sensor readings.
+
+Devices retry requests and RabbitMQ redelivers unacknowledged messages.
+With INGEST_DEDUP enabled, readings seen within the last
+INGEST_DEDUP_WINDOW seconds are dropped before they reach Postgres or the
+time series database.
+
+A reading is identified by its message id - the ``X-Message-Id`` header,
+the AMQP ``message_id`` property or a ``message_id`` field of the
+payload - or else by a hash of the sensor and the payload. Readings
+without a message id and without a time are never treated as duplicates.
+Message bodies are decoded with the codec of the message to find their
+time and message id, see `codecs.peek`.
+
+A reading is looked up with `is_duplicate` when it arrives and recorded
+with `remember` only once it has been saved, so a reading whose write
+failed is processed again when it is retried or redelivered. Copies of a
+reading arriving while the first one is still being saved are not caught.
+
+The index is kept per process: every web worker, ingest server, AMQP
+consumer worker and partition has its own. A retry served by another
+process than the original request, e.g. after a consumer restart or a
+partition moved to another worker, is not recognized.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from snms.core.config import config
+from snms.modules.sensors import codecs
+
+
+class DedupIndex(object):
+    """
+    Bounded index of recently seen keys.
+
+    Keys are kept for `window` seconds; the oldest keys are dropped once
+    `max_size` keys are stored.
+    """
+
+    def __init__(self, window=300, max_size=100000):
+        self.window = window
+        self.max_size = max_size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, key):
+        """
+        Check for a key.
+
+        :return: True if the key was remembered within the window
+        """
+        with self._lock:
+            self._expire(time.monotonic())
+            return key in self._seen
+
+    def remember(self, key):
+        """Record a key for the next `window` seconds"""
+        now = time.monotonic()
+        with self._lock:
+            self._seen.pop(key, None)
+            self._expire(now, 1)
+            self._seen[key] = now + self.window
+
+    def _expire(self, now, room=0):
+        # Keys are ordered by expiry, the window being the same for all of them.
+        while self._seen:
+            oldest = next(iter(self._seen.values()))
+            if oldest > now and len(self._seen) + room <= self.max_size:
+                break
+            self._seen.popitem(last=False)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def reading_key(sensor, data, message_id=None, codec=codecs.JSON):
+    """
+    Key identifying a reading.
+
+    :param sensor: Reference of the sensor, e.g. its uid or the routing key
+    :param data: Reading dict or the raw message body
+    :param message_id: Message id from a header or message property
+    :param codec: Codec of the message body
+    :return: Key or None if the reading can not be identified
+    """
+    if isinstance(data, bytes):
+        time, payload_id = codecs.peek(codec, data)
+    else:
+        time, payload_id = data.get('time'), data.get('message_id')
+    message_id = message_id or payload_id
+    if message_id:
+        return sensor, 'id', str(message_id)
+    if time is None:
+        return None
+    payload = data if isinstance(data, bytes) else json.dumps(data, sort_keys=True, default=str).encode('utf-8')
+    return sensor, 'sha1', hashlib.sha1(payload).hexdigest()
+
+
+def dedup_key(sensor, data, message_id=None, codec=codecs.JSON):
+    """
+    Key of a reading for `is_duplicate` and `remember`.
+
+    :param sensor: Reference of the sensor, e.g. its uid or the routing key
+    :param data: Reading dict or the raw message body
+    :param message_id: Message id from a header or message property
+    :param codec: Codec of the message body, see `codecs.get_codec`
+    :return: Key, None unless INGEST_DEDUP is enabled and the reading can be identified
+    """
+    if not config.INGEST_DEDUP:
+        return None
+    return reading_key(sensor, data, message_id, codec)
+
+
+def is_duplicate(key):
+    """
+    Check if a reading was already saved.
+
+    :param key: Key from `dedup_key`, never a duplicate if None
+    """
+    return key is not None and _get_index().seen(key)
+
+
+def remember(key):
+    """
+    Record a saved reading.
+
+    :param key: Key from `dedup_key`, ignored if None
+    """
+    if key is not None:
+        _get_index().remember(key)
+
+
+def _get_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = DedupIndex(config.INGEST_DEDUP_WINDOW, config.INGEST_DEDUP_SIZE)
+    return _index
@@ -0,0 +1,83 @@
+import struct
+
+import pytest
+
+from snms.modules.sensors import codecs, dedup
+from snms.modules.sensors.dedup import DedupIndex, reading_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_seen_does_not_remember(clock):
+    index = DedupIndex(window=10)
+    assert not index.seen('a')
+    assert not index.seen('a')
+    index.remember('a')
+    assert index.seen('a')
+    assert len(index) == 1
+
+
+def test_window(clock):
+    index = DedupIndex(window=10)
+    index.remember('a')
+    clock[0] += 5
+    index.remember('b')
+    clock[0] += 5
+    assert not index.seen('a')
+    assert index.seen('b')
+    assert len(index) == 1
+
+
+def test_remember_again_extends_window(clock):
+    index = DedupIndex(window=10)
+    index.remember('a')
+    clock[0] += 5
+    index.remember('b')
+    clock[0] += 3
+    index.remember('a')
+    clock[0] += 8
+    assert not index.seen('b')
+    assert index.seen('a')
+
+
+def test_max_size(clock):
+    index = DedupIndex(window=10, max_size=2)
+    for key in 'abc':
+        index.remember(key)
+    assert len(index) == 2
+    assert not index.seen('a')
+    assert index.seen('b') and index.seen('c')
+
+
+@pytest.mark.parametrize(('data', 'message_id', 'expected'), (
+    ({'value': 1}, 'm1', ('s', 'id', 'm1')),
+    ({'value': 1, 'message_id': 7}, None, ('s', 'id', '7')),
+    ({'value': 1}, None, None),
+    (b'{"value": 1}', None, None),
+    (b'{"value": 1, "message_id": "m2"}', None, ('s', 'id', 'm2')),
+))
+def test_reading_key(data, message_id, expected):
+    assert reading_key('s', data, message_id) == expected
+
+
+def test_reading_key_hashes_timed_readings():
+    key = reading_key('s', {'time': '2018-01-01T00:00:00', 'value': 1})
+    assert key[:2] == ('s', 'sha1')
+    assert key == reading_key('s', {'value': 1, 'time': '2018-01-01T00:00:00'})
+    assert key != reading_key('s', {'time': '2018-01-01T00:00:01', 'value': 1})
+    assert reading_key('s', b'{"time": 1}') == reading_key('s', b'{"time": 1}')
+
+
+def test_reading_key_hashes_timed_binary_readings():
+    timed = struct.pack('<If', 1514764800, 1.0)
+    key = reading_key('s', timed, codec=codecs.COMPACT)
+    assert key[:2] == ('s', 'sha1')
+    assert key == reading_key('s', timed, codec=codecs.COMPACT)
+    assert key != reading_key('s', struct.pack('<If', 1514764801, 1.0), codec=codecs.COMPACT)
+    assert reading_key('s', struct.pack('<If', 0, 1.0), codec=codecs.COMPACT) is None
+    assert reading_key('s', timed, codec=None) is None
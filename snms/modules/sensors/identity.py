@@ -0,0 +1,205 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Sensor identity cache.
+
+Resolving a sensor by uid or hid happens for every reading and every
+broker auth request. The identity of a sensor - what is needed to route
+and authorize a reading - rarely changes, so it is cached as an immutable
+snapshot and dropped whenever a sensor or its company is committed.
+
+Invalidation only reaches the cache of the committing process. Every other
+process keeps authorizing readings with an old identity, e.g. a revoked
+key, until its entry expires after SENSOR_CACHE_TTL seconds, which is why
+that TTL is kept short.
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import inspect
+
+from snms.core import signals
+from snms.core.config import config
+from snms.core.db import db
+from snms.modules.companies import Company
+from snms.modules.sensors.models.sensors import Sensor
+
+SensorIdentity = namedtuple('SensorIdentity', [
+    'id', 'uid', 'hid', 'type', 'company_id', 'company_uid', 'key', 'company_key', 'time_start', 'time_end', 'deleted'
+])
+
+
+class SensorIdentityCache(object):
+    """
+    Cache of sensor identities by uid, by (company uid, hid) and by hid.
+
+    Entries expire after SENSOR_CACHE_TTL seconds so that changes made by
+    other processes are picked up.
+
+    :param max_size: Maximum number of entries, the cache is cleared when reached
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._entries = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        Get an identity, loading it with `loader` on a miss.
+
+        Missing sensors are not cached.
+
+        :param key: Cache key
+        :param loader: Function returning the SensorIdentity or None
+        """
+        identity = self.peek(key)
+        if identity is None:
+            identity = loader()
+            if identity is not None:
+                self.put(key, identity)
+        return identity
+
+    def peek(self, key):
+        """Get a cached identity, None on a miss"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    def put(self, key, identity):
+        """Cache an identity"""
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
+                self._keys.clear()
+            self._entries[key] = (identity, time.monotonic() + config.SENSOR_CACHE_TTL)
+            self._keys.setdefault(identity.id, set()).add(key)
+
+    def invalidate(self, sensor_id):
+        """Drop all entries of a sensor"""
+        with self._lock:
+            for key in self._keys.pop(sensor_id, ()):
+                self._entries.pop(key, None)
+
+    def invalidate_company(self, company_id):
+        """Drop all entries of the sensors of a company"""
+        with self._lock:
+            for key, (identity, _) in list(self._entries.items()):
+                if identity.company_id == company_id:
+                    del self._entries[key]
+                    self._keys.pop(identity.id, None)
+
+    def clear(self):
+        """Drop all entries"""
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+
+sensor_identities = SensorIdentityCache()
+
+
+def _identity_query(*criteria):
+    return db.session.query(
+        Sensor.id, Sensor.uid, Sensor.hid, Sensor.type, Sensor.company_id, Company.uid, Sensor.key, Company.key,
+        Sensor.time_start, Sensor.time_end, Sensor.deleted
+    ).join(Company, Company.id == Sensor.company_id).filter(Sensor.deleted == False).filter(*criteria)
+
+
+def _load_identity(*criteria):
+    row = _identity_query(*criteria).first()
+    if row is None:
+        return None
+    return SensorIdentity(*row)
+
+
+def get_sensor_by_uid(sensor_uid):
+    """
+    Get the identity of a sensor by its uid.
+
+    :param sensor_uid: Sensor UID
+    :return: SensorIdentity or None if there is no such sensor
+    """
+    return sensor_identities.get(('uid', sensor_uid), lambda: _load_identity(Sensor.uid == sensor_uid))
+
+
+def get_sensor_by_hid(sensor_hid, company_uid=None):
+    """
+    Get the identity of a sensor by its hid.
+
+    HIDs are only unique within a company; without `company_uid` any
+    sensor with the hid is returned.
+
+    :param sensor_hid: Sensor HID
+    :param company_uid: Company UID
+    :return: SensorIdentity or None if there is no such sensor
+    """
+    if company_uid is None:
+        return sensor_identities.get(('hid', None, sensor_hid), lambda: _load_identity(Sensor.hid == sensor_hid))
+    return sensor_identities.get(
+        ('hid', company_uid, sensor_hid),
+        lambda: _load_identity(Sensor.hid == sensor_hid, Company.uid == company_uid, Company.deleted == False)
+    )
+
+
+def get_sensors(uids=(), hids=()):
+    """
+    Get the identities of many sensors, loading all cache misses with one query.
+
+    As with `get_sensor_by_hid` without a company, any sensor with a hid
+    is returned.
+
+    :param uids: Sensor UIDs
+    :param hids: Sensor HIDs
+    :return: Dicts of the found uids and hids and their SensorIdentity
+    """
+    by_uid = {}
+    by_hid = {}
+    missing_uids = set()
+    missing_hids = set()
+    for uid in uids:
+        identity = sensor_identities.peek(('uid', uid))
+        if identity is None:
+            missing_uids.add(uid)
+        else:
+            by_uid[uid] = identity
+    for hid in hids:
+        identity = sensor_identities.peek(('hid', None, hid))
+        if identity is None:
+            missing_hids.add(hid)
+        else:
+            by_hid[hid] = identity
+    if missing_uids or missing_hids:
+        criteria = []
+        if missing_uids:
+            criteria.append(Sensor.uid.in_(missing_uids))
+        if missing_hids:
+            criteria.append(Sensor.hid.in_(missing_hids))
+        for row in _identity_query(db.or_(*criteria)):
+            identity = SensorIdentity(*row)
+            if identity.uid in missing_uids:
+                by_uid[identity.uid] = identity
+                sensor_identities.put(('uid', identity.uid), identity)
+            if identity.hid in missing_hids and identity.hid not in by_hid:
+                by_hid[identity.hid] = identity
+                sensor_identities.put(('hid', None, identity.hid), identity)
+    return by_uid, by_hid
+
+
+@signals.model_committed.connect_via(Sensor)
+def _sensor_committed(sender, obj, change, **kwargs):
+    # Use the identity key, attributes of the object are expired after the commit.
+    sensor_identities.invalidate(inspect(obj).identity[0])
+
+
+@signals.model_committed.connect_via(Company)
+def _company_committed(sender, obj, change, **kwargs):
+    sensor_identities.invalidate_company(inspect(obj).identity[0])
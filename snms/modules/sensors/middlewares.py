@@ -12,7 +12,7 @@ from flask import g, request
 from snms.common.auth import DecodeError, parse_token, ExpiredSignature
 from snms.modules.users import User
 from snms.modules.companies import Company, user_company_acl_role
-from snms.modules.sensors import Sensor
+from snms.modules.sensors.identity import get_sensor_by_uid, get_sensor_by_hid
 from snms.const import ROLE_ADMIN, ROLE_READ, ROLE_WRITE
 
 
@@ -60,22 +60,15 @@ def access_control(f):
                 g.company_user_role = role
 
         if 'sensor_id' in kwargs.keys() or 'sensor_hid' in kwargs.keys():
-            sensor = None
             if 'sensor_id' in kwargs.keys():
-                sensor_uid = kwargs['sensor_id']
-                sensor = Sensor.query.filter(Sensor.uid == sensor_uid).filter(Sensor.deleted == False).first()
+                sensor = get_sensor_by_uid(kwargs['sensor_id'])
             else:
-                sensor_hid = kwargs['sensor_hid']
-                s_q = Sensor.query.filter(Sensor.hid == sensor_hid)
-                if 'company_id' in kwargs.keys():
-                    company_id = kwargs['company_id']
-                    company = Company.query.filter(Company.uid == company_id).filter(Company.deleted == False).first()
-                    s_q = s_q.filter(Sensor.company_id == company.id)
-                sensor = s_q.filter(Sensor.deleted == False).first()
+                sensor = get_sensor_by_hid(kwargs['sensor_hid'], kwargs.get('company_id'))
             if sensor is None:
                 raise NotFound("Sensor not found")
+            # Identity snapshot of the sensor, load the Sensor if other columns are needed.
             g.sensor = sensor
-            if sensor.key == sensor_key or sensor.company.key == company_key or super_admin:
+            if sensor.key == sensor_key or sensor.company_key == company_key or super_admin:
                 return f(*args, **kwargs)
             if auth_header and g.user:
                 role = user_company_acl_role(g.user.id, sensor.company_id)
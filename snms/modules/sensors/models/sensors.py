@@ -5,6 +5,8 @@
 # License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
 
 """Sensors database model."""
+import json
+from collections import namedtuple
 from datetime import datetime, time
 from snms.database import tsdb
 from snms.core.db import db, query_callable, regions
@@ -130,4 +132,64 @@ def get_all_types():
         "fields": sensor.value_fields,
         "config_fields": sensor.config_fields
     } for sensor in sensors}
-    return types
\ No newline at end of file
+    return types
+
+SensorState = namedtuple('SensorState', ['is_inactive', 'last_update', 'config_updated'])
+
+
+def update_sensor_state(sensor_id, data):
+    """
+    Update columns of a sensor without loading it.
+
+    The previous inactivity state and the configuration time are read by
+    the same statement.
+
+    :param sensor_id: Sensor ID
+    :param data: Column values
+    :return: SensorState before the update or None if the sensor does not exist
+    """
+    sensors = Sensor.__table__
+    old = sensors.alias('old')
+    query = sensors.update()\
+        .where(sensors.c.id == old.c.id)\
+        .where(sensors.c.id == sensor_id)\
+        .values(**data)\
+        .returning(old.c.is_inactive, old.c.last_update, old.c.config_updated)
+    row = db.session.execute(query).first()
+    if row is None:
+        return None
+    return SensorState(*row)
+
+
+def update_sensor_states(connection, states):
+    """
+    Update the value, last update, ip and location of many sensors with one
+    statement and clear their down and inactive flags.
+
+    :param connection: Database connection
+    :param states: Dict of sensor IDs and column values
+    :return: Dict of sensor IDs and their SensorState before the update
+    """
+    rows = []
+    params = {}
+    for i, (sensor_id, data) in enumerate(states.items()):
+        rows.append('(CAST(:id_{0} AS integer), CAST(:value_{0} AS json), CAST(:last_update_{0} AS timestamp), '
+                    'CAST(:ip_{0} AS varchar), CAST(:lat_{0} AS double precision), '
+                    'CAST(:lng_{0} AS double precision))'.format(i))
+        params['id_{}'.format(i)] = sensor_id
+        params['value_{}'.format(i)] = json.dumps(data['value'])
+        params['last_update_{}'.format(i)] = data['last_update']
+        params['ip_{}'.format(i)] = data.get('ip')
+        params['lat_{}'.format(i)] = data.get('location_lat')
+        params['lng_{}'.format(i)] = data.get('location_long')
+    query = db.text("""
+        UPDATE sensors
+        SET value = v.value, last_update = v.last_update, ip = v.ip,
+            location_lat = COALESCE(v.location_lat, sensors.location_lat),
+            location_long = COALESCE(v.location_long, sensors.location_long),
+            is_down = FALSE, is_inactive = FALSE
+        FROM (VALUES {}) AS v (id, value, last_update, ip, location_lat, location_long), sensors AS old
+        WHERE sensors.id = v.id AND old.id = v.id
+        RETURNING sensors.id, old.is_inactive, old.last_update, old.config_updated
+    """.format(', '.join(rows)))
+    return {row[0]: SensorState(*row[1:]) for row in connection.execute(query, params)}
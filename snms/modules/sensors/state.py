@@ -0,0 +1,189 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Write-behind buffer for the latest state of sensors.
+
+Every reading updates the value, last update time, ip and location of its
+sensor. Instead of rewriting the same row for every reading, only the
+newest state of each sensor is kept and all changed sensors are written
+every SENSOR_STATE_FLUSH_INTERVAL seconds with a single statement.
+"""
+
+import atexit
+import os
+import threading
+
+from flask import current_app
+from sqlalchemy import inspect
+
+from snms.core import signals
+from snms.core.config import config
+from snms.core.db import db
+from snms.core.logger import Logger
+from snms.modules.sensors.models.sensors import Sensor, update_sensor_state, update_sensor_states
+from snms.utils.check_alerts import process_sensor_alerts
+
+_LOGGER = Logger.get(__name__)
+
+
+class SensorStateBuffer(object):
+    """
+    Latest-state buffer of sensors.
+
+    The first reading of a sensor in this process is written immediately
+    to learn its state. Later readings are buffered and merged, so a field
+    like the location is kept when a newer reading does not have it. A
+    reading arriving SENSOR_STATE_STALE_AFTER seconds or more after the
+    previous one is written immediately as well: only then may the sensor
+    have been marked inactive, and its recovery is alerted right away
+    instead of one flush later. The flush still reads the previous state of
+    each row to catch shorter inactivity periods.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self._pending = {}
+        self._states = {}
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._app = None
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+    def update(self, sensor, data):
+        """
+        Save the state of a sensor.
+
+        Without SENSOR_STATE_BUFFER the row is updated in the current session.
+
+        :param sensor: Sensor or SensorIdentity
+        :param data: Column values, as for `update_sensor_state`
+        :return: SensorState before the update, as far as known, or None if the sensor does not exist
+        """
+        if not config.SENSOR_STATE_BUFFER:
+            return update_sensor_state(sensor.id, data)
+        with self._cond:
+            state = self._states.get(sensor.id)
+            pending = self._pending.pop(sensor.id, None)
+            if pending is not None:
+                data = {**pending[1], **data}
+            if state is not None and not self._closed and \
+                    (data['last_update'] - state.last_update).total_seconds() < config.SENSOR_STATE_STALE_AFTER:
+                self._pending[sensor.id] = (sensor, data)
+                self._states[sensor.id] = state._replace(last_update=data['last_update'])
+                self._ensure_thread()
+                return state
+        state = update_sensor_state(sensor.id, data)
+        if state is not None:
+            with self._cond:
+                self._states[sensor.id] = state._replace(is_inactive=False, last_update=data['last_update'])
+        return state
+
+    def update_many(self, items):
+        """
+        Save the state of many sensors.
+
+        Without SENSOR_STATE_BUFFER all rows are updated with one statement
+        in the current session.
+
+        :param items: List of (sensor, data) pairs, at most one per sensor
+        :return: Dict of sensor IDs and their SensorState before the update, as far as known
+        """
+        if not config.SENSOR_STATE_BUFFER:
+            return update_sensor_states(db.session.connection(), {sensor.id: data for sensor, data in items})
+        states = {}
+        for sensor, data in items:
+            state = self.update(sensor, data)
+            if state is not None:
+                states[sensor.id] = state
+        return states
+
+    def last_update(self, sensor):
+        """
+        Time the newest state of a sensor was received, buffered or saved.
+
+        :param sensor: Sensor or SensorIdentity
+        :return: Naive UTC datetime, None if the sensor has no state yet
+        """
+        with self._cond:
+            pending = self._pending.get(sensor.id)
+        if pending is not None:
+            return pending[1]['last_update']
+        return db.session.query(Sensor.last_update).filter(Sensor.id == sensor.id).scalar()
+
+    def forget(self, sensor_id):
+        """Drop the known state of a sensor, its next reading is written immediately"""
+        with self._cond:
+            self._states.pop(sensor_id, None)
+
+    def flush(self):
+        """Write all buffered states now"""
+        with self._cond:
+            pending = self._pending
+            self._pending = {}
+        if not pending or self._app is None:
+            return
+        items = list(pending.items())
+        with self._write_lock, self._app.app_context():
+            for i in range(0, len(items), self.batch_size):
+                batch = dict(items[i:i + self.batch_size])
+                try:
+                    with db.engine.begin() as connection:
+                        previous = update_sensor_states(connection, {k: data for k, (_, data) in batch.items()})
+                except Exception as e:
+                    _LOGGER.error('Dropped state of %d sensors: %s', len(batch), e)
+                    continue
+                for sensor_id, state in previous.items():
+                    if state.is_inactive:
+                        sensor, data = batch[sensor_id]
+                        process_sensor_alerts(sensor, None, backup_alert=True,
+                                              seconds=(data['last_update'] - state.last_update).total_seconds())
+                    with self._cond:
+                        known = self._states.get(sensor_id)
+                        if known is not None:
+                            self._states[sensor_id] = known._replace(config_updated=state.config_updated)
+
+    def close(self):
+        """Stop the flush thread and write all buffered states"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            thread.join()
+        self.flush()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        if self._pid is None:
+            atexit.register(self.close)
+        self._app = current_app._get_current_object()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='sensor-state-buffer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(config.SENSOR_STATE_FLUSH_INTERVAL)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+
+sensor_states = SensorStateBuffer()
+
+
+@signals.model_committed.connect_via(Sensor)
+def _sensor_committed(sender, obj, change, **kwargs):
+    sensor_states.forget(inspect(obj).identity[0])
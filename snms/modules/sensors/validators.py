@@ -0,0 +1,179 @@
+# This file is part of SwarmSense IoT Platform
+# Copyright (c) 2018, Baseapp Systems And Softwares Private Limited
+# Authors: Gopal Lal
+#
+# License: www.baseapp.com/swarmsense-whitelabel-iot-platoform
+
+"""
+Sensor value validators.
+
+A validator is compiled once per sensor type from `SensorType.value_fields`
+and converts a raw reading in a single pass into the value saved for the
+sensor, the fields written to the time series database and its location.
+"""
+
+import datetime
+import threading
+import time
+from collections import namedtuple
+
+from dateutil import parser
+
+from snms.core import signals
+from snms.core.config import config
+from snms.core.logger import Logger
+from snms.modules.sensors.models.sensors import SensorType
+
+_LOGGER = Logger.get()
+
+Reading = namedtuple('Reading', ['value', 'fields', 'location_lat', 'location_long', 'time'])
+"""
+Validated reading.
+
+`value` holds all sensor fields, `fields` the fields to be saved to the
+time series database (without meta fields). `time` is the time of the
+reading in UTC, None if it was not given or could not be parsed.
+"""
+
+
+class InvalidValue(ValueError):
+    """A field of a reading has an invalid value"""
+
+    def __init__(self, field, message):
+        super().__init__(message)
+        self.field = field
+
+
+class ValueValidator(object):
+    """
+    Validator for the readings of one sensor type.
+
+    :param sensor_type: Sensor type name
+    :param value_fields: Value fields of the sensor type
+    """
+
+    def __init__(self, sensor_type, value_fields):
+        self.sensor_type = sensor_type
+        self.fields = [(name, field.get('type'), bool(field.get('meta', False)))
+                       for name, field in (value_fields or {}).items()]
+        # Field order of positional (array) payloads.
+        self.positional_fields = [name for name, kind, meta in self.fields if kind != 'file']
+
+    def validate(self, data, files=None, save_file=None):
+        """
+        Validate a reading.
+
+        File fields are only read from `files` and stored with `save_file`,
+        which gets the field name and the file and returns the value to
+        save, e.g. the UID of the stored file.
+
+        :param data: Mapping of field names to values and optional `time`
+        :param files: Mapping of field names to uploaded files
+        :param save_file: Callback to store an uploaded file
+        :return: Reading
+        :raises InvalidValue: If a value can not be converted
+        """
+        value = {}
+        fields = {}
+        lat = None
+        lng = None
+        for name, kind, meta in self.fields:
+            if kind == 'file':
+                if not files or save_file is None or not files.get(name):
+                    continue
+                item = save_file(name, files[name])
+            else:
+                item = data.get(name)
+                if item is None or item == '':
+                    continue
+                try:
+                    item = float(item)
+                except (TypeError, ValueError) as e:
+                    raise InvalidValue(name, str(e))
+                if kind == 'latitude':
+                    lat = item
+                elif kind == 'longitude':
+                    lng = item
+            value[name] = item
+            if not meta:
+                fields[name] = item
+
+        reading_time = data.get('time')
+        if isinstance(reading_time, datetime.datetime):
+            # Decoded from a binary payload
+            if reading_time.tzinfo is None:
+                reading_time = reading_time.replace(tzinfo=datetime.timezone.utc)
+            reading_time = reading_time.astimezone(datetime.timezone.utc)
+        elif isinstance(reading_time, (int, float)) and not isinstance(reading_time, bool):
+            # UNIX time, from a binary payload
+            try:
+                reading_time = datetime.datetime.fromtimestamp(reading_time, datetime.timezone.utc)
+            except (ValueError, OverflowError, OSError) as e:
+                _LOGGER.error('Date parse error : %s', e)
+                reading_time = None
+        elif reading_time is not None:
+            try:
+                reading_time = parser.parse(reading_time, ignoretz=True).replace(tzinfo=datetime.timezone.utc)
+            except (ValueError, TypeError, OverflowError) as e:
+                _LOGGER.error('Date parse error : %s', e)
+                reading_time = None
+        return Reading(value, fields, lat, lng, reading_time)
+
+
+_validators = {}
+_validators_lock = threading.Lock()
+
+
+def get_validator(sensor_type):
+    """
+    Get the compiled validator of a sensor type.
+
+    Validators are cached for SENSOR_TYPE_CACHE_TTL seconds so that changes
+    made by other processes are picked up; changes committed in this process
+    invalidate the cache immediately.
+
+    :param sensor_type: Sensor type name
+    :return: ValueValidator or None if the sensor type does not exist
+    """
+    validator = cached_validator(sensor_type)
+    if validator is not None:
+        return validator
+    _type = SensorType.query.filter(SensorType.type == sensor_type).filter(SensorType.deleted == False).first()
+    if _type is None:
+        return None
+    return cache_validator(ValueValidator(_type.type, _type.value_fields))
+
+
+def cached_validator(sensor_type):
+    """Get the validator of a sensor type if it is cached and not expired"""
+    cached = _validators.get(sensor_type)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+
+def cache_validator(validator):
+    """Cache a validator and return it"""
+    with _validators_lock:
+        _validators[validator.sensor_type] = (validator, time.monotonic() + config.SENSOR_TYPE_CACHE_TTL)
+    return validator
+
+
+def invalidate_validators(sensor_type=None):
+    """
+    Drop cached validators.
+
+    :param sensor_type: Sensor type name, all sensor types if None
+    """
+    with _validators_lock:
+        if sensor_type is None:
+            _validators.clear()
+        else:
+            _validators.pop(sensor_type, None)
+
+
+@signals.model_committed.connect_via(SensorType)
+def _sensor_type_committed(sender, obj, change, **kwargs):
+    # Attributes are expired after the commit; sensor type changes are rare
+    # enough to simply drop all validators instead of reloading the type.
+    invalidate_validators()
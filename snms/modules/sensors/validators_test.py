@@ -0,0 +1,67 @@
+import datetime
+
+import pytest
+
+from snms.modules.sensors.validators import InvalidValue, ValueValidator
+
+
+@pytest.fixture
+def validator():
+    return ValueValidator('weather', {
+        'temperature': {'type': 'number'},
+        'battery': {'type': 'number', 'meta': True},
+        'lat': {'type': 'latitude'},
+        'lng': {'type': 'longitude'},
+        'photo': {'type': 'file'},
+    })
+
+
+def test_validate_converts_fields(validator):
+    reading = validator.validate({'temperature': '21.5', 'battery': 80, 'lat': '12.5', 'lng': 77, 'other': 1})
+    assert reading.value == {'temperature': 21.5, 'battery': 80.0, 'lat': 12.5, 'lng': 77.0}
+    assert reading.fields == {'temperature': 21.5, 'lat': 12.5, 'lng': 77.0}
+    assert (reading.location_lat, reading.location_long) == (12.5, 77.0)
+    assert reading.time is None
+
+
+def test_validate_skips_empty_fields(validator):
+    reading = validator.validate({'temperature': '', 'battery': None})
+    assert reading.value == {}
+    assert reading.fields == {}
+
+
+def test_validate_invalid_value(validator):
+    with pytest.raises(InvalidValue) as exc_info:
+        validator.validate({'temperature': 'warm'})
+    assert exc_info.value.field == 'temperature'
+
+
+def test_validate_files(validator):
+    saved = []
+
+    def save_file(name, input_file):
+        saved.append((name, input_file))
+        return 'file-uid'
+
+    reading = validator.validate({'photo': 'ignored'}, {'photo': b'jpeg'}, save_file)
+    assert saved == [('photo', b'jpeg')]
+    assert reading.fields == {'photo': 'file-uid'}
+    assert validator.validate({'photo': 'ignored'}).value == {}
+
+
+@pytest.mark.parametrize(('value', 'expected'), (
+    ('2018-05-01T10:00:00', datetime.datetime(2018, 5, 1, 10, tzinfo=datetime.timezone.utc)),
+    ('2018-05-01T10:00:00+05:30', datetime.datetime(2018, 5, 1, 10, tzinfo=datetime.timezone.utc)),
+    (1525168800, datetime.datetime(2018, 5, 1, 10, tzinfo=datetime.timezone.utc)),
+    (datetime.datetime(2018, 5, 1, 10), datetime.datetime(2018, 5, 1, 10, tzinfo=datetime.timezone.utc)),
+    (datetime.datetime(2018, 5, 1, 15, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=5, minutes=30))),
+     datetime.datetime(2018, 5, 1, 10, tzinfo=datetime.timezone.utc)),
+    ('not a date', None),
+    (True, None),
+))
+def test_validate_time(validator, value, expected):
+    assert validator.validate({'time': value}).time == expected
+
+
+def test_positional_fields(validator):
+    assert validator.positional_fields == ['temperature', 'battery', 'lat', 'lng']
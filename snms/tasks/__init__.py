@@ -18,6 +18,7 @@ from dateutil import parser
 
 
 from snms.core.celery import celery
+from snms.core.config import config
 from snms.core.logger import Logger
 from snms.database import tsdb
 from snms.core.db import db
@@ -52,6 +53,8 @@ def setup_periodic_tasks(sender, **kwargs):
     sender.add_periodic_task(crontab(), device_status.s(), name='check_device_status')
     sender.add_periodic_task(crontab(), inactivity_alerts_check.s(), name='inactivity_alerts_check')
     sender.add_periodic_task(crontab(), run_schedule_events.s(), name='run_scheduled_events')
+    sender.add_periodic_task(crontab(), update_rollups.s(), name='update_rollups')
+    sender.add_periodic_task(crontab(minute=30), expire_data.s(), name='expire_data')
 
 
 def time_in_range(start, end, x):
@@ -81,6 +84,56 @@ def device_status():
     db.session.commit()
 
 
+@celery.task(name='snms.tasks.update_rollups', ignore_result=True)
+def update_rollups():
+    """Roll up the sensor readings of the intervals closed since the last run, with TSDB_ROLLUPS"""
+    if not config.TSDB_ROLLUPS:
+        return
+    sensors = db.session.query(Sensor.id, Sensor.type, Sensor.company_id, Sensor.last_update).\
+        filter(Sensor.deleted == False).\
+        filter(Sensor.last_update != None).all()
+    types = {}
+    companies = {}
+    for sensor_id, sensor_type, company_id, last_update in sensors:
+        types.setdefault(sensor_type, {})[sensor_id] = last_update
+        companies[sensor_id] = company_id
+    for sensor_type, last_updates in types.items():
+        try:
+            tsdb.update_rollups(sensor_type, last_updates, companies)
+        except Exception as e:
+            _LOGGER.error(e)
+
+
+@celery.task(name='snms.tasks.expire_data', ignore_result=True)
+def expire_data():
+    """
+    Drop what is kept about sensor readings past their retention, with
+    TSDB_RETENTION: the database entries they do not expire themselves and
+    the files of file fields.
+    """
+    if not tsdb.retention:
+        return
+    now = datetime.utcnow()
+    file_types = {sensor_type.type for sensor_type in SensorType.query
+                  if any(field['type'] == 'file' for field in (sensor_type.value_fields or {}).values())}
+    types = {}
+    for sensor_id, sensor_type, company_id in db.session.query(Sensor.id, Sensor.type, Sensor.company_id):
+        types.setdefault(sensor_type, {})[sensor_id] = company_id
+    for sensor_type, sensors in types.items():
+        try:
+            tsdb.expire(sensor_type, sensors)
+        except Exception as e:
+            _LOGGER.error(e)
+        if sensor_type not in file_types:
+            continue
+        for sensor_id, company_id in sensors.items():
+            seconds = tsdb.retention.seconds(sensor_type, company_id)
+            if seconds:
+                db.session.query(BinFile).filter(BinFile.sensor_id == sensor_id).\
+                    filter(BinFile.created_at < now - timedelta(seconds=seconds)).delete()
+        db.session.commit()
+
+
 def render_template(_str, **context):
     env = Environment()
     template = env.from_string(_str)
@@ -104,11 +104,32 @@ def configure_db(app):
 def configure_tsdb(app):
     if app.config['TESTING']:
         return
+    app.config['TSDB_CLIENT'] = config.TSDB_CLIENT
+    app.config['TSDB_DIR'] = config.TSDB_DIR
     app.config['TSDB_HOST'] = config.TSDB_HOST
     app.config['TSDB_PORT'] = config.TSDB_PORT
     app.config['TSDB_USERNAME'] = config.TSDB_USERNAME
     app.config['TSDB_PASSWORD'] = config.TSDB_PASSWORD
     app.config['TSDB_DB'] = config.TSDB_DB
+    app.config['TSDB_WRITE_BUFFER'] = config.TSDB_WRITE_BUFFER
+    app.config['TSDB_BATCH_SIZE'] = config.TSDB_BATCH_SIZE
+    app.config['TSDB_FLUSH_INTERVAL'] = config.TSDB_FLUSH_INTERVAL
+    app.config['TSDB_BUFFER_MAX_SIZE'] = config.TSDB_BUFFER_MAX_SIZE
+    app.config['TSDB_WRITE_RETRIES'] = config.TSDB_WRITE_RETRIES
+    app.config['TSDB_MAX_INFLIGHT'] = config.TSDB_MAX_INFLIGHT
+    app.config['TSDB_BUCKET_SIZE'] = config.TSDB_BUCKET_SIZE
+    app.config['TSDB_BUCKET_SIZES'] = config.TSDB_BUCKET_SIZES
+    app.config['TSDB_QUERY_CACHE'] = config.TSDB_QUERY_CACHE
+    app.config['TSDB_QUERY_CACHE_SIZE'] = config.TSDB_QUERY_CACHE_SIZE
+    app.config['TSDB_QUERY_CACHE_BUCKET'] = config.TSDB_QUERY_CACHE_BUCKET
+    app.config['TSDB_QUERY_CACHE_GRACE'] = config.TSDB_QUERY_CACHE_GRACE
+    app.config['TSDB_QUERY_CACHE_TTL'] = config.TSDB_QUERY_CACHE_TTL
+    app.config['TSDB_QUERY_CACHE_WAIT'] = config.TSDB_QUERY_CACHE_WAIT
+    app.config['REDIS_CACHE_URL'] = config.REDIS_CACHE_URL
+    app.config['TSDB_ROLLUPS'] = config.TSDB_ROLLUPS
+    app.config['TSDB_RETENTION'] = config.TSDB_RETENTION
+    app.config['TSDB_RETENTION_TYPES'] = config.TSDB_RETENTION_TYPES
+    app.config['TSDB_RETENTION_COMPANIES'] = config.TSDB_RETENTION_COMPANIES
 
     tsdb.init_app(app)
 